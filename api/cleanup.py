@@ -0,0 +1,88 @@
+import logging
+import shutil
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import func, select
+
+from api import database, metrics, storage
+from api.database import DBDocument
+from api.jobs import PENDING
+from api.settings import config
+
+logger = logging.getLogger("gunicorn.error")
+
+documents = DBDocument.__table__
+
+# columns storage.delete_documents needs
+columns = [
+    documents.c.pid,
+    documents.c.status,
+    documents.c.input,
+    documents.c.output,
+    documents.c.output_json,
+    documents.c.output_txt,
+    documents.c.content_key,
+]
+
+
+def disk_usage_percent() -> float:
+    usage = shutil.disk_usage(str(config.workdir))
+    return usage.used * 100 / usage.total
+
+
+async def reap_expired(now: Optional[datetime] = None) -> dict:
+    """
+    Delete expired documents, one batch of config.cleanup_batch_size at a
+    time. Documents still waiting for their OCR are left until it is done.
+    """
+    now = now or datetime.now()
+    report = {"documents": 0, "bytes": 0}
+    while True:
+        docs = await database.fetch_all(
+            select(columns)
+            .where((documents.c.expire < now) & documents.c.status.notin_(PENDING))
+            .order_by(documents.c.expire)
+            .limit(config.cleanup_batch_size)
+        )
+        if not docs:
+            return report
+        report["bytes"] += await storage.delete_documents(docs)
+        report["documents"] += len(docs)
+
+
+async def evict_least_recently_used() -> dict:
+    """
+    Delete the least recently downloaded documents until the disk holding
+    workdir is back under config.disk_low_water_percent
+    """
+    report = {"documents": 0, "bytes": 0}
+    while disk_usage_percent() > config.disk_low_water_percent:
+        docs = await database.fetch_all(
+            select(columns)
+            .where(documents.c.status.notin_(PENDING))
+            .order_by(func.coalesce(documents.c.accessed, documents.c.created))
+            .limit(config.cleanup_batch_size)
+        )
+        if not docs:
+            break
+        report["bytes"] += await storage.delete_documents(docs)
+        report["documents"] += len(docs)
+    return report
+
+
+async def run_cleanup() -> dict:
+    """
+    Reap the expired documents, then evict when the disk is over the high
+    water mark. What was reclaimed is logged and counted in the
+    ocr_cleanup_* metrics.
+    """
+    report = {"expired": await reap_expired(), "evicted": None}
+    metrics.cleanup_counted("expired", report["expired"])
+    if disk_usage_percent() > config.disk_high_water_percent:
+        report["evicted"] = await evict_least_recently_used()
+        metrics.cleanup_counted("evicted", report["evicted"])
+    report["finished"] = datetime.now()
+
+    logger.info("Cleanup finished: %s", report)
+    return report
@@ -1,19 +1,42 @@
 # api/database.py
-from sqlalchemy import create_engine, MetaData
+from datetime import datetime
+
+from sqlalchemy import MetaData
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from databases import Database
 from sqlalchemy import select, func
-from sqlalchemy import Column, String, DateTime
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, String, DateTime, Integer, LargeBinary
 from uuid import uuid4
 
-DATABASE_URL = "sqlite:///./test.db"
+from api.settings import config
+
+# "sqlite" or "postgresql"
+backend = make_url(config.database_url).get_backend_name()
+
+
+def local_time(moment: datetime) -> datetime:
+    """
+    A datetime read from the database as the naive local time the app
+    writes: PostgreSQL returns timestamptz values with a time zone.
+    """
+    if moment.tzinfo is None:
+        return moment
+    return moment.astimezone().replace(tzinfo=None)
+
+
+def connection_options() -> dict:
+    if backend == "sqlite":
+        # seconds a connection waits for another one's write lock
+        return {"timeout": config.sqlite_busy_timeout}
+    return {
+        "min_size": config.database_pool_min_size,
+        "max_size": config.database_pool_max_size,
+    }
 
-# Create a Database instance
-database = Database(DATABASE_URL)
 
-# Create the SQLAlchemy engine
-engine = create_engine(DATABASE_URL)
+# Create a Database instance
+database = Database(config.database_url, **connection_options())
 
 # Create a metadata object
 metadata = MetaData()
@@ -31,17 +54,83 @@ class DBDocument(Base):
     output = Column(String, nullable=False)
     output_json = Column(String, nullable=False)
     output_txt = Column(String, nullable=False)
+    output_docx = Column(String, nullable=True)
+    # no longer written, the OCR text lives in DBDocumentText
     text = Column(String, nullable=True)
-    created = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    created = Column(DateTime(timezone=True), server_default=func.now(), nullable=False, index=True)
     processing = Column(DateTime(timezone=True), nullable=True)
-    expire = Column(DateTime(timezone=True), nullable=False)
+    expire = Column(DateTime(timezone=True), nullable=False, index=True)
     finished = Column(DateTime(timezone=True), nullable=True)
     file_name = Column(String, nullable=True)
+    content_key = Column(String, nullable=True, index=True)
+    batch_id = Column(String, nullable=True, index=True)
+    code = Column(Integer, nullable=True)
+    result = Column(String, nullable=True)
+    callback_url = Column(String, nullable=True)
+    accessed = Column(DateTime(timezone=True), nullable=True)
+    # queue mode: the api.worker lease on the OCR job
+    priority = Column(String, nullable=True)
+    worker = Column(String, nullable=True)
+    lease_expire = Column(DateTime(timezone=True), nullable=True, index=True)
+    # for each page, "t" when its text came from the PDF, "o" when OCR'd
+    page_sources = Column(String, nullable=True)
+    profile = Column(String, nullable=True)
 
     def __repr__(self):
         return f"<Document(pid={self.pid}, status={self.status}, ...)>"
-    
-Base.metadata.create_all(bind=engine)
+
+
+# what Document.from_row reads, without the legacy text column
+document_columns = [column for column in DBDocument.__table__.c if column.name != "text"]
+
+
+class DBArtifact(Base):
+    """
+    OCR output shared by every document uploaded with the same content,
+    languages and OCR options. `leader` is the document whose job produces it.
+    """
+    __tablename__ = "artifacts"
+
+    key = Column(String, primary_key=True, nullable=False)
+    leader = Column(String, nullable=False)
+    status = Column(String, nullable=False)
+    output = Column(String, nullable=False)
+    output_txt = Column(String, nullable=False)
+    refcount = Column(Integer, nullable=False, default=1)
+    created = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+class DBDocumentText(Base):
+    """
+    OCR text, kept out of the documents table so listing queries never read
+    it. Keyed by the document's content_key (its pid for documents without
+    one), identical uploads share a row. The text itself is stored page by
+    page in DBDocumentPage, `data` only holds texts stored before that.
+    """
+    __tablename__ = "document_texts"
+
+    key = Column(String, primary_key=True, nullable=False)
+    encoding = Column(String, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+    size = Column(Integer, nullable=False)
+    pages = Column(Integer, nullable=True)
+
+
+class DBDocumentPage(Base):
+    """
+    One page of an OCR text, the text between two form feeds of the
+    sidecar, compressed as told by `encoding`. `start` is its offset in the
+    whole text, where pages are separated by form feeds.
+    """
+    __tablename__ = "document_pages"
+
+    key = Column(String, primary_key=True, nullable=False)
+    page = Column(Integer, primary_key=True, nullable=False)
+    start = Column(Integer, nullable=False)
+    size = Column(Integer, nullable=False)
+    encoding = Column(String, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+
 
 # This function will be used to connect to the database
 async def connect():
@@ -51,12 +140,19 @@ async def connect():
 async def disconnect():
     await database.disconnect()
 
+def transaction():
+    return database.transaction()
+
 async def execute(query):
     return await database.execute(query)
 
 async def fetch_all(query):
     return await database.fetch_all(query)
 
+async def iterate(query):
+    async for row in database.iterate(query):
+        yield row
+
 async def fetch_one(query):
     return await database.fetch_one(query)
     
@@ -0,0 +1,294 @@
+import io
+import logging
+import os
+import shlex
+import subprocess
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import ExitStack
+from pathlib import Path
+from typing import List, Optional
+
+from api import pool
+from api.settings import config
+from api.tools import special_win_wslpath
+
+try:
+    # pikepdf ships with ocrmypdf, without it large documents are OCR'd in one piece
+    import pikepdf
+except ImportError:
+    pikepdf = None
+
+try:
+    # pdfminer.six ships with ocrmypdf too, without it every page is OCR'd
+    from pdfminer.converter import TextConverter
+    from pdfminer.layout import LAParams
+    from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+    from pdfminer.pdfpage import PDFPage
+    from pdfminer.psparser import PSException
+except ImportError:
+    PDFPage = None
+
+logger = logging.getLogger("gunicorn.error")
+
+# page_sources letters: the text of the page came from the PDF or from OCR
+TEXT_LAYER = "t"
+OCR = "o"
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def split_workers() -> int:
+    return config.ocr_split_workers or os.cpu_count() or 1
+
+
+def executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=split_workers(), thread_name_prefix="ocr-chunk"
+        )
+    return _executor
+
+
+def shell_path(path: Path, wsl: bool = False) -> str:
+    return special_win_wslpath(path) if wsl else str(path.absolute())
+
+
+def run_ocrmypdf(
+    lang: str,
+    input_path: str,
+    output_path: str,
+    output_txt_path: str,
+    options: str = "",
+    base_options: Optional[str] = None,
+) -> bytes:
+    """
+    OCR in a warm pool process when ocrmypdf can be imported, else with the
+    command. Arguments are passed as a list, never through a shell.
+    """
+    base_options = config.base_command_option if base_options is None else base_options
+    if pool.available():
+        return pool.run(
+            lang, input_path, output_path, output_txt_path, f"{base_options} {options}"
+        )
+    return subprocess.check_output(
+        [
+            *shlex.split(config.base_command_ocr),
+            *shlex.split(base_options),
+            *shlex.split(options),
+            "-l",
+            lang,
+            "--sidecar",
+            output_txt_path,
+            input_path,
+            output_path,
+        ],
+        stderr=subprocess.STDOUT,
+    )
+
+
+def page_count(path: Path) -> Optional[int]:
+    if pikepdf is None:
+        return None
+    try:
+        with pikepdf.open(path) as pdf:
+            return len(pdf.pages)
+    except (pikepdf.PdfError, OSError):
+        return None
+
+
+def extract_text_layer(path: Path) -> Optional[List[str]]:
+    """
+    Text of each page from the PDF's own text layer, empty for pages
+    without one. None when it can't be read, then every page is OCR'd.
+    """
+    if PDFPage is None:
+        return None
+    pages = []
+    try:
+        with open(path, "rb") as pdf:
+            manager = PDFResourceManager()
+            for page in PDFPage.get_pages(pdf):
+                output = io.StringIO()
+                device = TextConverter(manager, output, laparams=LAParams())
+                PDFPageInterpreter(manager, device).process_page(page)
+                device.close()
+                pages.append(output.getvalue().replace("\f", ""))
+    except (PSException, OSError, ValueError, KeyError, TypeError) as e:
+        logger.warning("Could not read the text layer of %s: %s", path, e)
+        return None
+    return pages
+
+
+def page_sources(text_layer: List[str]) -> str:
+    """
+    Where the text of each page comes from: pages with at least
+    config.text_layer_min_chars characters of text are taken as they are,
+    the others are OCR'd.
+    """
+    return "".join(
+        TEXT_LAYER if len(page.strip()) >= config.text_layer_min_chars else OCR
+        for page in text_layer
+    )
+
+
+def profile_options(profile: Optional[str] = None) -> str:
+    """
+    ocrmypdf options of a models.Profile, config.default_profile by default
+    """
+    return {
+        "fast": config.base_command_option,
+        "balanced": config.profile_balanced_option,
+        "archival": config.profile_archival_option,
+    }[getattr(profile, "value", profile) or config.default_profile]
+
+
+def sparse_text(text_layer: List[str], sources: str) -> bool:
+    # pages to OCR having some text all the same, --skip-text would skip them
+    return any(
+        page.strip()
+        for page, source in zip(text_layer, sources)
+        if source == OCR
+    )
+
+
+def text_layer_options(options: str, redo: bool = False) -> str:
+    """
+    Options keeping the text of the pages having some: with --skip-text
+    ocrmypdf leaves those pages alone, with --redo-ocr (redo) it OCRs every
+    page without rasterizing the ones with text, which --skip-text would
+    leave out even with too little text to be taken as it is.
+    """
+    dropped = ["--force-ocr", "--redo-ocr", "--skip-text"]
+    if redo:
+        # ocrmypdf refuses them along with --redo-ocr
+        dropped += ["--deskew", "--clean-final", "--remove-background"]
+    kept = [option for option in options.split() if option not in dropped]
+    return " ".join(kept + ["--redo-ocr" if redo else "--skip-text"])
+
+
+def copies_output(options: str) -> bool:
+    """
+    Whether the input can stand for the output of options: neither PDF/A,
+    ocrmypdf's default output type, nor optimization, on by default
+    """
+    kwargs = pool.option_kwargs(options)
+    return kwargs.get("output_type", "pdfa") == "pdf" and not kwargs.get("optimize", 1)
+
+
+def write_sidecar(pages: List[str], output: Path):
+    # like the ocrmypdf one: pages separated by a form feed
+    output.write_text("\f".join(pages), encoding="utf-8")
+
+
+def merge_text_layer(
+    text_layer: List[str], sources: str, sidecar: Path
+):
+    """
+    Put the text layer of the pages taken from it in the sidecar, in place
+    of the placeholder ocrmypdf writes for the pages it skipped or the OCR
+    of them with --redo-ocr
+    """
+    ocr_pages = sidecar.read_text(encoding="utf-8").split("\f")
+    write_sidecar(
+        [
+            text_layer[index]
+            if source == TEXT_LAYER or index >= len(ocr_pages)
+            else ocr_pages[index]
+            for index, source in enumerate(sources)
+        ],
+        sidecar,
+    )
+
+
+def split_pdf(path: Path, directory: Path, chunk_pages: int) -> List[Path]:
+    parts = []
+    with pikepdf.open(path) as pdf:
+        for start in range(0, len(pdf.pages), chunk_pages):
+            part_path = directory / f"i_{start:06d}.pdf"
+            with pikepdf.new() as part:
+                part.pages.extend(pdf.pages[start:start + chunk_pages])
+                part.save(part_path)
+            parts.append(part_path)
+    return parts
+
+
+def merge_pdfs(parts: List[Path], output: Path):
+    with ExitStack() as stack:
+        merged = stack.enter_context(pikepdf.new())
+        for part_path in parts:
+            part = stack.enter_context(pikepdf.open(part_path))
+            merged.pages.extend(part.pages)
+        merged.save(output)
+
+
+def merge_sidecars(parts: List[Path], output: Path):
+    # ocrmypdf separates the pages of a sidecar with a form feed
+    with output.open("w", encoding="utf-8") as merged:
+        for index, part_path in enumerate(parts):
+            if index:
+                merged.write("\f")
+            merged.write(part_path.read_text(encoding="utf-8"))
+
+
+def run_ocrmypdf_split(
+    lang: str,
+    input_path: Path,
+    output_path: Path,
+    output_txt_path: Path,
+    wsl: bool = False,
+    base_options: Optional[str] = None,
+    cores: Optional[int] = None,
+) -> bytes:
+    """
+    OCR a large PDF as page ranges in parallel and stitch the output PDF and
+    sidecar text back together in page order. No more chunks run at once
+    than cores, all of the machine's by default, and they share them: the
+    executor is shared by every document, the next chunk is only submitted
+    when one is done.
+    """
+    cores = cores or os.cpu_count() or 1
+    concurrency = max(1, min(cores, split_workers()))
+    jobs = max(1, cores // concurrency)
+    with tempfile.TemporaryDirectory(dir=str(output_path.parent)) as tmp:
+        directory = Path(tmp)
+        inputs = split_pdf(input_path, directory, config.ocr_split_chunk_pages)
+        outputs = [part.with_name(f"o_{part.name[2:]}") for part in inputs]
+        sidecars = [part.with_suffix(".txt") for part in outputs]
+        chunks = list(zip(inputs, outputs, sidecars))
+
+        futures = {}
+
+        def submit(index: int):
+            part, output, sidecar = chunks[index]
+            future = executor().submit(
+                run_ocrmypdf,
+                lang,
+                shell_path(part, wsl),
+                shell_path(output, wsl),
+                shell_path(sidecar, wsl),
+                f"--jobs {jobs}",
+                base_options,
+            )
+            futures[future] = index
+
+        results: List[bytes] = [b""] * len(chunks)
+        submitted = min(concurrency, len(chunks))
+        for index in range(submitted):
+            submit(index)
+        try:
+            while futures:
+                done, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[futures.pop(future)] = future.result()
+                    if submitted < len(chunks):
+                        submit(submitted)
+                        submitted += 1
+        finally:
+            # let the running chunks finish before the temporary directory goes away
+            wait(list(futures))
+
+        merge_pdfs(outputs, output_path)
+        merge_sidecars(sidecars, output_txt_path)
+    return b"\n".join(results)
@@ -0,0 +1,105 @@
+"""
+In-process notifications of document status transitions. Subscribers are
+called on the event loop for every transition persisted to the database
+and must not block. Clients waiting on a document listen on a queue of
+its events, fanned out by publish().
+"""
+import asyncio
+import json
+import logging
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from fastapi.encoders import jsonable_encoder
+
+logger = logging.getLogger("gunicorn.error")
+
+FINAL = ("done", "error")
+
+subscribers: List[Callable[[dict], None]] = []
+listeners: Dict[str, Set[asyncio.Queue]] = {}
+
+
+def subscribe(callback: Callable[[dict], None]):
+    subscribers.append(callback)
+
+
+def unsubscribe(callback: Callable[[dict], None]):
+    if callback in subscribers:
+        subscribers.remove(callback)
+
+
+def publish(pid: str, status: str, **fields):
+    event = {"pid": str(pid), "status": status, "time": datetime.now(), **fields}
+    for queue in listeners.get(str(pid), ()):
+        queue.put_nowait(event)
+    for callback in list(subscribers):
+        try:
+            callback(event)
+        except Exception:
+            logger.exception("Event subscriber %r failed", callback)
+
+
+def listen(pid: str) -> asyncio.Queue:
+    queue = asyncio.Queue()
+    listeners.setdefault(str(pid), set()).add(queue)
+    return queue
+
+
+def stop_listening(pid: str, queue: asyncio.Queue):
+    queues = listeners.get(str(pid))
+    if queues is not None:
+        queues.discard(queue)
+        if not queues:
+            del listeners[str(pid)]
+
+
+async def wait_final(queue: asyncio.Queue, timeout: float) -> Optional[dict]:
+    """
+    Wait up to timeout seconds for the document to be done or failed
+    """
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return None
+        try:
+            event = await asyncio.wait_for(queue.get(), remaining)
+        except asyncio.TimeoutError:
+            return None
+        if event["status"] in FINAL:
+            return event
+
+
+def server_sent_event(event: dict) -> str:
+    return "event: status\ndata: {}\n\n".format(json.dumps(jsonable_encoder(event)))
+
+
+async def stream(
+    pid: str,
+    queue: asyncio.Queue,
+    current: Callable[[], Awaitable[Optional[dict]]],
+    keepalive: float,
+):
+    """
+    Server-sent events of a document's transitions, starting with its
+    current state and ending once it is done or failed. Each keepalive the
+    state is read again, for transitions made by another worker process.
+    """
+    try:
+        event = await current()
+        last = None
+        while event is not None:
+            if event["status"] != last:
+                yield server_sent_event(event)
+                last = event["status"]
+            if last in FINAL:
+                return
+            try:
+                event = await asyncio.wait_for(queue.get(), keepalive)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                event = await current()
+    finally:
+        stop_listening(pid, queue)
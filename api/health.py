@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import shlex
+import subprocess
+from typing import List, Optional
+
+from sqlalchemy import text
+
+from api import cleanup, database, jobs
+from api.models import Lang
+from api.settings import config
+
+logger = logging.getLogger("gunicorn.error")
+
+# detected once, the load balancer probes far too often to spawn processes
+versions: dict = {}
+
+UNAVAILABLE = "unavailable"
+
+
+def command_output(command: str, *args: str) -> str:
+    output = subprocess.check_output(
+        shlex.split(command) + list(args), stderr=subprocess.STDOUT
+    )
+    if isinstance(output, bytes):
+        output = output.decode("utf-8", "replace")
+    return output.strip()
+
+
+def ocrmypdf_version() -> str:
+    # failures are cached too, /status must not spawn a process per probe
+    if "ocrmypdf" not in versions:
+        try:
+            versions["ocrmypdf"] = command_output(config.base_command_ocr, "--version")
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning("Could not detect ocrmypdf: %s", e)
+            versions["ocrmypdf"] = UNAVAILABLE
+    return versions["ocrmypdf"]
+
+
+def tesseract_languages() -> List[str]:
+    # first line is "List of available languages (n):"
+    output = command_output(config.base_command_tesseract, "--list-langs")
+    return [line.strip() for line in output.splitlines()[1:] if line.strip()]
+
+
+def detect():
+    """
+    Detect the OCR tool versions and installed language packs
+    """
+    try:
+        ocrmypdf_version()
+        versions["tesseract"] = command_output(
+            config.base_command_tesseract, "--version"
+        ).splitlines()[0]
+        versions["languages"] = tesseract_languages()
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning("Could not detect the OCR tools: %s", e)
+
+
+async def database_ok(timeout: float = 2) -> Optional[str]:
+    try:
+        await asyncio.wait_for(database.fetch_one(text("SELECT 1")), timeout)
+    except Exception as e:
+        return repr(e)
+    return None
+
+
+async def readiness(scheduler) -> dict:
+    """
+    Whether this instance should get more work: the database answers, the
+    OCR queue is not saturated and workdir has room. In queue mode the
+    queue is the documents waiting in the database for a worker.
+    """
+    db_error = await database_ok()
+    queue = scheduler.stats()
+    if config.ocr_mode == "queue" and db_error is None:
+        # the documents table is the queue, worker processes run the jobs
+        try:
+            queue = await asyncio.wait_for(jobs.queue_stats(), 2)
+        except Exception as e:
+            db_error = repr(e)
+    depth = queue["depth"]
+    disk = cleanup.disk_usage_percent()
+    missing = [
+        lang.value
+        for lang in Lang
+        if "languages" in versions and lang.value not in versions["languages"]
+    ]
+    checks = {
+        "database": db_error is None,
+        "queue": depth < config.ready_max_queue_depth,
+        "disk": disk <= config.disk_high_water_percent,
+        "ocr": versions.get("ocrmypdf", UNAVAILABLE) != UNAVAILABLE and not missing,
+    }
+    return {
+        "ready": all(checks.values()),
+        "checks": checks,
+        "database_error": db_error,
+        "queue_depth": depth,
+        "active": queue["active"],
+        "disk_used_percent": round(disk, 1),
+        "versions": versions,
+        "missing_languages": missing,
+    }
@@ -0,0 +1,441 @@
+import asyncio
+import logging
+import math
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+from sqlalchemy import func, select
+from starlette.concurrency import run_in_threadpool
+
+from api import database, engine, events, metrics, search, storage
+from api.database import DBArtifact, DBDocument, document_columns
+from api.models import Document
+from api.scheduler import OCRScheduler, Priority
+from api.settings import config
+from api.tools import write_docx
+
+logger = logging.getLogger("gunicorn.error")
+
+documents = DBDocument.__table__
+artifacts = DBArtifact.__table__
+
+PENDING = ["received", "processing"]
+# rows per multi-row INSERT, keeps the bound parameters under SQLite's limit
+INSERT_CHUNK = 50
+
+
+def cpu_budget() -> int:
+    return config.cpu_budget or os.cpu_count() or 1
+
+
+def core_demand(document: Document) -> int:
+    """
+    Cores an OCR job can use: one per config.pages_per_core pages, at most
+    config.max_job_cores so a large document leaves room for small ones
+    """
+    most = config.max_job_cores or max(1, cpu_budget() // 2)
+    wanted = math.ceil((document.pages or 1) / max(config.pages_per_core, 1))
+    return max(1, min(wanted, most))
+
+
+scheduler = OCRScheduler(
+    on_wait=metrics.observe_queue_wait, cores=cpu_budget(), demand=core_demand
+)
+metrics.track_scheduler(scheduler)
+workers: List[asyncio.Task] = []
+
+
+async def enqueue(document: Document, key: str = "", priority: Priority = Priority.bulk):
+    # the page count sizes the job's share of the cores
+    document.pages = await run_in_threadpool(engine.page_count, document.input)
+    scheduler.submit(document, key, priority)
+
+
+def default_priority(document: Document) -> Priority:
+    if document.input.stat().st_size <= config.interactive_max_size:
+        return Priority.interactive
+    return Priority.bulk
+
+
+def document_values(document: Document, priority: Optional[Priority] = None) -> dict:
+    return dict(
+        pid=str(document.pid),
+        lang=",".join(lang.value for lang in document.lang),
+        status=document.status,
+        input=str(document.input.resolve()),
+        output=str(document.output.resolve()),
+        output_json=str(document.output_json.resolve()),
+        output_txt=str(document.output_txt.resolve()),
+        created=document.created,
+        expire=document.expire,
+        file_name=document.file_name,
+        content_key=document.content_key,
+        batch_id=str(document.batch_id) if document.batch_id else None,
+        callback_url=document.callback_url,
+        priority=priority.value if priority else None,
+        profile=document.profile.value if document.profile else None,
+    )
+
+
+async def submit(
+    new_documents: List[Document], key: str = "", priority: Optional[Priority] = None
+):
+    """
+    Insert the rows of newly uploaded documents and queue their OCR jobs.
+    Identical uploads share one OCR run, only the first one is queued. In
+    queue mode the rows are the queue, api.worker processes claim them.
+    """
+    priorities = {
+        document.pid: priority or default_priority(document) for document in new_documents
+    }
+    with metrics.stage_seconds.labels("db_insert").time():
+        async with database.transaction():
+            for start in range(0, len(new_documents), INSERT_CHUNK):
+                chunk = new_documents[start:start + INSERT_CHUNK]
+                await database.execute(
+                    documents.insert().values(
+                        [document_values(doc, priorities[doc.pid]) for doc in chunk]
+                    )
+                )
+    for document in new_documents:
+        metrics.document_counted("received", document.lang)
+        events.publish(document.pid, document.status)
+
+    shared = await storage.acquire_artifacts(new_documents)
+    for document in new_documents:
+        artifact = shared.get(document.content_key)
+        if artifact is None:
+            # the run it joined failed meanwhile and took the document with it
+            document.status = "error"
+        elif artifact["leader"] == str(document.pid):
+            if config.ocr_mode == "local":
+                await enqueue(document, key, priorities[document.pid])
+        elif artifact["status"] == "done":
+            await reuse_artifact(document)
+
+
+# DBDocument columns sent along with status events
+EVENT_FIELDS = ("code", "result", "processing", "finished")
+
+
+def publish(pid: str, values: dict):
+    events.publish(
+        pid,
+        values["status"],
+        **{name: values[name] for name in EVENT_FIELDS if name in values},
+    )
+
+
+async def leased(pid: str, token: Optional[str]) -> bool:
+    """
+    Whether the job of a queue mode worker is still leased to it, under the
+    token of its claim. Always true for local jobs, which have none.
+    """
+    if token is None:
+        return True
+    row = await database.fetch_one(
+        select([documents.c.pid])
+        .where((documents.c.pid == pid) & (documents.c.worker == token))
+        .with_for_update()
+    )
+    return row is not None
+
+
+async def update_status(pid: str, token: Optional[str] = None, **values) -> bool:
+    """
+    Update the document's row and publish its new status. With the token
+    of a worker's claim the row is only updated while the job is leased to
+    it: False when another worker took it over.
+    """
+    update = documents.update().where(documents.c.pid == pid).values(**values)
+    if token is None:
+        await database.execute(update)
+    else:
+        # execute does not tell how many rows were updated, the row is
+        # locked and checked first
+        async with database.transaction():
+            if not await leased(pid, token):
+                return False
+            await database.execute(update.where(documents.c.worker == token))
+    if "status" in values:
+        publish(pid, values)
+    return True
+
+
+def read_text(document: Document) -> Optional[str]:
+    if document.status != "done" or not document.output_txt.exists():
+        return None
+    return document.output_txt.read_text(encoding="utf-8")
+
+
+async def export_docx(document: Document, text: Optional[str]) -> Optional[str]:
+    if not config.docx_on_finish or document.status != "done" or text is None:
+        return None
+    path = storage.docx_path(document.output_txt)
+    await run_in_threadpool(write_docx, text, path)
+    return str(path.resolve())
+
+
+async def discard_files(sidecar: Optional[Path], inputs: List[str]):
+    """
+    Remove files not needed once the OCR text is stored: the sidecar, and
+    the uploaded PDFs unless config.keep_input.
+    """
+    paths = [sidecar] if sidecar else []
+    if not config.keep_input:
+        paths += inputs
+    await run_in_threadpool(storage.delete_files, *paths)
+
+
+async def finish_shared(
+    document: Document,
+    text: Optional[str],
+    output_docx: Optional[str] = None,
+    token: Optional[str] = None,
+):
+    """
+    Record the outcome of an OCR job on every document waiting for the same
+    artifact, including the one that ran it unless another worker took it
+    over from token.
+    """
+    key = document.content_key
+    if document.status == "done":
+        published = await storage.publish_artifact(key)
+    else:
+        # nothing to share, the next identical upload runs OCR again
+        await storage.drop_artifact(key)
+        published = False
+
+    waiting = (documents.c.content_key == key) & documents.c.status.in_(PENDING)
+    if token is not None:
+        # the documents waiting on the job are never claimed themselves
+        waiting &= documents.c.worker.is_(None) | (documents.c.worker == token)
+    rows = await database.fetch_all(
+        select([documents.c.pid, documents.c.input, documents.c.lang]).where(waiting)
+    )
+    stored = text is not None and published
+    if stored:
+        await storage.save_text(key, text)
+        await search.index_document(key, text)
+
+    values = dict(
+        status=document.status if published else "error",
+        code=document.code,
+        result=document.result,
+        processing=document.processing,
+        finished=document.finished,
+        page_sources=document.page_sources,
+    )
+    await database.execute(
+        documents.update()
+        .where(waiting)
+        .values(
+            output_docx=output_docx if published else None,
+            content_key=key if published else None,
+            **values,
+        )
+    )
+    if not published:
+        # the artifact paths are the next identical upload's to use
+        for row in rows:
+            output, output_txt = storage.document_paths(row["pid"])
+            await database.execute(
+                documents.update()
+                .where(documents.c.pid == row["pid"])
+                .values(output=str(output), output_txt=str(output_txt))
+            )
+    for row in rows:
+        metrics.document_counted(values["status"], row["lang"].split(","))
+        publish(row["pid"], values)
+    if stored:
+        await discard_files(document.output_txt, [row["input"] for row in rows])
+
+
+async def reuse_artifact(document: Document):
+    """
+    Complete a document from the already OCR'd output of an identical upload,
+    whose text is already indexed under the same key.
+    """
+    pid = str(document.pid)
+    document.status = "done"
+    document.code = 0
+    document.finished = datetime.now()
+    await update_status(pid, status="done", code=0, finished=document.finished)
+    metrics.document_counted("done", document.lang)
+    await discard_files(None, [str(document.input)])
+    await run_in_threadpool(document.write_state)
+
+
+async def document_exists(pid: str) -> bool:
+    row = await database.fetch_one(select([documents.c.pid]).where(documents.c.pid == pid))
+    return row is not None
+
+
+async def current_job(document: Document) -> Optional[Document]:
+    """
+    The document a queued job has to OCR: itself, or when it was deleted
+    since it was queued the upload its artifact was handed over to. None
+    when there is nothing left to do.
+    """
+    if await document_exists(str(document.pid)):
+        return document
+    artifact = await storage.get_artifact(document.content_key) if document.content_key else None
+    if artifact is None or artifact["status"] != "processing":
+        return None
+    row = await database.fetch_one(
+        select(document_columns).where(
+            (documents.c.pid == artifact["leader"]) & documents.c.status.in_(PENDING)
+        )
+    )
+    if row is None:
+        return None
+    successor = Document.from_row(row)
+    successor.pages = document.pages
+    successor.cpu_jobs = document.cpu_jobs
+    return successor
+
+
+async def run_job(document: Document, token: Optional[str] = None):
+    """
+    OCR a document and record the outcome. Queue mode workers pass the
+    token of their claim: once their lease was taken over by another
+    worker, the outcome is that worker's to record.
+    """
+    pid = str(document.pid)
+    document.status = "processing"
+    document.processing = datetime.now()
+    if not await update_status(
+        pid, token, status="processing", processing=document.processing
+    ):
+        logger.warning("OCR job %s was taken over by another worker", pid)
+        return
+
+    # Document.ocr blocks on the ocrmypdf subprocess, keep it off the event loop
+    await run_in_threadpool(document.ocr, config.enable_wsl_compat)
+    if not await document_exists(pid):
+        # deleted meanwhile, storage.delete_documents left the input to the job
+        await run_in_threadpool(storage.delete_files, document.input)
+        if not document.content_key:
+            await run_in_threadpool(storage.delete_files, document.output, document.output_txt)
+            return
+    text = await run_in_threadpool(read_text, document)
+    output_docx = await export_docx(document, text)
+    if not await leased(pid, token):
+        logger.warning("OCR job %s was taken over by another worker, dropping its result", pid)
+        return
+    if document.content_key:
+        # identical uploads still waiting get the output all the same
+        await finish_shared(document, text, output_docx, token)
+        return
+
+    if text is not None:
+        await storage.save_text(pid, text)
+        await search.index_document(pid, text)
+
+    if not await update_status(
+        pid,
+        token,
+        status=document.status,
+        code=document.code,
+        result=document.result,
+        processing=document.processing,
+        finished=document.finished,
+        output_docx=output_docx,
+        page_sources=document.page_sources,
+    ):
+        logger.warning("OCR job %s was taken over by another worker, dropping its result", pid)
+        return
+    metrics.document_counted(document.status, document.lang)
+    if text is not None:
+        await discard_files(document.output_txt, [str(document.input)])
+
+
+async def fail_job(document: Document, error: Exception, token: Optional[str] = None):
+    logger.error("OCR job %s failed", document.pid, exc_info=error)
+    document.status = "error"
+    document.result = f"{type(error).__name__}: {error}"
+    document.finished = datetime.now()
+    pid = str(document.pid)
+    if not await leased(pid, token):
+        logger.warning("OCR job %s was taken over by another worker", pid)
+    elif document.content_key:
+        await finish_shared(document, None, token=token)
+    elif await update_status(
+        pid, token, status="error", result=document.result, finished=document.finished
+    ):
+        metrics.document_counted("error", document.lang)
+
+
+async def worker():
+    while True:
+        document = await scheduler.next_job()
+        document.cpu_jobs = scheduler.grant(document)
+        job: Optional[Document] = document
+        try:
+            job = await current_job(document)
+            if job is not None:
+                await run_job(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            try:
+                await fail_job(job, e)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # the worker must outlive it, nothing would start another one
+                logger.exception("Could not record the failure of OCR job %s", job.pid)
+        finally:
+            scheduler.job_done(document)
+
+
+def is_job():
+    # documents waiting on another upload's artifact are not jobs themselves
+    return documents.c.content_key.is_(None) | documents.c.pid.in_(
+        select([artifacts.c.leader])
+    )
+
+
+async def queue_stats() -> dict:
+    """
+    Queue mode: the jobs waiting in the database for a worker by priority,
+    and the ones workers are running
+    """
+    rows = await database.fetch_all(
+        select([documents.c.status, documents.c.priority, func.count().label("count")])
+        .where(documents.c.status.in_(PENDING) & is_job())
+        .group_by(documents.c.status, documents.c.priority)
+    )
+    depth_by_priority = {priority.value: 0 for priority in Priority}
+    active = 0
+    for row in rows:
+        if row["status"] == "received":
+            depth_by_priority[row["priority"] or Priority.bulk.value] += row["count"]
+        else:
+            active += row["count"]
+    return {
+        "depth": sum(depth_by_priority.values()),
+        "depth_by_priority": depth_by_priority,
+        "active": active,
+    }
+
+
+async def start_workers():
+    for _ in range(config.max_ocr_process):
+        workers.append(asyncio.ensure_future(worker()))
+
+    # Jobs interrupted by a restart are still pending in the database
+    pending = await database.fetch_all(
+        select(document_columns).where(documents.c.status.in_(PENDING) & is_job())
+    )
+    for row in pending:
+        await enqueue(Document.from_row(row))
+
+
+async def stop_workers():
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    workers.clear()
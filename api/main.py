@@ -1,18 +1,20 @@
-from io import BytesIO
+import asyncio
 import logging
 import os
 import secrets
-import subprocess
 import uuid
 from datetime import datetime, timedelta
 from pathlib import Path
-from threading import BoundedSemaphore
-from typing import Optional, Dict, Set, Union
+from collections import Counter
+from typing import Optional, Dict, Set, Tuple
 from uuid import UUID
 from fastapi.params import Form
 from fastapi.responses import FileResponse, StreamingResponse
-from docx import Document as DocxDocument
-from api.database import connect, disconnect, Base, execute
+from pydantic import AnyHttpUrl
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from sqlalchemy import select, tuple_
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 from api.database import connect, disconnect, Base, execute
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from fastapi import (
@@ -25,13 +27,27 @@ from fastapi import (
     Security,
     Response,
     Query,
+    Request,
 )
 from fastapi.openapi.models import APIKey
 from fastapi.responses import FileResponse, JSONResponse
 from fastapi.security import APIKeyHeader
 from starlette.status import HTTP_403_FORBIDDEN
-from api import database
-from api.models import Document, Lang
+from api import (
+    cleanup,
+    database,
+    engine,
+    events,
+    health,
+    jobs,
+    migrations,
+    pool,
+    search,
+    storage,
+    webhooks,
+)
+from api.models import Document, Lang, Profile
+from api.scheduler import Priority
 
 from fastapi import Query
 
@@ -39,8 +55,20 @@ from typing import List
 
 
 from api.settings import config
-from api.database import DBDocument
-from api.tools import save_upload_file
+from api.database import DBDocument, document_columns
+from api.tools import (
+    ZIP_HEADER,
+    RequestSizeLimit,
+    extract_pdfs,
+    file_response,
+    is_zip,
+    remove_files,
+    save_upload_file,
+    text_response,
+    write_docx,
+    write_results_zip,
+)
+from api.text import parse_page_range, split_pages
 
 logger = logging.getLogger("gunicorn.error")
 
@@ -50,41 +78,37 @@ app = FastAPI(
     version="0.0.3",
     redoc_url=None,
 )
+app.add_middleware(
+    RequestSizeLimit,
+    max_size=config.max_request_size,
+    overrides={"/ocr/batch": config.max_batch_request_size},
+)
 Schedule = AsyncIOScheduler({"apscheduler.timezone": "UTC"})
 Schedule.start()
 
-pool_ocr = BoundedSemaphore(value=config.max_ocr_process)
-
 document: Document
 workdir = config.workdir
 
+DOCX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
 script_directory = Path(os.path.dirname(os.path.abspath(__file__))).resolve()
 expiration_delta = timedelta(hours=config.document_expire_hour)
 
 
-def delete_data(doc: DBDocument):
-    output_path = Path(doc.output)
-    output_json_path = Path(doc.output_json)
-    output_txt_path = Path(doc.output_txt)
-    input_path = Path(doc.input)
-    if output_path.exists():
-        output_path.unlink()
-    if output_json_path.exists():
-        output_json_path.unlink()
-    if output_txt_path.exists():
-        output_txt_path.unlink()
-    if input_path.exists():
-        input_path.unlink()
-
-
 if not workdir.exists():
     workdir.mkdir()
 
 
-async def do_ocr(_doc: Document):
-    pool_ocr.acquire()
-    _doc.ocr(config.enable_wsl_compat)
-    pool_ocr.release()
+async def touch(doc):
+    # last download time drives LRU eviction, a minute of precision is enough
+    now = datetime.now()
+    accessed = doc["accessed"]
+    if accessed is None or now - database.local_time(accessed) > timedelta(minutes=1):
+        await database.execute(
+            DBDocument.__table__.update()
+            .where(DBDocument.__table__.c.pid == doc["pid"])
+            .values(accessed=now)
+        )
 
 
 def get_db():
@@ -94,11 +118,30 @@ def get_db():
 
 @app.on_event("startup")
 async def startup_db_client():
+    await run_in_threadpool(migrations.migrate)
     await database.connect()
+    await run_in_threadpool(health.detect)
+    if config.ocr_mode == "local":
+        await run_in_threadpool(pool.start)
+        await jobs.start_workers()
+    webhooks.start()
+    Schedule.add_job(
+        cleanup.run_cleanup,
+        "interval",
+        minutes=config.cleanup_interval_minutes,
+        id="cleanup",
+        replace_existing=True,
+        coalesce=True,
+        max_instances=1,
+    )
 
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    Schedule.remove_job("cleanup")
+    await jobs.stop_workers()
+    await run_in_threadpool(pool.stop)
+    await webhooks.stop()
     await database.disconnect()
 
 api_key_header = APIKeyHeader(name="X-API-KEY")
@@ -106,7 +149,7 @@ api_key_header = APIKeyHeader(name="X-API-KEY")
 
 async def check_api_key(x_api_key: str = Security(api_key_header)):
     if secrets.compare_digest(x_api_key, config.api_key_secret):
-        return api_key_header
+        return x_api_key
     else:
         raise HTTPException(
             status_code=HTTP_403_FORBIDDEN, detail="Could not validate credentials"
@@ -115,211 +158,572 @@ async def check_api_key(x_api_key: str = Security(api_key_header)):
 
 @app.get("/status", include_in_schema=False)
 def status():
-    ocrmypdf = subprocess.check_output(
-        f"{config.base_command_ocr} --version", shell=True
+    return {"status": "ok", "version_ocr": health.ocrmypdf_version()}
+
+
+@app.get("/status/live", include_in_schema=False)
+def status_live():
+    return {"status": "ok"}
+
+
+@app.get("/status/ready", include_in_schema=False)
+async def status_ready():
+    report = await health.readiness(jobs.scheduler)
+    return JSONResponse(report, status_code=200 if report["ready"] else 503)
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics_endpoint():
+    return Response(generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+@app.get("/status/queue", include_in_schema=False)
+async def status_queue():
+    if config.ocr_mode == "queue":
+        return await jobs.queue_stats()
+    return jobs.scheduler.stats()
+
+
+@app.get("/ocr/{pid}", response_model=Document)
+async def get_doc(
+    pid: UUID,
+    wait: int = Query(0, ge=0, le=config.max_wait_seconds),
+    api_key: APIKey = Depends(check_api_key),
+):
+    """
+    With wait, a document still being processed is returned once it is done
+    or failed, or after wait seconds.
+    """
+    query = select(document_columns).where(
+        DBDocument.__table__.c.pid == str(pid))
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + wait
+    # in queue mode the jobs run in worker processes publishing nothing here,
+    # the row is read again every poll
+    poll = config.worker_poll_seconds if config.ocr_mode == "queue" else wait
+    # listening before reading so no transition falls in between
+    queue = events.listen(pid)
+    try:
+        doc = await database.fetch_one(query)
+        while doc and doc["status"] not in events.FINAL:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            await events.wait_final(queue, min(poll, remaining))
+            doc = await database.fetch_one(query)
+    finally:
+        events.stop_listening(pid, queue)
+
+    if doc:
+        return Document.from_row(doc)
+
+    raise HTTPException(status_code=404, detail="Document not found")
+
+
+@app.get("/ocr/{pid}/events")
+async def get_doc_events(pid: UUID, api_key: APIKey = Depends(check_api_key)):
+    """
+    Server-sent events stream of the document's status transitions
+    """
+    documents = DBDocument.__table__
+
+    async def current() -> Optional[dict]:
+        row = await database.fetch_one(
+            select(
+                [
+                    documents.c.pid,
+                    documents.c.status,
+                    documents.c.code,
+                    documents.c.result,
+                    documents.c.processing,
+                    documents.c.finished,
+                ]
+            ).where(documents.c.pid == str(pid))
+        )
+        return dict(row) if row else None
+
+    queue = events.listen(pid)
+    if await current() is None:
+        events.stop_listening(pid, queue)
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    return StreamingResponse(
+        events.stream(pid, queue, current, config.events_keepalive_seconds),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
-    return {"status": "ok", "version_ocr": ocrmypdf.strip()}
 
 
 @app.get("/ocr/{pid}/pdf")
-async def get_doc_pdf(pid: UUID, api_key: APIKey = Depends(check_api_key)):
-    query = DBDocument.__table__.select().where(
+async def get_doc_pdf(
+    pid: UUID, request: Request, api_key: APIKey = Depends(check_api_key)
+):
+    query = select(document_columns).where(
         DBDocument.__table__.c.pid == str(pid))
     doc = await database.fetch_one(query)
 
     if doc:
-        path = Path(doc.output)
+        await touch(doc)
+        path = Path(doc["output"])
 
-        if path.resolve().exists():
-            return FileResponse(
-                str(doc.output),
-                headers={"Content-Type": "application/pdf"},
-                filename=f"{pid}.pdf",
-            )
+        if path.exists():
+            return file_response(request, path, "application/pdf", f"{pid}.pdf")
 
     raise HTTPException(status_code=404, detail="Document not found")
 
 
+async def page_range_response(request: Request, doc, pages: str) -> Response:
+    """
+    Serve pages of the document's text, reading only the stored rows of
+    those pages, separated by form feeds like in the full text.
+    """
+    try:
+        first, last = parse_page_range(pages)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    key = storage.text_key(doc)
+    count = await storage.page_count_of(key)
+    split = None
+    if count is None:
+        # OCR'd before texts were stored, only the sidecar file has it
+        content = await storage.load_document_text(doc)
+        if content is None:
+            raise HTTPException(status_code=404, detail="Document not found")
+        split = split_pages(content)
+        count = len(split)
+    if first > count:
+        raise HTTPException(
+            status_code=416, detail=f"The document has {count} pages"
+        )
+
+    last = min(last or count, count)
+    if split is None:
+        selected = await storage.load_pages(key, first, last)
+    else:
+        selected = [page for _, page in split[first - 1:last]]
+
+    response = text_response(
+        request,
+        "\f".join(selected),
+        f"{key}-{first}-{last}",
+        f"{doc['pid']}-{first}-{last}.txt",
+    )
+    response.headers["X-Page-Count"] = str(count)
+    return response
+
+
 @app.get("/ocr/{pid}/txt")
-async def get_doc_txt(pid: UUID, api_key: APIKey = Depends(check_api_key)):
-    query = DBDocument.__table__.select().where(
+async def get_doc_txt(
+    pid: UUID,
+    request: Request,
+    pages: Optional[str] = Query(None, regex=r"^\d+(-\d*)?$"),
+    api_key: APIKey = Depends(check_api_key),
+):
+    """
+    The OCR text, pages separated by form feeds. With pages (`3`, `10-20`
+    or `10-`) only those pages are returned.
+    """
+    query = select(document_columns).where(
         DBDocument.__table__.c.pid == str(pid))
     doc = await database.fetch_one(query)
 
     if doc:
-        path = Path(doc.output_txt)
-
-        if path.resolve().exists():
-            return FileResponse(
-                str(doc.output_txt),
-                headers={"Content-Type": "text/plain"},
-                filename=f"{pid}.txt",
+        await touch(doc)
+        if pages:
+            return await page_range_response(request, doc, pages)
+        content = await storage.load_document_text(doc)
+
+        if content is not None:
+            return text_response(
+                request, content, storage.text_key(doc), f"{pid}.txt"
             )
 
     raise HTTPException(status_code=404, detail="Document not found")
 
 
-@app.get("/ocr/{pid}/docx")
-async def get_doc_docx(pid: UUID, api_key: APIKey = Depends(check_api_key)):
-    query = DBDocument.__table__.select().where(
+@app.get("/ocr/{pid}/pages")
+async def get_doc_pages(pid: UUID, api_key: APIKey = Depends(check_api_key)):
+    """
+    Number of pages of the OCR text with the offset and length of each page
+    in it
+    """
+    query = select(document_columns).where(
         DBDocument.__table__.c.pid == str(pid))
     doc = await database.fetch_one(query)
 
     if doc:
-        path = Path(doc.output_txt)
+        key = storage.text_key(doc)
+        count = await storage.page_count_of(key)
+        if count is not None:
+            return {"pages": count, "offsets": await storage.page_offsets(key, count)}
 
-        if path.resolve().exists():
-            doc = DocxDocument()
-            with open(str(path.resolve()), 'r', encoding='utf-8') as txt_file:
-                for line in txt_file:
-                    doc.add_paragraph(line.strip())
+    raise HTTPException(status_code=404, detail="Document not found")
 
-            docx_content = BytesIO()
-            doc.save(docx_content)
 
-            docx_content.seek(0)
+@app.get("/ocr/{pid}/docx")
+async def get_doc_docx(
+    pid: UUID, request: Request, api_key: APIKey = Depends(check_api_key)
+):
+    query = select(document_columns).where(
+        DBDocument.__table__.c.pid == str(pid))
+    doc = await database.fetch_one(query)
 
-            return StreamingResponse(
-                content=docx_content,
-                media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                headers={
-                    "Content-Disposition": f"attachment; filename={pid}.docx"},
-            )
+    if doc:
+        await touch(doc)
+        path = Path(doc["output_docx"] or storage.docx_path(doc["output_txt"]))
+
+        # built once from the OCR text on first download, then served from disk
+        if not path.exists():
+            content = await storage.load_document_text(doc)
+            if content is not None:
+                await run_in_threadpool(write_docx, content, path)
+        if path.exists():
+            if doc["output_docx"] is None:
+                await database.execute(
+                    DBDocument.__table__.update()
+                    .where(DBDocument.__table__.c.pid == str(pid))
+                    .values(output_docx=str(path))
+                )
+            return file_response(request, path, DOCX_MEDIA_TYPE, f"{pid}.docx")
 
     raise HTTPException(status_code=404)
 
 
-# @app.get("/search", response_model=list)
-# async def search_files(queries: List[str] = Query(..., title="Search Queries"), api_key: APIKey = Depends(check_api_key)):
-#     docs = await database.fetch_all(DBDocument.__table__.select())
-#     matching_pdfs = []
-
-#     for doc in docs:
-#         path = Path(doc.output_txt)
-#         if path.exists():
-#             with open(str(doc.output_txt), 'r', encoding='utf-8') as txt_file:
-#                 txt_content = txt_file.read()
-
-#                 if all(query.lower() in txt_content.lower() for query in queries):
-#                     matching_pdfs.append({"pid": str(doc.pid), "file_name": f"{doc.file_name}.pdf"})
-
-#     return matching_pdfs
-
-
-def parse_search_query(query: str) -> List[Union[List[str], str]]:
-    result = []
-    groups = query.split("||")
-    for group in groups:
-        and_conditions = group.split("&&")
-        if len(and_conditions) > 1:
-            result.append(and_conditions)
-        else:
-            result.append([group])
-    return result
+@app.get("/ocr/{pid}/storage")
+async def get_doc_storage(pid: UUID, api_key: APIKey = Depends(check_api_key)):
+    query = select(document_columns).where(
+        DBDocument.__table__.c.pid == str(pid))
+    doc = await database.fetch_one(query)
 
+    if doc:
+        return await storage.footprint(doc)
 
-def evaluate_condition(condition: List[str], txt_content: str) -> bool:
-    return all(query.strip().lower() in txt_content.lower() for query in condition)
+    raise HTTPException(status_code=404, detail="Document not found")
 
 
 @app.get("/search", response_model=list)
 async def search_files(
+    response: Response,
     search_query: str = Query(..., title="Search Query"),
+    limit: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = Query(None),
+    snippets: bool = Query(False),
+    stream: bool = Query(False),
+    ignore_accents: bool = Query(False),
+    pages: bool = Query(False),
     api_key: APIKey = Depends(check_api_key)
 ):
-    docs = await database.fetch_all(DBDocument.__table__.select())
-    matching_pdfs = []
-
-    parsed_query = parse_search_query(search_query)
-
-    for doc in docs:
-        path = Path(doc.output_txt)
-        if path.exists():
-            with open(str(doc.output_txt), 'r', encoding='utf-8') as txt_file:
-                txt_content = txt_file.read()
-
-                # Evaluate each group in the parsed query
-                if any(evaluate_condition(group, txt_content) for group in parsed_query):
-                    matching_pdfs.append(
-                        {"pid": str(doc.pid), "file_name": f"{doc.file_name}.pdf"})
+    """
+    With pages, each result lists the numbers of its pages holding a match
+    of the query.
+    """
+    try:
+        if cursor:
+            search.decode_cursor(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if stream:
+        return StreamingResponse(
+            search.stream_search(
+                search_query, limit, cursor, snippets, ignore_accents, pages
+            ),
+            media_type="application/x-ndjson",
+        )
 
-    return matching_pdfs
+    limit = min(limit or config.search_page_size, config.search_max_page_size)
+    results, next_cursor = await search.search(
+        search_query, limit, cursor, snippets, ignore_accents, pages
+    )
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return results
 
 
 @app.delete("/ocr/{pid}")
 async def delete_doc(pid: UUID, api_key: APIKey = Depends(check_api_key)):
-    query = DBDocument.__table__.select().where(
+    query = select(document_columns).where(
         DBDocument.__table__.c.pid == str(pid))
     doc = await database.fetch_one(query)
     if doc:
-        delete_data(doc)
-        await database.execute(DBDocument.__table__.delete().where(DBDocument.__table__.c.pid == str(pid)))
+        await storage.delete_documents([doc])
         return Response(status_code=204, headers={"X-Status": "Deleted"})
     raise HTTPException(status_code=404, detail="Document not found")
 
 
-@app.get("/documents", response_model=list)
-async def get_documents(api_key: APIKey = Depends(check_api_key)):
-    documents = await database.fetch_all(DBDocument.__table__.select())
-    result = [{"pid": doc.pid, "file_name": doc.file_name, "lang": doc.lang}
-              for doc in documents]
-    return result
+def encode_documents_cursor(created: datetime, pid: str) -> str:
+    return search.encode_cursor(created.timestamp(), pid)
 
 
-@app.post(
-    "/ocr", response_model=Document, status_code=200,
-)
-async def ocr(
-    background_tasks: BackgroundTasks,
-    lang: Optional[Set[str]] = Query([Lang.eng]),
-    file: UploadFile = File(...),
+@app.get("/documents", response_model=list)
+async def get_documents(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = Query(None),
+    status: Optional[str] = Query(None),
+    lang: Optional[Set[Lang]] = Query(None),
+    created_after: Optional[datetime] = Query(None),
+    created_before: Optional[datetime] = Query(None),
     api_key: APIKey = Depends(check_api_key),
-    file_name: Optional[str] = Query(None),
-
 ):
-    pid = uuid.uuid4()
-    now = datetime.now()
-    expire = now + expiration_delta
-    filename = f"{pid}"
+    """
+    List documents, most recent first. Pass the X-Next-Cursor response
+    header back as cursor to get the next page.
+    """
+    documents = DBDocument.__table__
+    query = select(
+        [
+            documents.c.pid,
+            documents.c.file_name,
+            documents.c.lang,
+            documents.c.status,
+            documents.c.created,
+        ]
+    )
+    if cursor:
+        try:
+            timestamp, pid = search.decode_cursor(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        query = query.where(
+            tuple_(documents.c.created, documents.c.pid)
+            < tuple_(datetime.fromtimestamp(timestamp), pid)
+        )
+    if status:
+        query = query.where(documents.c.status == status)
+    for code in lang or []:
+        # lang holds comma separated codes
+        query = query.where(
+            ("," + documents.c.lang + ",").like(f"%,{code.value},%")
+        )
+    if created_after:
+        query = query.where(documents.c.created >= created_after)
+    if created_before:
+        query = query.where(documents.c.created < created_before)
+
+    limit = min(limit or config.search_page_size, config.search_max_page_size)
+    rows = await database.fetch_all(
+        query.order_by(documents.c.created.desc(), documents.c.pid.desc()).limit(limit)
+    )
+    if len(rows) == limit:
+        response.headers["X-Next-Cursor"] = encode_documents_cursor(
+            rows[-1]["created"], rows[-1]["pid"]
+        )
+    return [
+        {
+            "pid": row["pid"],
+            "file_name": row["file_name"],
+            "lang": row["lang"],
+            "status": row["status"],
+            "created": row["created"],
+        }
+        for row in rows
+    ]
 
-    input_file = workdir / Path(f"i_{filename}.pdf")
-    save_upload_file(file, input_file)
-    output_file = workdir / Path(f"o_{filename}.pdf")
-    output_file_json = workdir / Path(f"o_{filename}.json")
-    output_file_txt = workdir / Path(f"o_{filename}.txt")
 
-    document = Document(
+def input_path(pid: UUID) -> Path:
+    return storage.shard_path(pid.hex, f"i_{pid}.pdf")
+
+
+def new_input() -> Tuple[UUID, Path]:
+    pid = uuid.uuid4()
+    return pid, input_path(pid)
+
+
+def document_name(file_name: Optional[str]) -> Optional[str]:
+    # stored without the extension, search results add ".pdf" back
+    if file_name and file_name.lower().endswith(".pdf"):
+        return file_name[:-4]
+    return file_name
+
+
+def new_document(
+    pid: UUID,
+    lang: Set[str],
+    input_file: Path,
+    digest: str,
+    file_name: str,
+    now: datetime,
+    batch_id: Optional[UUID] = None,
+    callback_url: Optional[str] = None,
+    profile: Optional[Profile] = None,
+) -> Document:
+    profile = profile or Profile(config.default_profile)
+    content_key = storage.content_key(digest, lang, engine.profile_options(profile))
+    output_file, output_file_txt = storage.artifact_paths(content_key)
+    return Document(
         pid=pid,
         lang=lang,
         status="received",
         input=input_file,
         output=output_file,
-        output_json=output_file_json,
+        output_json=storage.shard_path(pid.hex, f"o_{pid}.json"),
         output_txt=output_file_txt,
         created=now,
-        expire=expire,
-        file_name=file_name or file.file,
+        expire=now + expiration_delta,
+        file_name=document_name(file_name),
+        content_key=content_key,
+        batch_id=batch_id,
+        callback_url=callback_url,
+        profile=profile,
     )
 
-    await do_ocr(document)
 
-    document.save_state()
-    with open(str(output_file_txt), 'r', encoding='utf-8') as txt_file:
-        txt_content = txt_file.read()
-        await database.execute(
-            DBDocument.__table__.insert().values(
-                pid=str(pid),
-                lang=",".join(lang),
-                status="received",
-                input=str(input_file.resolve()),
-                output=str(output_file.resolve()),
-                output_json=str(output_file_json.resolve()),
-                output_txt=str(output_file_txt.resolve()),
-                created=now,
-                expire=expire,
-                file_name=file_name or file.file,
-                text=txt_content,
-            )
+@app.post("/ocr/batch", status_code=200)
+async def ocr_batch(
+    lang: Optional[Set[str]] = Query([Lang.eng]),
+    files: List[UploadFile] = File(...),
+    api_key: APIKey = Depends(check_api_key),
+    priority: Priority = Query(Priority.bulk),
+    callback_url: Optional[AnyHttpUrl] = Query(None),
+    profile: Optional[Profile] = Query(None),
+):
+    """
+    Submit many PDFs at once, as several files and/or ZIP archives of PDFs.
+    Poll GET /ocr/batch/{batch_id} for progress.
+    """
+    batch_id = uuid.uuid4()
+    now = datetime.now()
+    uploads = []
+    try:
+        for file in files:
+            if len(uploads) >= config.max_batch_files:
+                raise HTTPException(status_code=413, detail="Too many files")
+
+            if is_zip(file):
+                archive = workdir / Path(f"z_{uuid.uuid4()}.zip")
+                try:
+                    await save_upload_file(
+                        file, archive, config.max_batch_request_size, ZIP_HEADER
+                    )
+                    uploads += await run_in_threadpool(
+                        extract_pdfs,
+                        archive,
+                        config.max_upload_size,
+                        config.max_batch_files - len(uploads),
+                        new_input,
+                    )
+                finally:
+                    remove_files([archive])
+            else:
+                pid, input_file = new_input()
+                digest = await save_upload_file(file, input_file, config.max_upload_size)
+                uploads.append((pid, input_file, digest, file.filename))
+    except BaseException:
+        await run_in_threadpool(remove_files, [path for _, path, _, _ in uploads])
+        raise
+
+    if not uploads:
+        raise HTTPException(status_code=400, detail="No PDF in request")
+
+    batch = [
+        new_document(
+            pid, lang, input_file, digest, name, now, batch_id, callback_url, profile
+        )
+        for pid, input_file, digest, name in uploads
+    ]
+    await jobs.submit(batch, api_key, priority)
+    return {
+        "batch_id": str(batch_id),
+        "documents": [
+            {"pid": str(doc.pid), "file_name": doc.file_name, "status": doc.status}
+            for doc in batch
+        ],
+    }
+
+
+@app.get("/ocr/batch/{batch_id}")
+async def get_batch(batch_id: UUID, api_key: APIKey = Depends(check_api_key)):
+    documents = DBDocument.__table__
+    rows = await database.fetch_all(
+        select(
+            [
+                documents.c.pid,
+                documents.c.file_name,
+                documents.c.status,
+                documents.c.created,
+                documents.c.finished,
+            ]
+        )
+        .where(documents.c.batch_id == str(batch_id))
+        .order_by(documents.c.created, documents.c.pid)
+    )
+    if not rows:
+        raise HTTPException(status_code=404, detail="Batch not found")
+
+    counts = Counter(row["status"] for row in rows)
+    return {
+        "batch_id": str(batch_id),
+        "total": len(rows),
+        "status": dict(counts),
+        "progress": (counts["done"] + counts["error"]) / len(rows),
+        "documents": [
+            {
+                "pid": row["pid"],
+                "file_name": row["file_name"],
+                "status": row["status"],
+                "finished": row["finished"],
+            }
+            for row in rows
+        ],
+    }
+
+
+@app.get("/ocr/batch/{batch_id}/zip")
+async def get_batch_zip(batch_id: UUID, api_key: APIKey = Depends(check_api_key)):
+    documents = DBDocument.__table__
+    rows = await database.fetch_all(
+        select([documents.c.pid, documents.c.output, documents.c.content_key]).where(
+            (documents.c.batch_id == str(batch_id)) & (documents.c.status == "done")
         )
+    )
+    if not rows:
+        raise HTTPException(status_code=404, detail="Batch not found")
+
+    texts = await storage.load_texts([storage.text_key(row) for row in rows])
+    entries = []
+    for row in rows:
+        entries.append((f"{row['pid']}.pdf", Path(row["output"])))
+        if storage.text_key(row) in texts:
+            entries.append((f"{row['pid']}.txt", texts[storage.text_key(row)]))
+    archive = workdir / Path(f"z_{uuid.uuid4()}.zip")
+    await run_in_threadpool(write_results_zip, entries, archive)
+    return FileResponse(
+        str(archive),
+        media_type="application/zip",
+        filename=f"{batch_id}.zip",
+        background=BackgroundTask(remove_files, [archive]),
+    )
+
 
+@app.post(
+    "/ocr", response_model=Document, status_code=200,
+)
+async def ocr(
+    background_tasks: BackgroundTasks,
+    lang: Optional[Set[str]] = Query([Lang.eng]),
+    file: UploadFile = File(...),
+    api_key: APIKey = Depends(check_api_key),
+    file_name: Optional[str] = Query(None),
+    priority: Optional[Priority] = Query(None),
+    callback_url: Optional[AnyHttpUrl] = Query(None),
+    profile: Optional[Profile] = Query(None),
+):
+    """
+    profile trades speed for output quality, config.default_profile by
+    default
+    """
+    pid = uuid.uuid4()
+    now = datetime.now()
+    input_file = input_path(pid)
+    digest = await save_upload_file(file, input_file, config.max_upload_size)
+
+    document = new_document(
+        pid, lang, input_file, digest, file_name or file.filename, now,
+        callback_url=callback_url,
+        profile=profile,
+    )
+    document.write_state()
+    await jobs.submit([document], api_key, priority)
     return document
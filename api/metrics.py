@@ -0,0 +1,87 @@
+"""
+Prometheus metrics, served on /metrics. Recording one is a dictionary
+lookup and a lock, cheap enough to leave on in production.
+"""
+from typing import Iterable
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from api.scheduler import OCRScheduler, Priority
+
+# 5ms .. ~1h, OCR stages span from a JSON write to a thousand-page book
+STAGE_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600,
+)
+
+stage_seconds = Histogram(
+    "ocr_stage_seconds",
+    "Time spent in each stage of the OCR pipeline",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+queue_wait_seconds = Histogram(
+    "ocr_queue_wait_seconds",
+    "Time OCR jobs waited in the queue for a worker",
+    ["priority"],
+    buckets=STAGE_BUCKETS,
+)
+search_seconds = Histogram(
+    "ocr_search_seconds", "Latency of full-text searches", ["mode"]
+)
+documents_total = Counter(
+    "ocr_documents_total", "Documents received and finished", ["status", "lang"]
+)
+pages_total = Counter("ocr_pages_total", "Pages OCR'd")
+text_layer_pages_total = Counter(
+    "ocr_text_layer_pages_total", "Pages whose text was taken from the PDF, not OCR'd"
+)
+pages_per_second = Histogram(
+    "ocr_pages_per_second",
+    "OCR throughput of each job",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 25, 50),
+)
+queue_depth = Gauge("ocr_queue_depth", "OCR jobs waiting for a worker", ["priority"])
+active_processes = Gauge("ocr_active_processes", "OCR jobs being run")
+cleanup_documents_total = Counter(
+    "ocr_cleanup_documents_total", "Documents deleted by the cleanup", ["reason"]
+)
+cleanup_bytes_total = Counter(
+    "ocr_cleanup_bytes_total", "Bytes of files reclaimed by the cleanup", ["reason"]
+)
+
+
+def lang_label(lang: Iterable[str]) -> str:
+    return "+".join(sorted(getattr(code, "value", code) for code in lang))
+
+
+def document_counted(status: str, lang: Iterable[str]):
+    documents_total.labels(status, lang_label(lang)).inc()
+
+
+def cleanup_counted(reason: str, report: dict):
+    # reason: "expired" or "evicted"
+    cleanup_documents_total.labels(reason).inc(report["documents"])
+    cleanup_bytes_total.labels(reason).inc(report["bytes"])
+
+
+def observe_queue_wait(priority: Priority, seconds: float):
+    queue_wait_seconds.labels(priority.value).observe(seconds)
+
+
+def observe_ocr(pages: int, seconds: float):
+    stage_seconds.labels("ocr").observe(seconds)
+    if pages:
+        pages_total.inc(pages)
+        if seconds > 0:
+            pages_per_second.observe(pages / seconds)
+
+
+def track_scheduler(scheduler: OCRScheduler):
+    """
+    Read the queue gauges from the scheduler at scrape time
+    """
+    for priority in Priority:
+        queue_depth.labels(priority.value).set_function(
+            lambda priority=priority: scheduler.stats()["depth_by_priority"][priority.value]
+        )
+    active_processes.set_function(lambda: scheduler.active)
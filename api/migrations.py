@@ -0,0 +1,218 @@
+"""
+Schema migrations, applied in order at startup and recorded in the
+schema_version table. The first one creates the tables as currently
+declared, so every later migration has to be a no-op on a fresh database.
+"""
+import logging
+
+from sqlalchemy import create_engine, func, inspect, select
+
+from api.database import (
+    DBDocument,
+    DBDocumentPage,
+    DBDocumentText,
+    backend,
+    connection_options,
+    metadata,
+)
+from api.settings import config
+from api.storage import page_rows
+from api.text import compress, decompress, fold, normalize
+
+documents = DBDocument.__table__
+texts = DBDocumentText.__table__
+pages = DBDocumentPage.__table__
+
+logger = logging.getLogger("gunicorn.error")
+
+
+def add_missing_columns(connection, table):
+    """
+    Add the declared columns and indexes a table created by an older
+    version lacks. New columns are nullable, existing rows keep NULL.
+    """
+    inspector = inspect(connection)
+    existing = {column["name"] for column in inspector.get_columns(table.name)}
+    for column in table.columns:
+        if column.name not in existing:
+            connection.execute(
+                "ALTER TABLE {} ADD COLUMN {} {}".format(
+                    table.name,
+                    column.name,
+                    column.type.compile(dialect=connection.dialect),
+                )
+            )
+    indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name not in indexes:
+            index.create(connection)
+
+
+def create_tables(connection):
+    """
+    Create the declared tables, adding to the documents table of the first
+    versions what it lacks. Their uploads were stored with the extension
+    of the file name, search results add it.
+    """
+    metadata.create_all(connection)
+    for table in metadata.sorted_tables:
+        add_missing_columns(connection, table)
+
+    name = documents.c.file_name
+    connection.execute(
+        documents.update()
+        .where(func.lower(name).like("%.pdf"))
+        .values(file_name=func.substr(name, 1, func.length(name) - 4))
+    )
+
+
+def create_search_index(connection):
+    """
+    Full-text index over the normalized texts, kept up to date by
+    api.search and keyed like document_texts: identical uploads sharing an
+    artifact share one entry. `folded` holds the same text without accents.
+    PostgreSQL stores the tsvector of both, generated on write, which needs
+    PostgreSQL 12.
+    """
+    if backend == "postgresql":
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS documents_fts "
+            "(key VARCHAR PRIMARY KEY, text TEXT, folded TEXT, "
+            "text_vector tsvector GENERATED ALWAYS AS "
+            "(to_tsvector('simple', text)) STORED, "
+            "folded_vector tsvector GENERATED ALWAYS AS "
+            "(to_tsvector('simple', folded)) STORED)"
+        )
+        for column in ("text", "folded"):
+            connection.execute(
+                f"CREATE INDEX IF NOT EXISTS ix_documents_fts_{column}_vector "
+                f"ON documents_fts USING gin ({column}_vector)"
+            )
+    else:
+        connection.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5("
+            "key UNINDEXED, text, folded, tokenize = 'unicode61 remove_diacritics 0')"
+        )
+
+    # the texts of the first versions, in the documents table
+    rows = connection.execute(
+        "SELECT coalesce(content_key, pid), text FROM documents WHERE text IS NOT NULL"
+    ).fetchall()
+    for key, content in rows:
+        normalized = normalize(content)
+        connection.execute(
+            "INSERT INTO documents_fts (key, text, folded) VALUES (%s, %s, %s)"
+            if backend == "postgresql"
+            else "INSERT INTO documents_fts (key, text, folded) VALUES (?, ?, ?)",
+            (key, normalized, fold(normalized)),
+        )
+
+
+def move_texts(connection):
+    """
+    Move the OCR text out of the documents table into document_texts
+    """
+    # one text at a time, they can be large
+    pids = connection.execute(
+        "SELECT pid FROM documents WHERE text IS NOT NULL"
+    ).fetchall()
+    for (pid,) in pids:
+        content_key, content = connection.execute(
+            select([documents.c.content_key, documents.c.text]).where(
+                documents.c.pid == pid
+            )
+        ).fetchone()
+        key = content_key or pid
+        if connection.execute(select([texts.c.key]).where(texts.c.key == key)).first():
+            continue
+        encoding, data = compress(content, config.text_compression)
+        connection.execute(
+            texts.insert().values(key=key, encoding=encoding, data=data, size=len(content))
+        )
+    connection.execute("UPDATE documents SET text = NULL WHERE text IS NOT NULL")
+
+
+def add_document_columns(connection):
+    add_missing_columns(connection, documents)
+
+
+def split_texts(connection):
+    """
+    Store the texts in document_texts page by page in document_pages
+    """
+    keys = connection.execute(
+        select([texts.c.key]).where(texts.c.pages.is_(None))
+    ).fetchall()
+    for (key,) in keys:
+        encoding, data = connection.execute(
+            select([texts.c.encoding, texts.c.data]).where(texts.c.key == key)
+        ).fetchone()
+        rows = page_rows(key, decompress(encoding, data))
+        connection.execute(pages.delete().where(pages.c.key == key))
+        connection.execute(pages.insert(), rows)
+        connection.execute(
+            texts.update()
+            .where(texts.c.key == key)
+            .values(
+                data=b"",
+                pages=len(rows),
+            )
+        )
+
+
+MIGRATIONS = [
+    create_tables,
+    create_search_index,
+    move_texts,
+    # code, result
+    add_document_columns,
+    # callback_url
+    add_document_columns,
+    split_texts,
+    # priority, worker, lease_expire
+    add_document_columns,
+    # page_sources
+    add_document_columns,
+    # profile
+    add_document_columns,
+]
+
+
+def lock(connection):
+    # serializes the workers of a deployment starting at the same time
+    if backend == "postgresql":
+        connection.execute("SELECT pg_advisory_xact_lock(hashtext('schema_version'))")
+    else:
+        connection.execute("UPDATE schema_version SET version = version")
+
+
+def migrate():
+    connect_args = connection_options() if backend == "sqlite" else {}
+    engine = create_engine(config.database_url, connect_args=connect_args)
+    try:
+        with engine.connect() as connection:
+            if backend == "sqlite":
+                # persistent, readers no longer block the writer
+                connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS schema_version "
+                "(id INTEGER PRIMARY KEY, version INTEGER NOT NULL)"
+            )
+            connection.execute(
+                "INSERT INTO schema_version (id, version) VALUES (1, 0) "
+                "ON CONFLICT (id) DO NOTHING"
+            )
+
+        with engine.begin() as connection:
+            lock(connection)
+            version = connection.execute(
+                "SELECT version FROM schema_version WHERE id = 1"
+            ).scalar()
+            for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+                logger.info("Applying migration %d: %s", number, migration.__name__)
+                migration(connection)
+                connection.execute(
+                    "UPDATE schema_version SET version = {} WHERE id = 1".format(number)
+                )
+    finally:
+        engine.dispose()
@@ -1,14 +1,22 @@
+import shutil
 import subprocess
+import time
 from datetime import datetime
 from enum import Enum
 from pathlib import Path
-from typing import Optional, Set
+from typing import List, Optional, Set
 from uuid import UUID
 
 from pydantic import BaseModel
 
+from api import engine, metrics
 from api.settings import config
-from api.tools import special_win_wslpath
+
+
+def decode_output(output) -> str:
+    if isinstance(output, bytes):
+        output = output.decode("utf-8", "replace")
+    return str(output).strip()
 
 
 class Lang(str, Enum):
@@ -16,6 +24,16 @@ class Lang(str, Enum):
     vie = "vie"
 
 
+class Profile(str, Enum):
+    """
+    Speed against output quality: fast only adds the text layer, balanced
+    also straightens and optimizes the pages, archival produces PDF/A
+    """
+    fast = "fast"
+    balanced = "balanced"
+    archival = "archival"
+
+
 class Document(BaseModel):
     pid: UUID
     lang: Set[Lang]
@@ -31,53 +49,129 @@ class Document(BaseModel):
     expire: datetime
     finished: Optional[datetime] = None
     file_name: Optional[str] = None
+    content_key: Optional[str] = None
+    batch_id: Optional[UUID] = None
+    callback_url: Optional[str] = None
+    # engine.TEXT_LAYER or engine.OCR for each page
+    page_sources: Optional[str] = None
+    profile: Optional[Profile] = None
+    pages: Optional[int] = None
+    # threads ocrmypdf may use, granted by the scheduler
+    cpu_jobs: Optional[int] = None
+
+    @classmethod
+    def from_row(cls, row) -> "Document":
+        return cls(
+            pid=row["pid"],
+            lang=row["lang"].split(","),
+            status=row["status"],
+            input=row["input"],
+            output=row["output"],
+            output_json=row["output_json"],
+            output_txt=row["output_txt"],
+            created=row["created"],
+            processing=row["processing"],
+            expire=row["expire"],
+            finished=row["finished"],
+            file_name=row["file_name"],
+            content_key=row["content_key"],
+            batch_id=row["batch_id"],
+            code=row["code"],
+            result=row["result"],
+            callback_url=row["callback_url"],
+            page_sources=row["page_sources"],
+            profile=row["profile"],
+        )
 
     def ocr(self, wsl: bool = False):
         self.status = "processing"
         self.processing = datetime.now()
-        self.save_state()
+        self.write_state()
 
-        output_txt_path = (
-            special_win_wslpath(self.output_txt)
-            if wsl
-            else str(self.output_txt.absolute())
-        )
-        input_path = (
-            special_win_wslpath(self.input) if wsl else str(self.input.absolute())
-        )
-        output_path = (
-            special_win_wslpath(self.output) if wsl else str(self.output.absolute())
-        )
+        lang = "+".join([l.value for l in self.lang])
+        pages = 0
+        started = time.monotonic()
         try:
-            output = subprocess.check_output(
-                " ".join(
-                    [
-                        config.base_command_ocr,
-                        config.base_command_option,
-                        f"-l {'+'.join([l.value for l in self.lang])}",
-                        f"--sidecar {output_txt_path}",
-                        input_path,
-                        output_path,
-                    ]
-                ),
-                stderr=subprocess.STDOUT,
-                shell=True,
+            pages = self.pages or engine.page_count(self.input)
+            text_layer = self.read_text_layer()
+            sources = engine.page_sources(text_layer) if text_layer else None
+            base_options = engine.profile_options(self.profile)
+            keep_text = bool(sources) and engine.TEXT_LAYER in sources
+            if keep_text:
+                base_options = engine.text_layer_options(
+                    base_options, engine.sparse_text(text_layer, sources)
+                )
+
+            copied = (
+                bool(sources)
+                and engine.OCR not in sources
+                and engine.copies_output(base_options)
             )
+            if copied:
+                output = self.use_text_layer(text_layer)
+            elif pages and pages >= config.ocr_split_min_pages:
+                output = engine.run_ocrmypdf_split(
+                    lang,
+                    self.input,
+                    self.output,
+                    self.output_txt,
+                    wsl,
+                    base_options,
+                    self.cpu_jobs,
+                )
+            else:
+                output = engine.run_ocrmypdf(
+                    lang,
+                    engine.shell_path(self.input, wsl),
+                    engine.shell_path(self.output, wsl),
+                    engine.shell_path(self.output_txt, wsl),
+                    f"--jobs {self.cpu_jobs}" if self.cpu_jobs else "",
+                    base_options,
+                )
+            if keep_text and not copied:
+                engine.merge_text_layer(text_layer, sources, self.output_txt)
+            self.page_sources = sources
 
         except subprocess.CalledProcessError as e:
             self.status = "error"
             self.code = e.returncode
-            self.result = e.output.strip()
+            self.result = decode_output(e.output)
             self.finished = datetime.now()
         else:
             self.status = "done"
             self.code = 0
-            self.result = str(output).strip()
+            self.result = decode_output(output)
             self.finished = datetime.now()
+            ocr_pages = self.page_sources.count(engine.OCR) if self.page_sources else pages
+            metrics.observe_ocr(ocr_pages or 0, time.monotonic() - started)
+            if self.page_sources:
+                metrics.text_layer_pages_total.inc(self.page_sources.count(engine.TEXT_LAYER))
         finally:
+            self.write_state()
+
+    def read_text_layer(self) -> Optional[List[str]]:
+        if not config.text_layer_min_chars:
+            return None
+        with metrics.stage_seconds.labels("text_layer").time():
+            return engine.extract_text_layer(self.input)
+
+    def use_text_layer(self, text_layer: List[str]) -> str:
+        """
+        Born-digital PDF: its text layer is the sidecar and the PDF itself
+        the output, no page needs OCR. Only for profiles asking for neither
+        PDF/A nor optimization, the others run ocrmypdf with --skip-text.
+        """
+        shutil.copyfile(self.input, self.output)
+        engine.write_sidecar(text_layer, self.output_txt)
+        return f"OCR skipped, text layer of {len(text_layer)} pages extracted"
+
+    def write_state(self):
+        # the database holds the state, the JSON file is kept for tools reading it
+        if config.write_state_json:
             self.save_state()
 
     def save_state(self):
-        with open(self.output_json, "w") as ff:
-            ff.write(self.json())
+        with metrics.stage_seconds.labels("save_state").time():
+            with open(self.output_json, "w") as ff:
+                ff.write(self.json())
 
@@ -0,0 +1,249 @@
+"""
+Warm ocrmypdf processes. Each one imports ocrmypdf once and runs jobs
+through its Python API, saving the interpreter start and imports running
+the command costs for every document. A process runs one job at a time and
+is replaced after config.ocr_pool_max_tasks jobs, bounding how much memory
+it can grow. When it dies or its job outlasts
+config.ocr_pool_timeout_seconds, only that job fails: the process is
+replaced and the job is not run again, the same PDF would likely break the
+next one too.
+"""
+import logging
+import multiprocessing
+import shlex
+import subprocess
+import threading
+from importlib.util import find_spec
+from multiprocessing.connection import wait
+from typing import List, Set, Tuple
+
+from api.settings import config
+
+logger = logging.getLogger("gunicorn.error")
+
+# ocrmypdf.ExitCode.other_error
+OTHER_ERROR = 15
+
+# the processes started and not stopped, the idle ones ready for a job
+_processes: Set["WarmProcess"] = set()
+_idle: List["WarmProcess"] = []
+_condition = threading.Condition()
+
+
+def available() -> bool:
+    # WSL paths only make sense to a command run in WSL
+    return (
+        config.ocr_engine == "pool"
+        and not config.enable_wsl_compat
+        and find_spec("ocrmypdf") is not None
+    )
+
+
+def option_kwargs(options: str) -> dict:
+    """
+    ocrmypdf.ocr() keyword arguments of command line options:
+    "--output-type pdf --optimize 0 --force-ocr" gives
+    {"output_type": "pdf", "optimize": 0, "force_ocr": True}
+    """
+    kwargs = {}
+    tokens = shlex.split(options)
+    for index, token in enumerate(tokens):
+        if not token.startswith("-"):
+            continue
+        name = token.lstrip("-").replace("-", "_")
+        value = tokens[index + 1] if index + 1 < len(tokens) else None
+        if value is None or value.startswith("-"):
+            kwargs[name] = True
+        else:
+            kwargs[name] = int(value) if value.isdigit() else value
+    return kwargs
+
+
+def warm():
+    try:
+        import ocrmypdf  # noqa: F401
+    except Exception:
+        # reported by every job
+        pass
+
+
+def ocr(input_path: str, output_path: str, kwargs: dict) -> Tuple[int, str]:
+    """
+    Run in a pool process. Returns the exit code with a message, exceptions
+    don't cross the process boundary with their details.
+    """
+    try:
+        import ocrmypdf
+    except Exception as e:
+        return OTHER_ERROR, f"{type(e).__name__}: {e}"
+
+    try:
+        return int(ocrmypdf.ocr(input_path, output_path, **kwargs)), ""
+    except ocrmypdf.exceptions.ExitCodeException as e:
+        return int(e.exit_code), f"{type(e).__name__}: {e}"
+    except Exception as e:
+        return OTHER_ERROR, f"{type(e).__name__}: {e}"
+
+
+def serve(connection):
+    """
+    Main loop of a pool process: runs the jobs sent by WarmProcess.run
+    until told to stop or the API process goes away.
+    """
+    warm()
+    connection.send(None)
+    while True:
+        try:
+            job = connection.recv()
+        except (EOFError, OSError):
+            return
+        if job is None:
+            return
+        connection.send(ocr(*job))
+
+
+class ProcessDied(Exception):
+    pass
+
+
+class WarmProcess:
+    """
+    A pool process and the pipe its jobs go through, one at a time
+    """
+
+    def __init__(self):
+        # spawned, forking a process running threads and an event loop is unsafe
+        context = multiprocessing.get_context("spawn")
+        self.connection, child = context.Pipe()
+        # daemonic, so none outlives the API process
+        self.process = context.Process(target=serve, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+        self.warm = False
+        self.tasks = 0
+
+    def receive(self, timeout: float):
+        """
+        The next message of the process, TimeoutError when none came in time
+        """
+        ready = wait([self.connection, self.process.sentinel], timeout)
+        if not ready:
+            raise TimeoutError
+        # a process exiting right after answering is ready both ways
+        if self.connection in ready or self.connection.poll():
+            try:
+                return self.connection.recv()
+            except (EOFError, OSError):
+                pass
+        self.process.join(5)
+        raise ProcessDied(f"exit code {self.process.exitcode}")
+
+    def run(self, input_path: str, output_path: str, kwargs: dict) -> Tuple[int, str]:
+        if not self.warm:
+            # importing ocrmypdf is no part of the job's time
+            self.receive(config.ocr_pool_timeout_seconds)
+            self.warm = True
+        self.tasks += 1
+        self.connection.send((input_path, output_path, kwargs))
+        return self.receive(config.ocr_pool_timeout_seconds)
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(5)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.connection.close()
+
+
+def acquire() -> WarmProcess:
+    """
+    An idle process, started when fewer than config.max_ocr_process are.
+    Waits for one to be released otherwise.
+    """
+    with _condition:
+        while not _idle and len(_processes) >= config.max_ocr_process:
+            _condition.wait()
+        if _idle:
+            return _idle.pop()
+        process = WarmProcess()
+        _processes.add(process)
+        logger.info("Started an ocrmypdf process, %d running", len(_processes))
+        return process
+
+
+def release(process: WarmProcess, healthy: bool = True):
+    """
+    Give a process back once its job is done. It is stopped when it failed,
+    ran config.ocr_pool_max_tasks jobs or the pool was stopped meanwhile.
+    """
+    with _condition:
+        keep = healthy and process in _processes and process.tasks < config.ocr_pool_max_tasks
+        if keep:
+            _idle.append(process)
+        else:
+            _processes.discard(process)
+        _condition.notify()
+    if not keep:
+        if healthy:
+            process.stop()
+        else:
+            process.kill()
+
+
+def run(lang: str, input_path: str, output_path: str, sidecar: str, options: str) -> bytes:
+    """
+    Same contract as running the command: the output, or CalledProcessError
+    with the exit code. The timeout counts from when a process takes the job
+    up, not the wait for an idle one.
+    """
+    kwargs = option_kwargs(options)
+    # the processes can't start the process pool ocrmypdf would run pages in
+    kwargs.update(language=lang.split("+"), sidecar=sidecar, use_threads=True)
+    process = acquire()
+    try:
+        code, message = process.run(input_path, output_path, kwargs)
+    except TimeoutError:
+        release(process, healthy=False)
+        raise subprocess.CalledProcessError(
+            OTHER_ERROR,
+            "ocrmypdf",
+            output=f"Timed out after {config.ocr_pool_timeout_seconds}s".encode(),
+        )
+    except (ProcessDied, OSError) as e:
+        release(process, healthy=False)
+        logger.warning("ocrmypdf process died running %s: %s", input_path, e)
+        raise subprocess.CalledProcessError(
+            OTHER_ERROR, "ocrmypdf", output=f"ocrmypdf process died: {e}".encode()
+        )
+    except BaseException:
+        release(process, healthy=False)
+        raise
+    release(process)
+    if code:
+        raise subprocess.CalledProcessError(code, "ocrmypdf", output=message.encode())
+    return message.encode()
+
+
+def start():
+    if available():
+        processes = [acquire() for _ in range(config.max_ocr_process)]
+        for process in processes:
+            release(process)
+
+
+def stop():
+    with _condition:
+        processes = list(_processes)
+        _processes.clear()
+        _idle.clear()
+        _condition.notify_all()
+    # the jobs still running fail
+    for process in processes:
+        process.kill()
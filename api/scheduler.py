@@ -0,0 +1,141 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from enum import Enum
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+
+class Priority(str, Enum):
+    interactive = "interactive"
+    bulk = "bulk"
+
+
+class OCRScheduler:
+    """
+    Queue of pending OCR jobs shared by the OCR workers. Jobs of a higher
+    priority are always handed out first, and inside a priority the API keys
+    are served round-robin so one client pushing a large batch can't starve
+    the others. Waiting workers are parked on futures, never on a lock.
+    on_wait is called with the priority and the seconds each job queued.
+
+    With a budget of cores, jobs are only handed out while some are free.
+    Each job is granted the cores demand(job) asks for, or fewer when not
+    that many are free, so small jobs keep running next to large ones.
+    """
+
+    def __init__(
+        self,
+        on_wait: Optional[Callable[[Priority, float], None]] = None,
+        cores: int = 0,
+        demand: Optional[Callable[[Any], int]] = None,
+    ):
+        self._levels: Dict[Priority, "OrderedDict[str, Deque[Tuple[float, Any]]]"] = {
+            priority: OrderedDict() for priority in Priority
+        }
+        self._waiters: Deque[asyncio.Future] = deque()
+        self.active = 0
+        self.submitted = 0
+        self.completed = 0
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.on_wait = on_wait
+        self.cores = cores
+        self.cores_used = 0
+        self.demand = demand or (lambda job: 1)
+        self._grants: Dict[int, int] = {}
+
+    @property
+    def depth(self) -> int:
+        return sum(
+            len(jobs) for level in self._levels.values() for jobs in level.values()
+        )
+
+    def submit(self, job: Any, key: str = "", priority: Priority = Priority.bulk):
+        level = self._levels[priority]
+        level.setdefault(key, deque()).append((time.monotonic(), job))
+        self.submitted += 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def _pop(self) -> Any:
+        for priority, level in self._levels.items():
+            if not level:
+                continue
+            key, jobs = next(iter(level.items()))
+            enqueued, job = jobs.popleft()
+            if jobs:
+                level.move_to_end(key)
+            else:
+                del level[key]
+
+            waited = time.monotonic() - enqueued
+            self.wait_count += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            if self.on_wait:
+                self.on_wait(priority, waited)
+            self.active += 1
+            if self.cores:
+                grant = max(1, min(self.demand(job), self.cores - self.cores_used))
+                self.cores_used += grant
+                self._grants[id(job)] = grant
+            return job
+        raise LookupError("no job queued")
+
+    def _ready(self) -> bool:
+        return bool(self.depth) and (not self.cores or self.cores_used < self.cores)
+
+    async def next_job(self) -> Any:
+        while not self._ready():
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # pass the wake-up on if it reached us right before cancelling
+                if waiter.done() and not waiter.cancelled():
+                    self._wake()
+                raise
+        job = self._pop()
+        if self._ready():
+            # a job done may free cores for more than one waiting worker
+            self._wake()
+        return job
+
+    def grant(self, job: Any) -> int:
+        """
+        Cores granted to a running job, 0 without a budget
+        """
+        return self._grants.get(id(job), 0)
+
+    def job_done(self, job: Any = None):
+        self.active -= 1
+        self.completed += 1
+        if id(job) in self._grants:
+            self.cores_used -= self._grants.pop(id(job))
+            self._wake()
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "depth_by_priority": {
+                priority.value: sum(len(jobs) for jobs in level.values())
+                for priority, level in self._levels.items()
+            },
+            "active": self.active,
+            "cores": self.cores,
+            "cores_used": self.cores_used,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "wait_seconds_avg": self.wait_total / self.wait_count
+            if self.wait_count
+            else 0.0,
+            "wait_seconds_max": self.wait_max,
+        }
@@ -0,0 +1,364 @@
+import base64
+import json
+import re
+import time
+from typing import List, Optional, Tuple
+
+from sqlalchemy import column, table, text
+
+from api import database, metrics
+from api.text import fold, normalize
+
+# control characters FTS5 wraps around matched tokens in snippets
+HIGHLIGHT_OPEN = "\x02"
+HIGHLIGHT_CLOSE = "\x03"
+
+WORD = re.compile(r"\w+")
+
+# ts_headline() options giving snippets shaped like the FTS5 ones
+HEADLINE_OPTIONS = (
+    f"StartSel={HIGHLIGHT_OPEN}, StopSel={HIGHLIGHT_CLOSE}, "
+    "MaxWords=16, MinWords=8"
+)
+
+# ts_headline() options marking every match of the whole text, like highlight()
+HIGHLIGHT_ALL_OPTIONS = (
+    f"StartSel={HIGHLIGHT_OPEN}, StopSel={HIGHLIGHT_CLOSE}, HighlightAll=true"
+)
+
+# the documents an entry of documents_fts, keyed by storage.text_key, holds
+# the text of
+INDEXED_DOCUMENTS = (
+    "documents.status = 'done' AND (documents.content_key = documents_fts.key "
+    "OR (documents.content_key IS NULL AND documents.pid = documents_fts.key))"
+)
+
+documents_fts = table("documents_fts", column("key"), column("text"), column("folded"))
+
+
+def parse_search_query(query: str) -> List[List[str]]:
+    result = []
+    groups = query.split("||")
+    for group in groups:
+        and_conditions = group.split("&&")
+        if len(and_conditions) > 1:
+            result.append(and_conditions)
+        else:
+            result.append([group])
+    return result
+
+
+def phrase(term: str) -> str:
+    # quoted so FTS5 operators in user input are matched literally, the
+    # trailing * keeps matching words that only start with the last token
+    return '"{}" *'.format(term.replace('"', '""'))
+
+
+def tsquery_phrase(term: str) -> Optional[str]:
+    # the PostgreSQL counterpart of phrase(): words in sequence, the last
+    # one matched as a prefix
+    words = ["'{}'".format(word.replace("'", "''")) for word in WORD.findall(term)]
+    if not words:
+        return None
+    return "({}:*)".format(" <-> ".join(words))
+
+
+def index_column(ignore_accents: bool = False) -> str:
+    return "folded" if ignore_accents else "text"
+
+
+def compile_query(query: str, ignore_accents: bool = False) -> Optional[str]:
+    """
+    Compile the `a && b || c` search syntax into an FTS5 MATCH expression
+    (a tsquery on PostgreSQL), normalized the same way as the indexed text.
+    """
+    query = normalize(query)
+    if ignore_accents:
+        query = fold(query)
+    postgresql = database.backend == "postgresql"
+
+    groups = []
+    for group in parse_search_query(query):
+        if postgresql:
+            terms = [tsquery_phrase(term) for term in group if tsquery_phrase(term)]
+        else:
+            terms = [phrase(term.strip()) for term in group if term.strip()]
+        if terms:
+            groups.append("({})".format((" & " if postgresql else " AND ").join(terms)))
+    if not groups:
+        return None
+    if postgresql:
+        return " | ".join(groups)
+    return "{} : ({})".format(index_column(ignore_accents), " OR ".join(groups))
+
+
+async def index_document(key: str, content: str):
+    """
+    Index an OCR text under its storage.text_key: identical uploads sharing
+    an artifact share its entry.
+    """
+    with metrics.stage_seconds.labels("index").time():
+        normalized = normalize(content)
+        await remove_texts([key])
+        await database.execute(
+            documents_fts.insert().values(
+                key=key, text=normalized, folded=fold(normalized)
+            )
+        )
+
+
+async def remove_texts(keys: List[str]):
+    if keys:
+        await database.execute(documents_fts.delete().where(documents_fts.c.key.in_(keys)))
+
+
+def encode_cursor(rank: float, pid: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([rank, pid]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[float, str]:
+    try:
+        rank, pid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(rank), str(pid)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def parse_snippet(marked: str) -> dict:
+    """
+    Strip the highlight markers from an FTS5 snippet and return the plain
+    snippet with the [start, end) character offsets of the matched terms.
+    """
+    snippet = ""
+    highlights = []
+    for index, piece in enumerate(re.split(f"[{HIGHLIGHT_OPEN}{HIGHLIGHT_CLOSE}]", marked)):
+        if index % 2:
+            highlights.append([len(snippet), len(snippet) + len(piece)])
+        snippet += piece
+    return {"snippet": snippet, "highlights": highlights}
+
+
+def original_snippet(postgresql: bool = False) -> str:
+    """
+    SQL expression of the stretch of `text` a snippet of `folded` was cut
+    from: folding maps characters one to one, so it starts where the
+    snippet, without its markers and ellipses, starts in `folded`.
+    """
+    if postgresql:
+        plain = "btrim(replace(replace(snippet, chr(2), ''), chr(3), ''), '…')"
+        start = f"strpos(folded, {plain})"
+    else:
+        plain = "trim(replace(replace(snippet, char(2), ''), char(3), ''), '…')"
+        start = f"instr(folded, {plain})"
+    return f"substr(text, {start}, length({plain})) AS original"
+
+
+def restore_accents(result: dict, original: Optional[str]) -> dict:
+    """
+    Replace the folded text of a parsed snippet with the original stretch
+    of text, which has the same length; the highlights stay valid.
+    """
+    snippet = result["snippet"]
+    folded = snippet.strip("…")
+    if not folded or original is None or len(original) != len(folded):
+        return result
+    start = snippet.index(folded)
+    result["snippet"] = snippet[:start] + original + snippet[start + len(folded):]
+    return result
+
+
+def page_numbers(marked: str) -> List[int]:
+    """
+    Numbers of the pages of a text with every match highlighted holding
+    at least one of them
+    """
+    return [
+        number
+        for number, page in enumerate(marked.split("\f"), 1)
+        if HIGHLIGHT_OPEN in page
+    ]
+
+
+def build_postgresql_search(
+    column: str, snippets: bool = False, limit: bool = False, pages: bool = False
+) -> str:
+    """
+    Same statement as the SQLite one, on the stored and GIN indexed tsvector
+    of column. ts_rank grows with relevance, it is negated to sort like
+    bm25. Snippets and page hits are only made for the rows of the page.
+    """
+    vector = f"documents_fts.{column}_vector"
+    hits = (
+        "SELECT * FROM ("
+        "SELECT documents_fts.key AS key, documents.pid AS pid, "
+        f"documents.file_name AS file_name, -ts_rank({vector}, query) AS rank "
+        f"FROM documents_fts JOIN documents ON {INDEXED_DOCUMENTS}, "
+        "to_tsquery('simple', :match) AS query "
+        f"WHERE {vector} @@ query"
+        ") AS hits WHERE (rank, pid) > (:rank, :pid) "
+        "ORDER BY rank, pid"
+    )
+    if limit:
+        hits += " LIMIT :limit"
+    if not snippets and not pages:
+        return hits
+
+    columns = "pid, file_name, rank"
+    marks = ""
+    if snippets:
+        columns += ", snippet"
+        marks += (
+            f", ts_headline('simple', documents_fts.{column}, "
+            "to_tsquery('simple', :page_match), :headline) AS snippet"
+        )
+        if column == "folded":
+            columns += f", {original_snippet(True)}"
+    if pages:
+        columns += ", marked"
+        marks += (
+            f", ts_headline('simple', documents_fts.{column}, "
+            "to_tsquery('simple', :page_match), :highlight_all) AS marked"
+        )
+    return (
+        f"SELECT {columns} FROM ("
+        "SELECT hits.*, documents_fts.text AS text, documents_fts.folded AS folded"
+        f"{marks} FROM ({hits}) AS hits "
+        "JOIN documents_fts ON documents_fts.key = hits.key"
+        ") AS snippets ORDER BY rank, pid"
+    )
+
+
+def build_sqlite_search(
+    column: int, snippets: bool = False, limit: bool = False, pages: bool = False
+) -> str:
+    """
+    The rows of the page are ranked first, their snippets and page hits
+    are only made afterwards: FTS5 would make them for every match. The
+    CROSS JOIN keeps those rows the outer loop, each entry then read by
+    rowid.
+    """
+    hits = (
+        "SELECT * FROM ("
+        "SELECT documents_fts.rowid AS fts_rowid, documents.pid AS pid, "
+        "documents.file_name AS file_name, bm25(documents_fts) AS rank "
+        f"FROM documents_fts JOIN documents ON {INDEXED_DOCUMENTS} "
+        "WHERE documents_fts MATCH :match"
+        ") WHERE (rank, pid) > (:rank, :pid) "
+        "ORDER BY rank, pid"
+    )
+    if limit:
+        hits += " LIMIT :limit"
+    if not snippets and not pages:
+        return hits
+
+    columns = "pid, file_name, rank"
+    marks = ""
+    if snippets:
+        columns += ", snippet"
+        marks += f", snippet(documents_fts, {column}, char(2), char(3), '…', 16) AS snippet"
+        if column == 2:
+            # the snippet of the folded text would show it without accents
+            columns += f", {original_snippet()}"
+    if pages:
+        columns += ", marked"
+        marks += f", highlight(documents_fts, {column}, char(2), char(3)) AS marked"
+    return (
+        f"SELECT {columns} FROM ("
+        "SELECT hits.*, documents_fts.text AS text, documents_fts.folded AS folded"
+        f"{marks} FROM ({hits}) AS hits "
+        "CROSS JOIN documents_fts ON documents_fts.rowid = hits.fts_rowid "
+        "WHERE documents_fts MATCH :page_match"
+        ") ORDER BY rank, pid"
+    )
+
+
+def build_search(
+    query: str,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    snippets: bool = False,
+    ignore_accents: bool = False,
+    pages: bool = False,
+):
+    """
+    Build the ranked search statement, ordered by BM25 (best first) and pid
+    so a cursor taken from the last row resumes exactly after it.
+    """
+    match = compile_query(query, ignore_accents)
+    if match is None:
+        return None
+
+    rank, pid = decode_cursor(cursor) if cursor else (float("-inf"), "")
+    values = {"match": match, "rank": rank, "pid": pid}
+    if snippets or pages:
+        # the databases drivers bind a parameter only once
+        values["page_match"] = match
+    if database.backend == "postgresql":
+        statement = build_postgresql_search(
+            index_column(ignore_accents), snippets, limit is not None, pages
+        )
+        if snippets:
+            values["headline"] = HEADLINE_OPTIONS
+        if pages:
+            values["highlight_all"] = HIGHLIGHT_ALL_OPTIONS
+    else:
+        statement = build_sqlite_search(
+            2 if ignore_accents else 1, snippets, limit is not None, pages
+        )
+    if limit is not None:
+        values["limit"] = limit
+    return text(statement).bindparams(**values)
+
+
+def search_result(row) -> dict:
+    result = {
+        "pid": str(row["pid"]),
+        "file_name": f"{row['file_name']}.pdf" if row["file_name"] else None,
+        "score": -row["rank"],
+    }
+    keys = row.keys()
+    if "snippet" in keys:
+        result.update(parse_snippet(row["snippet"] or ""))
+        if "original" in keys:
+            restore_accents(result, row["original"])
+    if "marked" in keys:
+        result["pages"] = page_numbers(row["marked"] or "")
+    return result
+
+
+async def search(
+    query: str,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    snippets: bool = False,
+    ignore_accents: bool = False,
+    pages: bool = False,
+) -> Tuple[List[dict], Optional[str]]:
+    statement = build_search(query, limit, cursor, snippets, ignore_accents, pages)
+    if statement is None:
+        return [], None
+
+    with metrics.search_seconds.labels("page").time():
+        rows = await database.fetch_all(statement)
+        results = [search_result(row) for row in rows]
+    next_cursor = None
+    if limit is not None and len(rows) == limit:
+        next_cursor = encode_cursor(rows[-1]["rank"], rows[-1]["pid"])
+    return results, next_cursor
+
+
+async def stream_search(
+    query: str,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    snippets: bool = False,
+    ignore_accents: bool = False,
+    pages: bool = False,
+):
+    statement = build_search(query, limit, cursor, snippets, ignore_accents, pages)
+    if statement is None:
+        return
+    started = time.monotonic()
+    async for row in database.iterate(statement):
+        yield json.dumps(search_result(row)) + "\n"
+    metrics.search_seconds.labels("stream").observe(time.monotonic() - started)
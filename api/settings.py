@@ -8,10 +8,68 @@ class Settings(BaseSettings):
     basedir: Path = Path(os.path.dirname(os.path.abspath(__file__))).resolve()
     workdir: Path = "/Users/linhth1/Documents/python/api_converter/workdir"
     base_command_ocr: str = "/usr/local/bin/ocrmypdf"
+    base_command_tesseract: str = "tesseract"
     api_key_secret: str = "123456"
+    # options of the "fast" profile
     base_command_option: str = "--output-type pdf --fast-web-view 0 --optimize 0 --force-ocr"
+    profile_balanced_option: str = "--output-type pdf --optimize 1 --force-ocr --rotate-pages --deskew"
+    profile_archival_option: str = "--output-type pdfa --optimize 2 --force-ocr --rotate-pages --deskew"
+    default_profile: str = "fast"
+    database_url: str = "sqlite:///./test.db"
+    database_pool_min_size: int = 1
+    database_pool_max_size: int = 10
+    sqlite_busy_timeout: float = 30
     max_ocr_process: int = 15
+    # cores shared by the running OCR jobs, 0 for all of them. A job gets
+    # one per pages_per_core pages, at most max_job_cores (0: half of them)
+    cpu_budget: int = 0
+    pages_per_core: int = 4
+    max_job_cores: int = 0
+    # "pool": warm processes calling the ocrmypdf Python API when it is
+    # installed, "subprocess": base_command_ocr for every document
+    ocr_engine: str = "pool"
+    ocr_pool_max_tasks: int = 100
+    # a pool job running longer is killed along with its process
+    ocr_pool_timeout_seconds: float = 3600
+    # "local": OCR jobs run in the API process, "queue": api.worker
+    # processes claim them from the database
+    ocr_mode: str = "local"
+    worker_lease_seconds: float = 60
+    worker_poll_seconds: float = 1
+    worker_metrics_port: int = 0
+    ready_max_queue_depth: int = 500
+    interactive_max_size: int = 1024 * 1024
+    max_upload_size: int = 200 * 1024 * 1024
+    max_request_size: int = 210 * 1024 * 1024
+    max_batch_files: int = 1000
+    max_batch_request_size: int = 4 * 1024 * 1024 * 1024
+    ocr_split_min_pages: int = 100
+    ocr_split_chunk_pages: int = 25
+    ocr_split_workers: int = 0
+    # pages with this much text in the PDF are not OCR'd, 0 disables it
+    text_layer_min_chars: int = 20
+    docx_on_finish: bool = False
+    text_compression: str = "zlib"
+    workdir_shard_depth: int = 2
+    keep_input: bool = True
+    write_state_json: bool = False
+    max_wait_seconds: int = 60
+    events_keepalive_seconds: float = 15
+    webhook_secret: str = ""
+    webhook_batch_seconds: float = 1
+    webhook_batch_size: int = 100
+    webhook_max_attempts: int = 8
+    webhook_retry_base_seconds: float = 1
+    webhook_retry_max_seconds: float = 300
+    webhook_timeout_seconds: float = 10
+    webhook_max_connections: int = 20
+    search_page_size: int = 50
+    search_max_page_size: int = 500
     document_expire_hour: int = 1
+    cleanup_interval_minutes: int = 5
+    cleanup_batch_size: int = 500
+    disk_high_water_percent: float = 90
+    disk_low_water_percent: float = 80
     enable_wsl_compat: bool = False
 
 config = Settings()
\ No newline at end of file
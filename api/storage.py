@@ -0,0 +1,413 @@
+import hashlib
+from collections import Counter
+from itertools import groupby
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+from uuid import UUID
+
+from sqlalchemy import func, select, text
+from starlette.concurrency import run_in_threadpool
+
+from api import database, metrics, search
+from api.database import DBArtifact, DBDocument, DBDocumentPage, DBDocumentText
+from api.settings import config
+from api.text import compress, decompress, split_pages
+
+artifacts = DBArtifact.__table__
+documents = DBDocument.__table__
+texts = DBDocumentText.__table__
+pages = DBDocumentPage.__table__
+
+
+def content_key(digest: str, lang: Iterable[str], options: Optional[str] = None) -> str:
+    """
+    Key of the OCR result for an upload: the same bytes OCR'd with the same
+    languages and options always give the same output.
+    """
+    key = hashlib.sha256(digest.encode())
+    key.update(",".join(sorted(lang)).encode())
+    key.update((config.base_command_option if options is None else options).encode())
+    if config.text_layer_min_chars:
+        # born-digital pages are no longer rasterized in the output
+        key.update(f"text-layer:{config.text_layer_min_chars}".encode())
+    return key.hexdigest()
+
+
+def shard_path(name: str, filename: str) -> Path:
+    """
+    Path of filename in the subdirectory of workdir for name, a pid or a
+    content key: workdir/3f/a2/filename for "3fa2...". Keeps every
+    directory small however many documents are stored.
+    """
+    directory = config.workdir
+    for level in range(config.workdir_shard_depth):
+        directory = directory / name[level * 2:level * 2 + 2]
+    directory.mkdir(parents=True, exist_ok=True)
+    return directory / filename
+
+
+def artifact_paths(key: str) -> Tuple[Path, Path]:
+    return shard_path(key, f"c_{key}.pdf"), shard_path(key, f"c_{key}.txt")
+
+
+def document_paths(pid: str) -> Tuple[Path, Path]:
+    # output of a document sharing no artifact
+    name = UUID(pid).hex
+    return shard_path(name, f"o_{pid}.pdf"), shard_path(name, f"o_{pid}.txt")
+
+
+def docx_path(output_txt) -> Path:
+    return Path(output_txt).with_suffix(".docx")
+
+
+def delete_files(*paths) -> int:
+    """
+    Delete the files that exist, returning the number of bytes freed
+    """
+    freed = 0
+    for path in paths:
+        path = Path(path)
+        if path.exists():
+            freed += path.stat().st_size
+            path.unlink()
+    return freed
+
+
+def text_key(doc) -> str:
+    return doc["content_key"] or str(doc["pid"])
+
+
+def page_rows(key: str, content: str) -> List[dict]:
+    """
+    DBDocumentPage rows of an OCR text, each page compressed on its own
+    """
+    rows = []
+    for number, (start, page) in enumerate(split_pages(content), 1):
+        encoding, data = compress(page, config.text_compression)
+        rows.append(
+            {
+                "key": key,
+                "page": number,
+                "start": start,
+                "size": len(page),
+                "encoding": encoding,
+                "data": data,
+            }
+        )
+    return rows
+
+
+def join_pages(rows) -> str:
+    return "\f".join(decompress(row["encoding"], row["data"]) for row in rows)
+
+
+async def save_text(key: str, content: str):
+    with metrics.stage_seconds.labels("store_text").time():
+        rows = await run_in_threadpool(page_rows, key, content)
+        async with database.transaction():
+            await delete_texts([key])
+            await database.execute(
+                texts.insert().values(
+                    key=key,
+                    encoding=config.text_compression,
+                    data=b"",
+                    size=len(content),
+                    pages=len(rows),
+                )
+            )
+            await database.execute(pages.insert().values(rows))
+
+
+async def page_count_of(key: str) -> Optional[int]:
+    """
+    Number of pages of an OCR text, None when it is not stored
+    """
+    row = await database.fetch_one(select([texts.c.pages]).where(texts.c.key == key))
+    return row["pages"] if row else None
+
+
+async def load_text(key: str) -> Optional[str]:
+    rows = await database.fetch_all(
+        pages.select().where(pages.c.key == key).order_by(pages.c.page)
+    )
+    if not rows:
+        return None
+    return await run_in_threadpool(join_pages, rows)
+
+
+async def load_pages(key: str, first: int, last: int) -> List[str]:
+    """
+    Pages first to last (1-based, inclusive) of an OCR text, reading only
+    their rows
+    """
+    rows = await database.fetch_all(
+        pages.select()
+        .where((pages.c.key == key) & pages.c.page.between(first, last))
+        .order_by(pages.c.page)
+    )
+    return [decompress(row["encoding"], row["data"]) for row in rows]
+
+
+async def page_offsets(key: str, count: int) -> List[dict]:
+    """
+    Offset and length in the OCR text of its first count pages
+    """
+    rows = await database.fetch_all(
+        select([pages.c.page, pages.c.start, pages.c.size])
+        .where((pages.c.key == key) & (pages.c.page <= count))
+        .order_by(pages.c.page)
+    )
+    return [dict(page=row["page"], start=row["start"], size=row["size"]) for row in rows]
+
+
+async def load_document_text(doc) -> Optional[str]:
+    """
+    OCR text of a document, from the database or else from the sidecar file
+    of documents OCR'd before texts were stored there.
+    """
+    content = await load_text(text_key(doc))
+    path = Path(doc["output_txt"])
+    if content is None and path.exists():
+        content = await run_in_threadpool(path.read_text, encoding="utf-8")
+    return content
+
+
+async def load_texts(keys: List[str]) -> Dict[str, str]:
+    rows = await database.fetch_all(
+        pages.select().where(pages.c.key.in_(keys)).order_by(pages.c.key, pages.c.page)
+    )
+    return {
+        key: await run_in_threadpool(join_pages, list(group))
+        for key, group in groupby(rows, key=lambda row: row["key"])
+    }
+
+
+async def delete_texts(keys: List[str]):
+    if keys:
+        await database.execute(pages.delete().where(pages.c.key.in_(keys)))
+        await database.execute(texts.delete().where(texts.c.key.in_(keys)))
+
+
+async def get_artifact(key: str):
+    return await database.fetch_one(artifacts.select().where(artifacts.c.key == key))
+
+
+async def acquire_artifacts(documents) -> Dict[str, object]:
+    """
+    Take a reference on the artifact of each document, creating it with the
+    document as leader when nobody produced it yet. Returns the artifacts by
+    key.
+    """
+    async with database.transaction():
+        for document in documents:
+            await database.execute(
+                text(
+                    "INSERT INTO artifacts "
+                    "(key, leader, status, output, output_txt, refcount) "
+                    "VALUES (:key, :pid, 'processing', :output, :output_txt, 1) "
+                    "ON CONFLICT (key) DO UPDATE SET refcount = artifacts.refcount + 1"
+                ).bindparams(
+                    key=document.content_key,
+                    pid=str(document.pid),
+                    output=str(document.output.resolve()),
+                    output_txt=str(document.output_txt.resolve()),
+                )
+            )
+    rows = await database.fetch_all(
+        artifacts.select().where(
+            artifacts.c.key.in_({document.content_key for document in documents})
+        )
+    )
+    return {row["key"]: row for row in rows}
+
+
+async def publish_artifact(key: str) -> bool:
+    """
+    Mark the artifact as done. When every reference went away while it was
+    being produced, its files are removed and False is returned.
+    """
+    await database.execute(
+        artifacts.update().where(artifacts.c.key == key).values(status="done")
+    )
+    if await get_artifact(key) is None:
+        output, output_txt = artifact_paths(key)
+        await run_in_threadpool(delete_files, output, output_txt, docx_path(output_txt))
+        return False
+    return True
+
+
+async def drop_artifact(key: str):
+    artifact = await get_artifact(key)
+    await database.execute(artifacts.delete().where(artifacts.c.key == key))
+    if artifact is not None:
+        await run_in_threadpool(
+            delete_files,
+            artifact["output"],
+            artifact["output_txt"],
+            docx_path(artifact["output_txt"]),
+        )
+
+
+async def release_artifacts(references: Dict[str, int]) -> List[str]:
+    """
+    Drop references to artifacts, deleting the ones nobody references
+    anymore. Returns the paths of the files to remove.
+    """
+    if not references:
+        return []
+
+    async with database.transaction():
+        for key, count in references.items():
+            await database.execute(
+                artifacts.update()
+                .where(artifacts.c.key == key)
+                .values(refcount=artifacts.c.refcount - count)
+            )
+        unused = await database.fetch_all(
+            artifacts.select().where(
+                artifacts.c.key.in_(list(references)) & (artifacts.c.refcount <= 0)
+            )
+        )
+        if unused:
+            unused_keys = [artifact["key"] for artifact in unused]
+            await database.execute(
+                artifacts.delete().where(artifacts.c.key.in_(unused_keys))
+            )
+            await delete_texts(unused_keys)
+            await search.remove_texts(unused_keys)
+
+    return [
+        path
+        for artifact in unused
+        for path in (
+            artifact["output"],
+            artifact["output_txt"],
+            docx_path(artifact["output_txt"]),
+        )
+    ]
+
+
+async def hand_over_artifacts(docs: Sequence):
+    """
+    Make another upload waiting for the same output the leader of each
+    artifact a deleted document was queued to produce, its job then OCRs
+    that upload's input instead.
+    """
+    pids = [str(doc["pid"]) for doc in docs]
+    for doc in docs:
+        if doc["status"] != "received" or not doc["content_key"]:
+            continue
+        artifact = await get_artifact(doc["content_key"])
+        if (
+            artifact is None
+            or artifact["status"] != "processing"
+            or artifact["leader"] != str(doc["pid"])
+        ):
+            continue
+        follower = await database.fetch_one(
+            select([documents.c.pid])
+            .where(
+                (documents.c.content_key == doc["content_key"])
+                & (documents.c.status == "received")
+                & documents.c.pid.notin_(pids)
+            )
+            .order_by(documents.c.created)
+            .limit(1)
+        )
+        if follower is not None:
+            await database.execute(
+                artifacts.update()
+                .where(artifacts.c.key == doc["content_key"])
+                .values(leader=follower["pid"])
+            )
+
+
+async def artifact_owned(paths: List[str]) -> Set[str]:
+    """
+    The paths among paths an artifact owns, only release_artifacts removes
+    those
+    """
+    rows = await database.fetch_all(
+        select([artifacts.c.output, artifacts.c.output_txt]).where(
+            artifacts.c.output.in_(paths) | artifacts.c.output_txt.in_(paths)
+        )
+    )
+    owned = set()
+    for row in rows:
+        owned.update((row["output"], row["output_txt"], str(docx_path(row["output_txt"]))))
+    return owned
+
+
+async def delete_documents(docs: Sequence) -> int:
+    """
+    Delete documents with their rows, index entries and files, returning the
+    number of bytes freed. Shared OCR output is only removed with the last
+    document referencing it, even from a document which no longer shares
+    it. The input of a job being OCR'd is left to the job, which removes it
+    once done.
+    """
+    if not docs:
+        return 0
+
+    await hand_over_artifacts(docs)
+    pids = [doc["pid"] for doc in docs]
+    await database.execute(documents.delete().where(documents.c.pid.in_(pids)))
+    keys = [str(doc["pid"]) for doc in docs if not doc["content_key"]]
+    await delete_texts(keys)
+    await search.remove_texts(keys)
+
+    paths = []
+    outputs = []
+    for doc in docs:
+        if doc["status"] != "processing":
+            paths.append(doc["input"])
+        paths.append(doc["output_json"])
+        if not doc["content_key"]:
+            outputs += [doc["output"], doc["output_txt"], str(docx_path(doc["output_txt"]))]
+    if outputs:
+        owned = await artifact_owned(outputs)
+        paths += [path for path in outputs if path not in owned]
+    paths += await release_artifacts(
+        Counter(doc["content_key"] for doc in docs if doc["content_key"])
+    )
+    return await run_in_threadpool(delete_files, *paths)
+
+
+def file_sizes(*paths) -> List[int]:
+    return [Path(path).stat().st_size if path and Path(path).exists() else 0 for path in paths]
+
+
+async def footprint(doc) -> dict:
+    """
+    Bytes used by a document. Output shared with identical uploads is
+    counted in full under the files, and divided between the documents
+    sharing it in `attributed`.
+    """
+    key = text_key(doc)
+    text_row = await database.fetch_one(
+        select([func.sum(func.length(pages.c.data)).label("stored"), texts.c.size])
+        .select_from(texts.outerjoin(pages, pages.c.key == texts.c.key))
+        .where(texts.c.key == key)
+        .group_by(texts.c.size)
+    )
+    artifact = await get_artifact(doc["content_key"]) if doc["content_key"] else None
+    shared_by = artifact["refcount"] if artifact else 1
+
+    docx = doc["output_docx"] or docx_path(doc["output_txt"])
+    sizes = await run_in_threadpool(
+        file_sizes, doc["input"], doc["output_json"], doc["output"], doc["output_txt"], docx
+    )
+    files = dict(zip(["input", "state", "output", "output_txt", "docx"], sizes))
+    text_size = (text_row["stored"] or 0) if text_row else 0
+    own = files["input"] + files["state"]
+    shared = files["output"] + files["output_txt"] + files["docx"] + text_size
+    return {
+        "files": files,
+        "text": {
+            "stored": text_size,
+            "size": text_row["size"] if text_row else 0,
+        },
+        "shared_by": shared_by,
+        "total": own + shared,
+        "attributed": own + shared // max(shared_by, 1),
+    }
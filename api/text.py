@@ -0,0 +1,99 @@
+import re
+import unicodedata
+import zlib
+from typing import List, Optional, Tuple
+
+# a word broken over two lines by OCR: "docu-\nment"
+HYPHENATED = re.compile(r"(\w)-[ \t]*\n[ \t]*(\w)")
+SPACES = re.compile(r"[^\S\n\f]+")
+
+
+class _FoldTable(dict):
+    """
+    str.translate table mapping every character to its base letter. Built
+    lazily one character at a time and always one character for one, so
+    folded text keeps the offsets of the normalized text.
+    """
+
+    def __missing__(self, char: int) -> str:
+        base = "".join(
+            c
+            for c in unicodedata.normalize("NFD", chr(char))
+            if not unicodedata.combining(c)
+        )
+        self[char] = base if len(base) == 1 else chr(char)
+        return self[char]
+
+
+_fold_table = _FoldTable({ord("đ"): "d", ord("Đ"): "D"})
+
+
+def _join_hyphenated(match) -> str:
+    if match.group(2).islower():
+        return match.group(1) + match.group(2)
+    return match.group(0)
+
+
+def normalize(text: str) -> str:
+    """
+    Normalize OCR output: compose diacritics (NFC), rejoin words hyphenated
+    across line breaks and collapse runs of spaces. Line breaks and form
+    feeds are kept.
+    """
+    text = unicodedata.normalize("NFC", text)
+    text = HYPHENATED.sub(_join_hyphenated, text)
+    return SPACES.sub(" ", text)
+
+
+def fold(text: str) -> str:
+    """
+    Strip accents from normalized text ("Tiếng Việt" -> "Tieng Viet").
+    """
+    return text.translate(_fold_table)
+
+
+def split_pages(text: str) -> List[Tuple[int, str]]:
+    """
+    Split OCR text on the form feeds separating its pages, returning the
+    offset of every page in text along with it. Joining the pages with form
+    feeds gives back text.
+    """
+    pages = []
+    start = 0
+    for page in text.split("\f"):
+        pages.append((start, page))
+        start += len(page) + 1
+    return pages
+
+
+def parse_page_range(pages: str) -> Tuple[int, Optional[int]]:
+    """
+    Parse a 1-based, inclusive page range: "3", "10-20" or "10-" for every
+    page from the tenth. The last page is None when open ended.
+    """
+    first, separator, last = pages.partition("-")
+    try:
+        start = int(first)
+        end = (int(last) if last else None) if separator else start
+    except ValueError as e:
+        raise ValueError(f"Invalid page range: {pages}") from e
+    if start < 1 or (end is not None and end < start):
+        raise ValueError(f"Invalid page range: {pages}")
+    return start, end
+
+
+def compress(text: str, encoding: str = "zlib") -> Tuple[str, bytes]:
+    """
+    Encode text for storage, returning the encoding actually used along
+    with the bytes: "zlib" or "plain".
+    """
+    data = text.encode("utf-8")
+    if encoding == "zlib":
+        return "zlib", zlib.compress(data)
+    return "plain", data
+
+
+def decompress(encoding: str, data: bytes) -> str:
+    if encoding == "zlib":
+        data = zlib.decompress(data)
+    return data.decode("utf-8")
@@ -1,15 +1,249 @@
-import shutil
-from pathlib import Path
+import hashlib
+import io
+import os
+import time
+import zipfile
+from email.utils import parsedate_to_datetime
+from pathlib import Path, PurePosixPath
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from uuid import uuid4
 
-from fastapi import UploadFile
+import aiofiles
+from docx import Document as DocxDocument
+from fastapi import HTTPException, Request, Response, UploadFile
+from fastapi.responses import FileResponse, JSONResponse
 
+from api import metrics
 
-def save_upload_file(upload_file: UploadFile, destination: Path) -> None:
+CHUNK_SIZE = 1024 * 1024
+# the PDF header has to appear in the first 1024 bytes of the file
+PDF_HEADER = b"%PDF-"
+ZIP_HEADER = b"PK\x03\x04"
+
+
+def is_zip(upload_file: UploadFile) -> bool:
+    return upload_file.content_type in (
+        "application/zip",
+        "application/x-zip-compressed",
+    ) or (upload_file.filename or "").lower().endswith(".zip")
+
+
+async def save_upload_file(
+    upload_file: UploadFile, destination: Path, max_size: int, header: bytes = PDF_HEADER
+) -> str:
+    """
+    Stream the upload to destination in chunks, checking it is a PDF (or
+    whatever file starts with header) of at most max_size bytes on the way.
+    Returns the SHA-256 of its content.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    started = time.monotonic()
     try:
-        with destination.open("wb") as buffer:
-            shutil.copyfileobj(upload_file.file, buffer)
+        async with aiofiles.open(str(destination), "wb") as buffer:
+            chunk = await upload_file.read(CHUNK_SIZE)
+            if header not in chunk[:1024]:
+                kind = "a PDF" if header == PDF_HEADER else "a ZIP archive"
+                raise HTTPException(status_code=415, detail=f"File is not {kind}")
+
+            while chunk:
+                size += len(chunk)
+                if size > max_size:
+                    raise HTTPException(status_code=413, detail="File too large")
+                digest.update(chunk)
+                await buffer.write(chunk)
+                chunk = await upload_file.read(CHUNK_SIZE)
+    except HTTPException:
+        destination.unlink()
+        raise
     finally:
-        upload_file.file.close()
+        await upload_file.close()
+    metrics.stage_seconds.labels("upload").observe(time.monotonic() - started)
+    return digest.hexdigest()
+
+
+def write_docx(content: str, destination: Path):
+    """
+    Convert OCR text to DOCX, one paragraph per line and a page break per
+    form feed. The file is renamed into place so concurrent readers never
+    see a partial document.
+    """
+    document = DocxDocument()
+    with io.StringIO(content) as txt_file:
+        for line in txt_file:
+            pages = line.split("\f")
+            for index, text in enumerate(pages):
+                if index:
+                    document.add_page_break()
+                if text.strip() or len(pages) == 1:
+                    document.add_paragraph(text.strip())
+
+    partial = destination.with_name(f".{uuid4().hex}.{destination.name}")
+    document.save(str(partial))
+    partial.replace(destination)
+
+
+def extract_pdfs(
+    archive: Path,
+    max_size: int,
+    max_files: int,
+    destination: Callable[[], Tuple[object, Path]],
+) -> List[Tuple[object, Path, str, str]]:
+    """
+    Extract the PDFs of a ZIP archive, each to the path returned by
+    destination() along with its id. Other members are skipped. Returns
+    (id, path, sha256, name) for every PDF; nothing is left on disk when a
+    member is invalid.
+    """
+    extracted = []
+    try:
+        with zipfile.ZipFile(str(archive)) as zip_file:
+            for member in zip_file.infolist():
+                name = PurePosixPath(member.filename).name
+                if (
+                    member.is_dir()
+                    or name.startswith(".")
+                    or not name.lower().endswith(".pdf")
+                ):
+                    continue
+                if len(extracted) >= max_files:
+                    raise HTTPException(status_code=413, detail="Too many files")
+                if member.file_size > max_size:
+                    raise HTTPException(status_code=413, detail=f"{name} too large")
+
+                pid, path = destination()
+                extracted.append((pid, path, "", name))
+                digest = hashlib.sha256()
+                size = 0
+                with zip_file.open(member) as source, path.open("wb") as target:
+                    chunk = source.read(CHUNK_SIZE)
+                    if PDF_HEADER not in chunk[:1024]:
+                        raise HTTPException(
+                            status_code=415, detail=f"{name} is not a PDF"
+                        )
+                    while chunk:
+                        # file_size is only what the archive claims
+                        size += len(chunk)
+                        if size > max_size:
+                            raise HTTPException(
+                                status_code=413, detail=f"{name} too large"
+                            )
+                        digest.update(chunk)
+                        target.write(chunk)
+                        chunk = source.read(CHUNK_SIZE)
+                extracted[-1] = (pid, path, digest.hexdigest(), name)
+    except zipfile.BadZipFile:
+        remove_files([path for _, path, _, _ in extracted])
+        raise HTTPException(status_code=400, detail="Invalid ZIP archive")
+    except BaseException:
+        remove_files([path for _, path, _, _ in extracted])
+        raise
+    return extracted
+
+
+def remove_files(paths: List[Path]):
+    for path in paths:
+        if path.exists():
+            path.unlink()
+
+
+def write_results_zip(entries: List[Tuple[str, Union[Path, str]]], destination: Path):
+    """
+    Write (name, path or text) entries to a ZIP archive, skipping missing
+    files. PDFs are stored as is, they hardly compress anyway.
+    """
+    with zipfile.ZipFile(str(destination), "w") as zip_file:
+        for name, path in entries:
+            if isinstance(path, str):
+                zip_file.writestr(name, path, compress_type=zipfile.ZIP_DEFLATED)
+                continue
+            if not path.exists():
+                continue
+            compression = (
+                zipfile.ZIP_STORED
+                if path.suffix == ".pdf"
+                else zipfile.ZIP_DEFLATED
+            )
+            zip_file.write(str(path), name, compress_type=compression)
+
+
+class DownloadResponse(FileResponse):
+    chunk_size = CHUNK_SIZE
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(
+        tag.replace("W/", "", 1).strip('"') == etag for tag in tags
+    )
+
+
+def file_response(request: Request, path: Path, media_type: str, filename: str) -> Response:
+    """
+    Serve a file with ETag/Last-Modified headers, answering 304 Not Modified
+    to conditional requests for the version the client already has.
+    """
+    response = DownloadResponse(
+        str(path), media_type=media_type, filename=filename, stat_result=os.stat(path)
+    )
+    validators = {
+        "etag": response.headers["etag"],
+        "last-modified": response.headers["last-modified"],
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_none_match is not None:
+        not_modified = etag_matches(if_none_match, validators["etag"])
+    elif if_modified_since is not None:
+        try:
+            not_modified = parsedate_to_datetime(
+                validators["last-modified"]
+            ) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            not_modified = False
+    else:
+        not_modified = False
+
+    if not_modified:
+        return Response(status_code=304, headers=validators)
+    return response
+
+
+def text_response(request: Request, content: str, etag: str, filename: str) -> Response:
+    """
+    Serve text that is not on disk as a download, answering 304 Not
+    Modified when the client already has this etag.
+    """
+    headers = {"etag": f'"{etag}"'}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    headers["content-disposition"] = f'attachment; filename="{filename}"'
+    return Response(content, media_type="text/plain; charset=utf-8", headers=headers)
+
+
+class RequestSizeLimit:
+    """
+    ASGI middleware refusing POST bodies announced larger than max_size
+    before they are read and spooled to disk. Paths listed in overrides get
+    their own limit.
+    """
+
+    def __init__(self, app, max_size: int, overrides: Optional[Dict[str, int]] = None):
+        self.app = app
+        self.max_size = max_size
+        self.overrides = overrides or {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST":
+            max_size = self.overrides.get(scope["path"], self.max_size)
+            length = dict(scope["headers"]).get(b"content-length", b"")
+            if length.isdigit() and int(length) > max_size:
+                response = JSONResponse({"detail": "Request too large"}, status_code=413)
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
 
 
 def special_win_wslpath(path: Path) -> str:
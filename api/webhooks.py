@@ -0,0 +1,179 @@
+"""
+Completion callbacks. Documents uploaded with a callback_url are reported
+to it once done or failed: completions are collected for a short window
+and sent as one signed POST per URL, retried with exponential backoff.
+Deliveries pending when the service stops are lost.
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import time
+from collections import defaultdict
+from typing import List, Optional, Set
+
+import httpx
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select
+
+from api import database, events
+from api.database import DBDocument
+from api.settings import config
+
+logger = logging.getLogger("gunicorn.error")
+
+documents = DBDocument.__table__
+
+client: Optional[httpx.AsyncClient] = None
+queue: Optional[asyncio.Queue] = None
+tasks: Set[asyncio.Future] = set()
+
+
+def sign(body: bytes, timestamp: str) -> str:
+    """
+    HMAC-SHA256 of "<timestamp>.<body>", sent in X-Signature so receivers
+    can check the call comes from us and is recent.
+    """
+    secret = (config.webhook_secret or config.api_key_secret).encode()
+    return hmac.new(secret, timestamp.encode() + b"." + body, hashlib.sha256).hexdigest()
+
+
+def retry_delay(attempt: int) -> float:
+    return min(
+        config.webhook_retry_base_seconds * 2 ** (attempt - 1),
+        config.webhook_retry_max_seconds,
+    )
+
+
+async def deliver(http: httpx.AsyncClient, url: str, notifications: List[dict]) -> bool:
+    body = json.dumps({"documents": jsonable_encoder(notifications)}).encode()
+    for attempt in range(config.webhook_max_attempts):
+        if attempt:
+            await asyncio.sleep(retry_delay(attempt))
+        timestamp = str(int(time.time()))
+        try:
+            response = await http.post(
+                url,
+                content=body,
+                headers={
+                    "Content-Type": "application/json",
+                    "X-Timestamp": timestamp,
+                    "X-Signature": f"sha256={sign(body, timestamp)}",
+                },
+            )
+        except httpx.HTTPError as e:
+            logger.warning("Callback to %s failed: %r", url, e)
+            continue
+        if response.status_code < 300:
+            return True
+        logger.warning("Callback to %s answered %d", url, response.status_code)
+        # the receiver refused the call, sending it again won't help
+        if response.status_code < 500 and response.status_code != 429:
+            break
+    logger.error("Giving up on callback to %s for %d documents", url, len(notifications))
+    return False
+
+
+def on_event(event: dict):
+    if event["status"] in events.FINAL and queue is not None:
+        queue.put_nowait(event)
+
+
+async def collect() -> List[dict]:
+    """
+    Wait for a completion, then gather the ones following it for up to
+    config.webhook_batch_seconds
+    """
+    batch = [await queue.get()]
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + config.webhook_batch_seconds
+    while len(batch) < config.webhook_batch_size:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), remaining))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+
+def notification(event: dict, row) -> dict:
+    pid = event["pid"]
+    return {
+        "pid": pid,
+        "status": event["status"],
+        "code": event.get("code"),
+        "finished": event.get("finished"),
+        "file_name": row["file_name"],
+        "links": {
+            "document": f"/ocr/{pid}",
+            "pdf": f"/ocr/{pid}/pdf",
+            "txt": f"/ocr/{pid}/txt",
+        },
+    }
+
+
+async def dispatch(batch: List[dict]):
+    """
+    Start the delivery of a batch of completions, one call per callback URL
+    """
+    rows = await database.fetch_all(
+        select([documents.c.pid, documents.c.file_name, documents.c.callback_url]).where(
+            documents.c.pid.in_([event["pid"] for event in batch])
+            & documents.c.callback_url.isnot(None)
+        )
+    )
+    found = {row["pid"]: row for row in rows}
+
+    by_url = defaultdict(list)
+    for event in batch:
+        row = found.get(event["pid"])
+        if row is not None:
+            by_url[row["callback_url"]].append(notification(event, row))
+    for url, notifications in by_url.items():
+        task = asyncio.ensure_future(deliver(client, url, notifications))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+
+async def dispatcher():
+    while True:
+        batch = await collect()
+        # a failing database must not end the deliveries, the batch is
+        # tried again like a failed call
+        for attempt in range(1, config.webhook_max_attempts + 1):
+            try:
+                await dispatch(batch)
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(
+                    "Could not dispatch callbacks for %d documents", len(batch)
+                )
+                await asyncio.sleep(retry_delay(attempt))
+
+
+def start():
+    global client, queue
+    client = httpx.AsyncClient(
+        timeout=config.webhook_timeout_seconds,
+        limits=httpx.Limits(max_connections=config.webhook_max_connections),
+    )
+    queue = asyncio.Queue()
+    events.subscribe(on_event)
+    tasks.add(asyncio.ensure_future(dispatcher()))
+
+
+async def stop():
+    global client, queue
+    events.unsubscribe(on_event)
+    for task in list(tasks):
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    tasks.clear()
+    if client is not None:
+        await client.aclose()
+    client = queue = None
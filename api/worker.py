@@ -0,0 +1,209 @@
+"""
+OCR worker for queue mode (config.ocr_mode = "queue"), where the API only
+records uploads. Workers claim pending documents from the database under a
+lease, renewed while their OCR runs; a document whose lease ran out, its
+worker having died, is claimed again by another one. Run as many as needed
+on any node sharing the workdir and the database:
+
+    OCR_MODE=queue python -m api.worker
+
+Each worker runs up to config.max_ocr_process jobs at a time, sharing its
+config.cpu_budget cores between them. SIGTERM stops claiming and waits for
+the running jobs, a second one exits at once.
+"""
+import asyncio
+import logging
+import os
+import signal
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+from prometheus_client import start_http_server
+from sqlalchemy import select
+from starlette.concurrency import run_in_threadpool
+
+from api import database, engine, health, jobs, migrations, pool, webhooks
+from api.database import DBDocument, document_columns
+from api.models import Document
+from api.scheduler import Priority
+from api.settings import config
+
+logger = logging.getLogger("gunicorn.error")
+
+documents = DBDocument.__table__
+
+worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def lease_expire() -> datetime:
+    return datetime.now() + timedelta(seconds=config.worker_lease_seconds)
+
+
+def claimable(now: datetime):
+    # new jobs, and jobs of workers which stopped renewing their lease
+    return (
+        (documents.c.status == "received")
+        | ((documents.c.status == "processing") & (documents.c.lease_expire < now))
+    ) & jobs.is_job()
+
+
+def build_claim(token: str, limit: int, now: datetime):
+    """
+    Statement leasing up to limit jobs to token, interactive ones first and
+    then the oldest. A single UPDATE, so two workers never claim the same
+    job; on PostgreSQL the rows locked by a concurrent claim are skipped
+    rather than waited for.
+    """
+    candidates = (
+        select([documents.c.pid])
+        .where(claimable(now))
+        .order_by(
+            (documents.c.priority == Priority.interactive.value).desc(),
+            documents.c.created,
+        )
+        .limit(limit)
+    )
+    if database.backend == "postgresql":
+        candidates = candidates.with_for_update(skip_locked=True)
+    return (
+        documents.update()
+        .where(documents.c.pid.in_(candidates))
+        .values(status="processing", worker=token, lease_expire=lease_expire())
+    )
+
+
+def retry_delay(failures: int) -> float:
+    # polling slower while claims fail, up to once a lease
+    return min(
+        config.worker_poll_seconds * 2 ** min(failures, 16), config.worker_lease_seconds
+    )
+
+
+async def claim(limit: int) -> Tuple[str, List[Document]]:
+    token = f"{worker_id}:{uuid.uuid4().hex}"
+    await database.execute(build_claim(token, limit, datetime.now()))
+    rows = await database.fetch_all(
+        select(document_columns).where(documents.c.worker == token)
+    )
+    return token, [Document.from_row(row) for row in rows]
+
+
+async def heartbeat(token: str, pid: str, job: asyncio.Future):
+    """
+    Renew the lease of a running job. A database failing for as long as
+    the lease lasts lets it expire, another worker may claim the job: it is
+    cancelled then.
+    """
+    loop = asyncio.get_event_loop()
+    renewed = loop.time()
+    while True:
+        await asyncio.sleep(config.worker_lease_seconds / 3)
+        try:
+            await database.execute(
+                documents.update()
+                .where((documents.c.pid == pid) & (documents.c.worker == token))
+                .values(lease_expire=lease_expire())
+            )
+            renewed = loop.time()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Could not renew the lease of OCR job %s", pid)
+            if loop.time() - renewed >= config.worker_lease_seconds:
+                logger.error("Lease of OCR job %s expired, cancelling it", pid)
+                job.cancel()
+                return
+
+
+async def run(token: str, document: Document):
+    job = asyncio.ensure_future(jobs.run_job(document, token))
+    renew = asyncio.ensure_future(heartbeat(token, str(document.pid), job))
+    try:
+        await job
+    except asyncio.CancelledError:
+        if not renew.done():
+            raise
+        # cancelled by the heartbeat, the job is another worker's by now
+    except Exception as e:
+        await jobs.fail_job(document, e, token)
+    finally:
+        renew.cancel()
+
+
+async def serve(stopping: asyncio.Event):
+    # running jobs with the cores they were granted
+    running: Dict[asyncio.Future, int] = {}
+    cores = jobs.cpu_budget()
+    # claims failed in a row, the database being down
+    failures = 0
+    while not stopping.is_set():
+        free = min(config.max_ocr_process - len(running), cores - sum(running.values()))
+        if free > 0:
+            # every query in a task of its own: the database connection is
+            # bound to the context, jobs started from here must not share it
+            try:
+                token, claimed = await asyncio.ensure_future(claim(free))
+                failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Could not claim OCR jobs")
+                claimed = []
+                failures += 1
+            for index, document in enumerate(claimed):
+                document.pages = await run_in_threadpool(engine.page_count, document.input)
+                # at least a core left for each of the other claimed jobs
+                left = cores - sum(running.values()) - (len(claimed) - index - 1)
+                document.cpu_jobs = max(1, min(jobs.core_demand(document), left))
+                task = asyncio.ensure_future(run(token, document))
+                running[task] = document.cpu_jobs
+                task.add_done_callback(lambda task: running.pop(task, None))
+
+        stop = asyncio.ensure_future(stopping.wait())
+        await asyncio.wait(
+            [stop, *running],
+            timeout=retry_delay(failures),
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        stop.cancel()
+
+    if running:
+        logger.info("Waiting for %d OCR jobs to finish", len(running))
+        await asyncio.gather(*running, return_exceptions=True)
+
+
+def stop(stopping: asyncio.Event):
+    if stopping.is_set():
+        # the leases of the jobs left running expire, other workers take them
+        os._exit(1)
+    stopping.set()
+
+
+async def main():
+    await run_in_threadpool(migrations.migrate)
+    await database.connect()
+    await run_in_threadpool(health.detect)
+    await run_in_threadpool(pool.start)
+    webhooks.start()
+    if config.worker_metrics_port:
+        start_http_server(config.worker_metrics_port)
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop, stopping)
+
+    logger.info("OCR worker %s running %d jobs at a time", worker_id, config.max_ocr_process)
+    try:
+        await serve(stopping)
+    finally:
+        await run_in_threadpool(pool.stop)
+        await webhooks.stop()
+        await database.disconnect()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
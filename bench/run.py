@@ -0,0 +1,328 @@
+"""
+Throughput benchmark of the API with a stub OCR engine.
+
+    python -m bench.run --documents 200 --concurrency 1,8,32 --output bench.json
+    python -m bench.run --baseline bench.json
+
+Uploads a synthetic corpus of distinct PDFs through POST /ocr, waits for
+them to be OCR'd by bench/stub_ocr.py, then times the download, listing and
+search endpoints at each concurrency level. The app runs in process on a
+fresh workdir and SQLite database unless --url points at a running server,
+which then has to be configured with the stub itself. Results are written
+as JSON; with --baseline the difference to an earlier run is printed.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from bench.stub_ocr import VOCABULARY
+
+STUB = Path(__file__).resolve().parent / "stub_ocr.py"
+
+DOWNLOADS = ["pdf", "txt", "docx"]
+
+
+def percentile(values: List[float], percent: float) -> float:
+    # nearest rank
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(int(round(percent / 100 * len(ordered))), 1)
+    return ordered[rank - 1]
+
+
+def summarize(
+    scenario: str, concurrency: int, latencies: List[float], errors: int, elapsed: float
+) -> dict:
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def synthetic_pdf(number: int, size: int, pages: int = 1) -> bytes:
+    """
+    Valid PDF of blank pages, padded to about size bytes with an unused
+    stream of random bytes: identical uploads would share one OCR run.
+    """
+    kids = " ".join(f"{3 + page} 0 R" for page in range(pages))
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>".encode(),
+    ]
+    objects += [b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << >> >>"] * pages
+    padding = os.urandom(max(size - 200 - 60 * pages, 0))
+    objects.append(
+        f"<< /Length {len(padding)} >>\nstream\n".encode() + padding + b"\nendstream"
+    )
+
+    document = f"%PDF-1.4\n% bench document {number}\n".encode()
+    offsets = []
+    for index, content in enumerate(objects, 1):
+        offsets.append(len(document))
+        document += f"{index} 0 obj\n".encode() + content + b"\nendobj\n"
+    xref = len(document)
+    document += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    document += b"".join(f"{offset:010d} 00000 n \n".encode() for offset in offsets)
+    document += (
+        f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+        f"startxref\n{xref}\n%%EOF\n"
+    ).encode()
+    return document
+
+
+async def run_load(
+    scenario: str,
+    concurrency: int,
+    total: int,
+    request: Callable[[int], Awaitable[httpx.Response]],
+) -> dict:
+    """
+    Send total requests from concurrency concurrent workers, request(i)
+    sending the i-th one and returning its response.
+    """
+    latencies: List[float] = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for number in counter:
+            started = time.perf_counter()
+            try:
+                response = await request(number)
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            if failed:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(scenario, concurrency, latencies, errors, time.perf_counter() - started)
+
+
+async def upload_corpus(client, args, concurrency: int) -> Tuple[dict, List[str]]:
+    pids: List[str] = []
+
+    async def upload(number: int):
+        response = await client.post(
+            "/ocr",
+            files={"file": (f"bench_{number}.pdf", synthetic_pdf(number, args.size, args.pages), "application/pdf")},
+        )
+        if response.status_code == 200:
+            pids.append(response.json()["pid"])
+        return response
+
+    result = await run_load("upload", concurrency, args.documents, upload)
+    return result, pids
+
+
+async def wait_done(client, pids: List[str], timeout: float) -> int:
+    """
+    Wait for the documents to be OCR'd, returning how many failed
+    """
+    deadline = time.monotonic() + timeout
+    failed = 0
+    for pid in pids:
+        while True:
+            document = (await client.get(f"/ocr/{pid}", params={"wait": 10})).json()
+            if document["status"] in ("done", "error"):
+                failed += document["status"] == "error"
+                break
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Document {pid} not OCR'd after {timeout}s")
+    return failed
+
+
+async def benchmark(client, args) -> List[dict]:
+    results = []
+    pids: List[str] = []
+    for concurrency in args.concurrency:
+        result, uploaded = await upload_corpus(client, args, concurrency)
+        results.append(result)
+        pids += uploaded
+        print(json.dumps(result), file=sys.stderr)
+
+    started = time.perf_counter()
+    failed = await wait_done(client, pids, args.timeout)
+    ocr_seconds = time.perf_counter() - started
+    print(f"corpus of {len(pids)} documents ready, {failed} failed", file=sys.stderr)
+
+    generator = random.Random(args.seed)
+    scenarios: Dict[str, Callable] = {
+        kind: (lambda kind: lambda number: client.get(f"/ocr/{pids[number % len(pids)]}/{kind}"))(kind)
+        for kind in DOWNLOADS
+    }
+    scenarios["documents"] = lambda number: client.get("/documents", params={"limit": 50})
+    scenarios["search"] = lambda number: client.get(
+        "/search", params={"search_query": generator.choice(VOCABULARY), "limit": 20}
+    )
+    for concurrency in args.concurrency:
+        for scenario, request in scenarios.items():
+            result = await run_load(scenario, concurrency, args.requests, request)
+            results.append(result)
+            print(json.dumps(result), file=sys.stderr)
+
+    results.append(
+        {
+            "scenario": "ocr_backlog",
+            "documents": len(pids),
+            "failed": failed,
+            "seconds": round(ocr_seconds, 3),
+        }
+    )
+    return results
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=str(STUB.parent),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def configure(args):
+    """
+    Point the app at a fresh workdir, database and the stub before it is
+    imported, the settings being read from the environment at import.
+    """
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="bench_"))
+    workdir.mkdir(parents=True, exist_ok=True)
+    os.environ["WORKDIR"] = str(workdir)
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{workdir / 'bench.db'}")
+    os.environ["BASE_COMMAND_OCR"] = f"{shlex.quote(sys.executable)} {shlex.quote(str(STUB))}"
+    os.environ["OCR_ENGINE"] = "subprocess"
+    os.environ["BENCH_OCR_LATENCY"] = str(args.latency)
+    os.environ["BENCH_OCR_PAGES"] = str(args.pages)
+    os.environ.setdefault("DOCUMENT_EXPIRE_HOUR", "24")
+
+
+async def main_async(args) -> List[dict]:
+    if args.url:
+        async with httpx.AsyncClient(
+            base_url=args.url, headers={"X-API-KEY": args.api_key}, timeout=None
+        ) as client:
+            return await benchmark(client, args)
+
+    configure(args)
+    from api.main import app
+    from api.settings import config
+
+    # in a task of its own like a server's lifespan: the database connection
+    # it opens is bound to its context, which the requests must not inherit
+    await asyncio.create_task(app.router.startup())
+    try:
+        async with httpx.AsyncClient(
+            app=app,
+            base_url="http://bench",
+            headers={"X-API-KEY": config.api_key_secret},
+            timeout=None,
+        ) as client:
+            return await benchmark(client, args)
+    finally:
+        await asyncio.create_task(app.router.shutdown())
+
+
+def compare(results: List[dict], baseline: List[dict]) -> List[str]:
+    """
+    One line per scenario and concurrency level found in both runs, with the
+    relative change of throughput and p95 latency
+    """
+    previous = {
+        (result["scenario"], result.get("concurrency")): result for result in baseline
+    }
+    lines = []
+    for result in results:
+        before = previous.get((result["scenario"], result.get("concurrency")))
+        if before is None or "rps" not in result:
+            continue
+        lines.append(
+            "{:<10} c={:<4} rps {:>9.2f} -> {:>9.2f} ({:+.1%})  p95 {:>8.2f} -> {:>8.2f} ms ({:+.1%})".format(
+                result["scenario"],
+                result["concurrency"],
+                before["rps"],
+                result["rps"],
+                result["rps"] / before["rps"] - 1 if before["rps"] else 0,
+                before["p95_ms"],
+                result["p95_ms"],
+                result["p95_ms"] / before["p95_ms"] - 1 if before["p95_ms"] else 0,
+            )
+        )
+    return lines
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--documents", type=int, default=100, help="documents uploaded per concurrency level")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario and concurrency level")
+    parser.add_argument(
+        "--concurrency",
+        type=lambda value: [int(level) for level in value.split(",")],
+        default=[1, 8, 32],
+        help="comma separated concurrency levels",
+    )
+    parser.add_argument("--latency", type=float, default=0.5, help="stub OCR seconds per document")
+    parser.add_argument("--pages", type=int, default=2, help="pages per synthetic PDF and its stub OCR text")
+    parser.add_argument("--size", type=int, default=64 * 1024, help="bytes per synthetic PDF")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for the corpus OCR")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="workdir of the in process app, a new temporary one by default")
+    parser.add_argument("--url", help="benchmark a running server instead")
+    parser.add_argument("--api-key", default=os.environ.get("API_KEY_SECRET", "123456"))
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "parameters": {
+            name: getattr(args, name)
+            for name in ("documents", "requests", "concurrency", "latency", "pages", "size", "seed", "url")
+        },
+        "results": asyncio.run(main_async(args)),
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        for line in compare(report["results"], baseline["results"]):
+            print(line, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""
+Stand-in for ocrmypdf in benchmarks: takes the same arguments, sleeps
+BENCH_OCR_LATENCY seconds, copies the input to the output and writes a
+sidecar of BENCH_OCR_PAGES pages of words drawn from VOCABULARY, the same
+for the same input.
+"""
+import hashlib
+import os
+import random
+import shutil
+import sys
+import time
+
+VOCABULARY = [
+    "invoice", "contract", "payment", "delivery", "customer", "amount",
+    "total", "address", "signature", "receipt", "hóa", "đơn", "thanh",
+    "toán", "khách", "hàng", "địa", "chỉ", "tổng", "cộng",
+]
+
+
+def sidecar_text(seed: bytes, pages: int, words: int = 200) -> str:
+    generator = random.Random(hashlib.sha256(seed).digest())
+    return "\f".join(
+        " ".join(generator.choice(VOCABULARY) for _ in range(words))
+        for _ in range(pages)
+    )
+
+
+def main(args):
+    if "--version" in args:
+        print("0.0.0-bench")
+        return 0
+    sidecar = args[args.index("--sidecar") + 1]
+    input_path, output_path = args[-2], args[-1]
+
+    time.sleep(float(os.environ.get("BENCH_OCR_LATENCY", "0.5")))
+    shutil.copyfile(input_path, output_path)
+    with open(input_path, "rb") as f:
+        seed = f.read()
+    with open(sidecar, "w", encoding="utf-8") as f:
+        f.write(sidecar_text(seed, int(os.environ.get("BENCH_OCR_PAGES", "2"))))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,11 +1,16 @@
+import asyncio
 import random
 import uuid
 from datetime import datetime, timedelta
 from pathlib import Path
 
 import pytest
+from databases import Database
 
+import api.database
+from api import migrations
 from api.models import Document
+from api.settings import config
 
 subprocess_case = [
     (0, "done", "Command line output test"),
@@ -65,3 +70,30 @@ def document_model(tmp_path):
         return document
 
     return return_new_document
+
+
+@pytest.fixture
+def db(monkeypatch, tmp_path):
+    """
+    Fresh migrated SQLite database, tmp_path being the workdir. Returns a
+    function running a coroutine function connected to it.
+    """
+    url = f"sqlite:///{tmp_path / 'test.db'}"
+    monkeypatch.setattr(config, "database_url", url)
+    monkeypatch.setattr(config, "workdir", tmp_path)
+    migrations.migrate()
+    monkeypatch.setattr(api.database, "database", Database(url))
+
+    def run(function, *args):
+        async def connected():
+            await api.database.connect()
+            try:
+                # in a task of its own, like requests: the connection is
+                # bound to the context that first uses it
+                return await asyncio.ensure_future(function(*args))
+            finally:
+                await api.database.disconnect()
+
+        return asyncio.run(connected())
+
+    return run
@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta
+
+from prometheus_client import REGISTRY
+from sqlalchemy import select
+
+from api import cleanup, database, jobs
+from api.database import DBDocument
+from api.settings import config
+from tests.test_jobs import upload
+
+documents = DBDocument.__table__
+
+
+async def add(status: str, expire: datetime, accessed: datetime = None):
+    # distinct content, identical uploads would wait on a single OCR run
+    document = upload(f"%PDF-1.4 {status} {expire} {accessed}".encode())
+    document.status = status
+    document.expire = expire
+    await jobs.submit([document])
+    await jobs.update_status(str(document.pid), accessed=accessed)
+    return str(document.pid)
+
+
+async def remaining():
+    rows = await database.fetch_all(select([documents.c.pid]))
+    return {row["pid"] for row in rows}
+
+
+class TestCleanup:
+    def test_reap_expired(self, db, monkeypatch):
+        monkeypatch.setattr(config, "ocr_mode", "queue")
+        now = datetime.now()
+
+        async def run():
+            expired = await add("done", now - timedelta(minutes=1))
+            failed = await add("error", now - timedelta(minutes=1))
+            queued = await add("received", now - timedelta(minutes=1))
+            running = await add("processing", now - timedelta(minutes=1))
+            fresh = await add("done", now + timedelta(hours=1))
+            report = await cleanup.reap_expired(now)
+            return report, await remaining(), (expired, failed, queued, running, fresh)
+
+        report, left, (expired, failed, queued, running, fresh) = db(run)
+
+        assert report["documents"] == 2
+        assert left == {queued, running, fresh}
+
+    def test_evict_least_recently_used(self, db, monkeypatch):
+        monkeypatch.setattr(config, "ocr_mode", "queue")
+        monkeypatch.setattr(config, "cleanup_batch_size", 1)
+        monkeypatch.setattr(config, "disk_low_water_percent", 80)
+        usage = iter([95, 85, 75])
+        monkeypatch.setattr(cleanup, "disk_usage_percent", lambda: next(usage))
+        now = datetime.now()
+        expire = now + timedelta(hours=1)
+
+        async def run():
+            recent = await add("done", expire, now)
+            old = await add("done", expire, now - timedelta(hours=2))
+            older = await add("error", expire, now - timedelta(hours=3))
+            queued = await add("received", expire)
+            report = await cleanup.evict_least_recently_used()
+            return report, await remaining(), (recent, old, older, queued)
+
+        report, left, (recent, old, older, queued) = db(run)
+
+        assert report["documents"] == 2
+        assert left == {recent, queued}
+
+    def test_run_cleanup_counts_reclaimed_bytes(self, db, monkeypatch):
+        monkeypatch.setattr(config, "ocr_mode", "queue")
+        monkeypatch.setattr(cleanup, "disk_usage_percent", lambda: 10)
+        before = REGISTRY.get_sample_value(
+            "ocr_cleanup_bytes_total", {"reason": "expired"}
+        ) or 0
+
+        async def run():
+            await add("done", datetime.now() - timedelta(minutes=1))
+            return await cleanup.run_cleanup()
+
+        report = db(run)
+
+        assert report["expired"]["bytes"] > 0
+        assert report["evicted"] is None
+        assert REGISTRY.get_sample_value(
+            "ocr_cleanup_bytes_total", {"reason": "expired"}
+        ) == before + report["expired"]["bytes"]
@@ -0,0 +1,186 @@
+import shutil
+import threading
+import time
+
+import pytest
+
+from api import engine
+from api.models import Profile
+
+pikepdf = pytest.importorskip("pikepdf")
+
+
+@pytest.fixture
+def pdf_file(tmp_path):
+    path = tmp_path / "input.pdf"
+    with pikepdf.new() as pdf:
+        for _ in range(5):
+            pdf.add_blank_page()
+        pdf.save(path)
+    return path
+
+
+class TestEngine:
+    def test_page_count(self, pdf_file, tmp_path):
+        broken = tmp_path / "broken.pdf"
+        broken.touch()
+
+        assert engine.page_count(pdf_file) == 5
+        assert engine.page_count(broken) is None
+
+    def test_split_and_merge(self, pdf_file, tmp_path):
+        parts = engine.split_pdf(pdf_file, tmp_path, 2)
+        assert [engine.page_count(part) for part in parts] == [2, 2, 1]
+
+        merged = tmp_path / "merged.pdf"
+        engine.merge_pdfs(parts, merged)
+        assert engine.page_count(merged) == 5
+
+    def test_run_ocrmypdf_split(self, monkeypatch, mocker, pdf_file, tmp_path):
+        import api.settings
+
+        monkeypatch.setattr(api.settings.config, "ocr_split_chunk_pages", 2)
+
+        def fake_ocrmypdf(
+            lang, input_path, output_path, output_txt_path, options, base_options
+        ):
+            shutil.copy(input_path, output_path)
+            with open(output_txt_path, "w") as sidecar:
+                sidecar.write(
+                    "\f".join(
+                        f"{input_path[-10:-4]}:{page}"
+                        for page in range(engine.page_count(input_path))
+                    )
+                )
+            return b"ok"
+
+        mock_run = mocker.patch.object(
+            engine, "run_ocrmypdf", side_effect=fake_ocrmypdf
+        )
+        output = tmp_path / "output.pdf"
+        output_txt = tmp_path / "output.txt"
+
+        engine.run_ocrmypdf_split("eng", pdf_file, output, output_txt)
+
+        assert mock_run.call_count == 3
+        assert engine.page_count(output) == 5
+        assert output_txt.read_text().split("\f") == [
+            "000000:0",
+            "000000:1",
+            "000002:0",
+            "000002:1",
+            "000004:0",
+        ]
+
+    def test_run_ocrmypdf_split_within_cores(self, monkeypatch, mocker, pdf_file, tmp_path):
+        import api.settings
+
+        monkeypatch.setattr(api.settings.config, "ocr_split_chunk_pages", 1)
+        monkeypatch.setattr(api.settings.config, "ocr_split_workers", 4)
+        monkeypatch.setattr(engine, "_executor", None)
+        lock = threading.Lock()
+        running = []
+        concurrency = []
+
+        def fake_ocrmypdf(
+            lang, input_path, output_path, output_txt_path, options, base_options
+        ):
+            with lock:
+                running.append(input_path)
+                concurrency.append(len(running))
+            time.sleep(0.05)
+            shutil.copy(input_path, output_path)
+            open(output_txt_path, "w").close()
+            with lock:
+                running.remove(input_path)
+            return b"ok"
+
+        mock_run = mocker.patch.object(
+            engine, "run_ocrmypdf", side_effect=fake_ocrmypdf
+        )
+
+        engine.run_ocrmypdf_split(
+            "eng", pdf_file, tmp_path / "output.pdf", tmp_path / "output.txt", cores=2
+        )
+
+        assert mock_run.call_count == 5
+        assert max(concurrency) == 2
+        assert {call[0][4] for call in mock_run.call_args_list} == {"--jobs 1"}
+
+
+@pytest.fixture
+def mixed_pdf(tmp_path):
+    """
+    A page with a text layer followed by a blank, image-only like, page
+    """
+    path = tmp_path / "mixed.pdf"
+    with pikepdf.new() as pdf:
+        font = pdf.make_indirect(
+            pikepdf.Dictionary(
+                Type=pikepdf.Name.Font,
+                Subtype=pikepdf.Name.Type1,
+                BaseFont=pikepdf.Name.Helvetica,
+            )
+        )
+        pdf.add_blank_page()
+        pdf.add_blank_page()
+        page = pdf.pages[0]
+        page.Resources = pikepdf.Dictionary(Font=pikepdf.Dictionary(F1=font))
+        page.Contents = pdf.make_stream(
+            b"BT /F1 12 Tf 72 720 Td (Invoice number 42, total due 100 EUR) Tj ET"
+        )
+        pdf.save(path)
+    return path
+
+
+class TestTextLayer:
+    def test_extract_text_layer(self, mixed_pdf, tmp_path):
+        pytest.importorskip("pdfminer")
+        broken = tmp_path / "broken.pdf"
+        broken.write_bytes(b"%PDF-1.4 not really")
+
+        text_layer = engine.extract_text_layer(mixed_pdf)
+
+        assert [page.strip() for page in text_layer] == [
+            "Invoice number 42, total due 100 EUR",
+            "",
+        ]
+        assert engine.page_sources(text_layer) == "to"
+        assert engine.extract_text_layer(broken) is None
+
+    def test_merge_text_layer(self, tmp_path):
+        sidecar = tmp_path / "output.txt"
+        sidecar.write_text("[OCR skipped on page 1]\fscanned page\f")
+
+        engine.merge_text_layer(["digital page", "", ""], "too", sidecar)
+
+        # the last page is blank, it is kept
+        assert sidecar.read_text() == "digital page\fscanned page\f"
+
+    def test_text_layer_options(self):
+        options = "--output-type pdf --force-ocr --deskew"
+
+        assert engine.text_layer_options(options) == "--output-type pdf --deskew --skip-text"
+        assert engine.text_layer_options(options, redo=True) == "--output-type pdf --redo-ocr"
+
+    def test_sparse_text(self):
+        assert engine.sparse_text(["long enough", "page 3"], "to")
+        assert not engine.sparse_text(["long enough", " \n"], "to")
+
+    def test_copies_output(self):
+        assert engine.copies_output("--output-type pdf --optimize 0 --skip-text")
+        assert not engine.copies_output("--output-type pdfa --optimize 0")
+        assert not engine.copies_output("--output-type pdf")
+
+
+class TestProfiles:
+    def test_profile_options(self, monkeypatch):
+        import api.settings
+
+        monkeypatch.setattr(api.settings.config, "base_command_option", "--fast")
+        monkeypatch.setattr(api.settings.config, "profile_archival_option", "--archival")
+        monkeypatch.setattr(api.settings.config, "default_profile", "archival")
+
+        assert engine.profile_options("fast") == "--fast"
+        assert engine.profile_options(Profile.fast) == "--fast"
+        assert engine.profile_options() == "--archival"
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import uuid
+
+import pytest
+from fastapi import HTTPException
+
+import api.main
+from api import engine, events, jobs
+from api.scheduler import OCRScheduler
+from api.settings import config
+from tests.test_jobs import fake_ocrmypdf, run_next, upload
+
+
+class TestEvents:
+    def test_publish(self):
+        received = []
+
+        def failing(event):
+            raise RuntimeError("subscriber bug")
+
+        events.subscribe(failing)
+        events.subscribe(received.append)
+        try:
+            events.publish("pid", "done", code=0)
+        finally:
+            events.unsubscribe(failing)
+            events.unsubscribe(received.append)
+
+        assert [(e["pid"], e["status"], e["code"]) for e in received] == [("pid", "done", 0)]
+        assert events.subscribers == []
+
+    def test_stream(self):
+        states = iter([{"pid": "pid", "status": "received"}, {"pid": "pid", "status": "processing"}])
+
+        async def current():
+            return next(states)
+
+        async def run():
+            queue = events.listen("pid")
+            chunks = []
+            async for chunk in events.stream("pid", queue, current, keepalive=0.01):
+                chunks.append(chunk)
+                if len(chunks) == 3:
+                    events.publish("pid", "done", code=0)
+            return chunks
+
+        chunks = asyncio.run(run())
+
+        assert chunks[0] == 'event: status\ndata: {"pid": "pid", "status": "received"}\n\n'
+        assert chunks[1] == ": keepalive\n\n"
+        assert '"status": "processing"' in chunks[2]
+        assert '"status": "done"' in chunks[3]
+        assert len(chunks) == 4
+        assert events.listeners == {}
+
+    def test_wait_final(self):
+        async def run():
+            queue = events.listen("pid")
+            events.publish("pid", "processing")
+            events.publish("pid", "error")
+            try:
+                return await events.wait_final(queue, 1), await events.wait_final(queue, 0.01)
+            finally:
+                events.stop_listening("pid", queue)
+
+        final, timed_out = asyncio.run(run())
+
+        assert final["status"] == "error"
+        assert timed_out is None
+
+
+@pytest.fixture
+def local_jobs(monkeypatch, mocker):
+    monkeypatch.setattr(config, "text_layer_min_chars", 0)
+    monkeypatch.setattr(jobs, "scheduler", OCRScheduler(cores=2))
+    mocker.patch.object(engine, "run_ocrmypdf", side_effect=fake_ocrmypdf)
+
+
+class TestDocumentEvents:
+    def test_long_poll_returns_when_done(self, db, local_jobs):
+        async def run():
+            document = upload()
+            await jobs.submit([document])
+            loop = asyncio.get_event_loop()
+            started = loop.time()
+            polled = asyncio.ensure_future(
+                api.main.get_doc(document.pid, wait=30, api_key=None)
+            )
+            await asyncio.sleep(0.05)
+            assert not polled.done()
+            await run_next()
+            return await polled, loop.time() - started
+
+        polled, elapsed = db(run)
+
+        assert polled.status == "done"
+        assert elapsed < 5
+        assert events.listeners == {}
+
+    def test_long_poll_times_out(self, db, local_jobs):
+        async def run():
+            document = upload()
+            await jobs.submit([document])
+            loop = asyncio.get_event_loop()
+            started = loop.time()
+            polled = await api.main.get_doc(document.pid, wait=1, api_key=None)
+            return polled, loop.time() - started
+
+        polled, elapsed = db(run)
+
+        assert polled.status == "received"
+        assert elapsed >= 1
+        assert events.listeners == {}
+
+    def test_server_sent_events(self, db, local_jobs, monkeypatch):
+        monkeypatch.setattr(config, "events_keepalive_seconds", 30)
+
+        async def run():
+            document = upload()
+            await jobs.submit([document])
+            response = await api.main.get_doc_events(document.pid, api_key=None)
+            chunks = []
+            running = None
+            async for chunk in response.body_iterator:
+                chunks.append(chunk)
+                if running is None:
+                    running = asyncio.ensure_future(run_next())
+            await running
+            return document, response, chunks
+
+        document, response, chunks = db(run)
+
+        assert response.media_type == "text/event-stream"
+        sent = []
+        for chunk in chunks:
+            kind, data = chunk.rstrip("\n").split("\n")
+            assert kind == "event: status"
+            sent.append(json.loads(data[len("data: "):]))
+        assert [event["status"] for event in sent] == ["received", "processing", "done"]
+        assert {event["pid"] for event in sent} == {str(document.pid)}
+        assert sent[-1]["code"] == 0
+        assert events.listeners == {}
+
+    def test_server_sent_events_not_found(self, db):
+        async def run():
+            with pytest.raises(HTTPException) as raised:
+                await api.main.get_doc_events(uuid.uuid4(), api_key=None)
+            return raised.value
+
+        assert db(run).status_code == 404
+        assert events.listeners == {}
@@ -0,0 +1,46 @@
+import subprocess
+
+from api import health
+
+
+class TestHealth:
+    def test_detect_once(self, monkeypatch):
+        calls = []
+        outputs = {
+            ("ocrmypdf", "--version"): b"13.4.0\n",
+            ("tesseract", "--version"): b"tesseract 4.1.1\n leptonica-1.79.0\n",
+            ("tesseract", "--list-langs"): b"List of available languages (3):\neng\nosd\nvie\n",
+        }
+
+        def check_output(args, **kwargs):
+            calls.append(args)
+            return outputs[tuple(args)]
+
+        monkeypatch.setattr(subprocess, "check_output", check_output)
+        monkeypatch.setattr(health, "versions", {})
+        monkeypatch.setattr(health.config, "base_command_ocr", "ocrmypdf")
+        monkeypatch.setattr(health.config, "base_command_tesseract", "tesseract")
+
+        health.detect()
+        health.ocrmypdf_version()
+
+        assert health.versions == {
+            "ocrmypdf": "13.4.0",
+            "tesseract": "tesseract 4.1.1",
+            "languages": ["eng", "osd", "vie"],
+        }
+        assert len(calls) == 3
+
+    def test_ocrmypdf_unavailable_once(self, monkeypatch):
+        calls = []
+
+        def check_output(args, **kwargs):
+            calls.append(args)
+            raise FileNotFoundError(args[0])
+
+        monkeypatch.setattr(subprocess, "check_output", check_output)
+        monkeypatch.setattr(health, "versions", {})
+
+        assert health.ocrmypdf_version() == health.UNAVAILABLE
+        assert health.ocrmypdf_version() == health.UNAVAILABLE
+        assert len(calls) == 1
@@ -0,0 +1,281 @@
+import asyncio
+import hashlib
+import shutil
+import subprocess
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+from sqlalchemy import select
+
+import api.main
+from api import database, engine, jobs, search, storage
+from api.database import DBDocument
+from api.scheduler import OCRScheduler
+from api.settings import config
+
+documents = DBDocument.__table__
+
+
+def fake_ocrmypdf(lang, input_path, output_path, output_txt_path, options, base_options):
+    shutil.copyfile(input_path, output_path)
+    with open(output_txt_path, "w", encoding="utf-8") as sidecar:
+        sidecar.write("invoice page\fsecond page")
+    return b"ok"
+
+
+@pytest.fixture
+def ocr_stub(monkeypatch, mocker):
+    monkeypatch.setattr(config, "text_layer_min_chars", 0)
+    monkeypatch.setattr(jobs, "scheduler", OCRScheduler(cores=2))
+    return mocker.patch.object(engine, "run_ocrmypdf", side_effect=fake_ocrmypdf)
+
+
+def upload(content: bytes = b"%PDF-1.4 test", file_name: str = "a.pdf"):
+    pid, input_file = api.main.new_input()
+    input_file.write_bytes(content)
+    digest = hashlib.sha256(content).hexdigest()
+    return api.main.new_document(
+        pid, ["eng"], input_file, digest, file_name, datetime.now()
+    )
+
+
+async def row(document):
+    return await database.fetch_one(
+        select([documents]).where(documents.c.pid == str(document.pid))
+    )
+
+
+async def run_next():
+    document = await jobs.scheduler.next_job()
+    try:
+        job = await jobs.current_job(document)
+        if job is not None:
+            await jobs.run_job(job)
+    finally:
+        jobs.scheduler.job_done(document)
+    return job
+
+
+class TestJobs:
+    def test_run_job(self, db, ocr_stub):
+        async def run():
+            document = upload()
+            await jobs.submit([document])
+            assert (await row(document))["status"] == "received"
+            assert jobs.scheduler.depth == 1
+
+            await run_next()
+            results, _ = await search.search("invoice")
+            return await row(document), results
+
+        stored, results = db(run)
+
+        assert stored["status"] == "done"
+        assert stored["code"] == 0
+        assert stored["file_name"] == "a"
+        assert [result["file_name"] for result in results] == ["a.pdf"]
+        ocr_stub.assert_called_once()
+
+    def test_ocr_error(self, db, ocr_stub):
+        ocr_stub.side_effect = subprocess.CalledProcessError(2, "ocrmypdf", output=b"bad PDF")
+
+        async def run():
+            document = upload()
+            await jobs.submit([document])
+            await run_next()
+            return await row(document)
+
+        stored = db(run)
+
+        assert (stored["status"], stored["code"], stored["result"]) == ("error", 2, "bad PDF")
+
+    def test_fail_job(self, db, ocr_stub):
+        async def run():
+            document = upload()
+            await jobs.submit([document])
+            job = await jobs.scheduler.next_job()
+            await jobs.fail_job(job, RuntimeError("boom"))
+            jobs.scheduler.job_done(job)
+            return await row(document)
+
+        stored = db(run)
+
+        assert (stored["status"], stored["result"]) == ("error", "RuntimeError: boom")
+
+    def test_identical_uploads_share_a_run(self, db, ocr_stub):
+        async def run():
+            first, second = upload(), upload()
+            await jobs.submit([first])
+            await jobs.submit([second])
+            assert jobs.scheduler.depth == 1
+
+            await run_next()
+            third = upload()
+            await jobs.submit([third])
+            results, _ = await search.search("invoice")
+            entries = await database.fetch_all(search.documents_fts.select())
+            rows = [await row(document) for document in (first, second, third)]
+            return rows, results, entries
+
+        rows, results, entries = db(run)
+
+        assert [stored["status"] for stored in rows] == ["done"] * 3
+        assert len(results) == 3
+        # one index entry for the text they share
+        assert [entry["key"] for entry in entries] == [rows[0]["content_key"]]
+        assert len({stored["content_key"] for stored in rows}) == 1
+        ocr_stub.assert_called_once()
+
+    def test_deleting_a_failed_upload_keeps_the_output_of_a_later_one(self, db, ocr_stub):
+        ocr_stub.side_effect = subprocess.CalledProcessError(2, "ocrmypdf", output=b"bad PDF")
+
+        async def run():
+            failed = upload()
+            await jobs.submit([failed])
+            await run_next()
+            ocr_stub.side_effect = fake_ocrmypdf
+            done = upload()
+            await jobs.submit([done])
+            await run_next()
+            failed_row, done_row = await row(failed), await row(done)
+            await storage.delete_documents([failed_row])
+            return failed_row, done_row
+
+        failed_row, done_row = db(run)
+
+        assert failed_row["status"] == "error"
+        assert failed_row["output"] != done_row["output"]
+        assert Path(done_row["output"]).exists()
+
+    def test_deleted_leader_hands_over_its_job(self, db, ocr_stub):
+        async def run():
+            leader, follower = upload(), upload()
+            await jobs.submit([leader, follower])
+            await storage.delete_documents([await row(leader)])
+            assert not leader.input.exists()
+
+            job = await run_next()
+            return job, await row(follower), await storage.get_artifact(leader.content_key)
+
+        job, stored, artifact = db(run)
+
+        assert str(job.pid) == stored["pid"] == artifact["leader"]
+        assert stored["status"] == "done"
+        assert artifact["refcount"] == 1
+        assert ocr_stub.call_args[0][1] == str(job.input)
+
+    def test_deleted_job_without_follower_is_skipped(self, db, ocr_stub):
+        async def run():
+            document = upload()
+            await jobs.submit([document])
+            await storage.delete_documents([await row(document)])
+            return await run_next()
+
+        assert db(run) is None
+        ocr_stub.assert_not_called()
+
+    def test_running_leader_keeps_its_input(self, db, ocr_stub):
+        async def run():
+            leader, follower = upload(), upload()
+            await jobs.submit([leader, follower])
+            await jobs.update_status(str(leader.pid), status="processing")
+            await storage.delete_documents([await row(leader)])
+            assert leader.input.exists()
+
+            await jobs.run_job(await jobs.scheduler.next_job())
+            assert not leader.input.exists()
+            return await row(follower)
+
+        stored = db(run)
+
+        assert stored["status"] == "done"
+
+    def test_worker_survives_failing_to_record_an_error(self, db, ocr_stub, mocker):
+        calls = []
+
+        def ocr_once(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise RuntimeError("boom")
+            return fake_ocrmypdf(*args)
+
+        ocr_stub.side_effect = ocr_once
+        mocker.patch.object(jobs, "fail_job", side_effect=RuntimeError("database is down"))
+
+        async def run():
+            documents = [upload(), upload(b"%PDF-1.4 other")]
+            await jobs.submit(documents)
+            worker = asyncio.ensure_future(jobs.worker())
+            try:
+                for _ in range(100):
+                    statuses = sorted([(await row(document))["status"] for document in documents])
+                    if "done" in statuses:
+                        break
+                    await asyncio.sleep(0.05)
+            finally:
+                worker.cancel()
+            return statuses
+
+        # the first job could not be failed, the worker went on with the next
+        assert db(run) == ["done", "processing"]
+
+    def test_pending_jobs_requeued(self, db, ocr_stub, monkeypatch):
+        monkeypatch.setattr(config, "max_ocr_process", 0)
+
+        async def run():
+            document = upload()
+            await jobs.submit([document])
+            monkeypatch.setattr(jobs, "scheduler", OCRScheduler())
+            await jobs.start_workers()
+            return jobs.scheduler.depth
+
+        assert db(run) == 1
+
+    def test_sparse_text_page_is_ocred(self, db, ocr_stub, monkeypatch, mocker):
+        monkeypatch.setattr(config, "text_layer_min_chars", 20)
+        mocker.patch.object(
+            engine,
+            "extract_text_layer",
+            return_value=["a page of text taken as it is", "stamp"],
+        )
+
+        async def run():
+            document = upload()
+            await jobs.submit([document])
+            await run_next()
+            return await storage.load_text(document.content_key), await row(document)
+
+        text, stored = db(run)
+
+        # --skip-text would not OCR the page with a stamp only
+        assert "--redo-ocr" in ocr_stub.call_args[0][5]
+        assert text == "a page of text taken as it is\fsecond page"
+        assert stored["page_sources"] == "to"
+
+    def test_text_layer_converted_to_pdfa(self, db, ocr_stub, monkeypatch, mocker):
+        monkeypatch.setattr(config, "text_layer_min_chars", 20)
+        monkeypatch.setattr(config, "default_profile", "archival")
+        mocker.patch.object(
+            engine,
+            "extract_text_layer",
+            return_value=["a page of text taken as it is", "and another one of them"],
+        )
+
+        async def run():
+            document = upload()
+            await jobs.submit([document])
+            await run_next()
+            return await storage.load_text(document.content_key)
+
+        text = db(run)
+
+        # no page is OCR'd, ocrmypdf still makes the PDF/A
+        assert "--output-type pdfa" in ocr_stub.call_args[0][5]
+        assert "--skip-text" in ocr_stub.call_args[0][5]
+        assert text == "a page of text taken as it is\fand another one of them"
+
+    def test_document_name(self):
+        assert api.main.document_name("scan.PDF") == "scan"
+        assert api.main.document_name("notes.txt") == "notes.txt"
+        assert api.main.document_name(None) is None
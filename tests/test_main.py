@@ -1,10 +1,22 @@
+import io
+import uuid
+import zipfile
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
 import pytest
 from fastapi.testclient import TestClient
 from freezegun import freeze_time
+from sqlalchemy import create_engine
 
 import api.main
+from api import engine, health, storage
 from api.main import app
 from api.models import Document
+from api.settings import config
+from tests.test_jobs import fake_ocrmypdf
+
+HEADERS = {"X-API-KEY": "123456"}
 
 
 @pytest.fixture(scope="class")
@@ -12,6 +24,28 @@ def client():
     return TestClient(app)
 
 
+@pytest.fixture
+def app_client(db, monkeypatch, mocker):
+    """
+    Client of the started app on a fresh database, OCR'ing with a stub
+    """
+    monkeypatch.setattr(config, "text_layer_min_chars", 0)
+    monkeypatch.setattr(config, "ocr_engine", "subprocess")
+    mocker.patch.object(engine, "run_ocrmypdf", side_effect=fake_ocrmypdf)
+    with TestClient(app) as client:
+        yield client
+
+
+def ocr_done(client, content: bytes = b"%PDF-1.4 test") -> str:
+    response = client.post(
+        "/ocr", files={"file": ("a.pdf", content, "application/pdf")}, headers=HEADERS
+    )
+    pid = response.json()["pid"]
+    document = client.get(f"/ocr/{pid}", params={"wait": 10}, headers=HEADERS).json()
+    assert document["status"] == "done"
+    return pid
+
+
 @pytest.fixture(scope="module")
 def document_upload():
     post_files_param = {"file": open("tests/test.pdf", "rb")}
@@ -30,6 +64,7 @@ class TestMain:
             return "1.0.0"
 
         monkeypatch.setattr(subprocess, "check_output", mock_check_output)
+        monkeypatch.setattr(api.main.health, "versions", {})
 
         response = client.get("/status")
         assert response.status_code == 200
@@ -146,3 +181,460 @@ class TestMain:
             "expire": x_expire.isoformat(),
             "finished": None,
         }
+
+
+class TestUpload:
+    def test_upload_too_large(self, monkeypatch, client):
+        monkeypatch.setattr(api.main.config, "max_upload_size", 16)
+
+        response = client.post(
+            "/ocr",
+            files={"file": ("a.pdf", b"%PDF-1.4 " + b"x" * 32, "application/pdf")},
+            headers={"X-API-KEY": "123456"},
+        )
+
+        assert response.status_code == 413
+
+    def test_request_too_large(self, client):
+        response = client.post(
+            "/ocr",
+            headers={
+                "X-API-KEY": "123456",
+                "Content-Length": str(api.main.config.max_request_size + 1),
+            },
+        )
+
+        assert response.status_code == 413
+
+    def test_upload_not_a_pdf(self, client):
+        response = client.post(
+            "/ocr",
+            files={"file": ("a.pdf", b"<html></html>", "application/pdf")},
+            headers={"X-API-KEY": "123456"},
+        )
+
+        assert response.status_code == 415
+        assert response.json() == {"detail": "File is not a PDF"}
+
+
+def batch_done(client, batch_id: str) -> dict:
+    batch = client.get(f"/ocr/batch/{batch_id}", headers=HEADERS).json()
+    for document in batch["documents"]:
+        client.get(f"/ocr/{document['pid']}", params={"wait": 10}, headers=HEADERS)
+    return client.get(f"/ocr/batch/{batch_id}", headers=HEADERS).json()
+
+
+def zip_of(**members: bytes) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, content in members.items():
+            archive.writestr(name, content)
+    return buffer.getvalue()
+
+
+class TestBatch:
+    def test_batch(self, app_client):
+        archive = zip_of(**{"b.pdf": b"%PDF-1.4 b", "notes.txt": b"skipped"})
+        response = app_client.post(
+            "/ocr/batch",
+            files=[
+                ("files", ("a.pdf", b"%PDF-1.4 a", "application/pdf")),
+                ("files", ("more.zip", archive, "application/zip")),
+            ],
+            headers=HEADERS,
+        )
+
+        assert response.status_code == 200
+        created = response.json()
+        assert [doc["file_name"] for doc in created["documents"]] == ["a", "b"]
+        assert {doc["status"] for doc in created["documents"]} == {"received"}
+
+        batch = batch_done(app_client, created["batch_id"])
+
+        assert batch["total"] == 2
+        assert batch["status"] == {"done": 2}
+        assert batch["progress"] == 1
+        assert {doc["pid"] for doc in batch["documents"]} == {
+            doc["pid"] for doc in created["documents"]
+        }
+        assert all(doc["finished"] for doc in batch["documents"])
+
+        response = app_client.get(f"/ocr/batch/{created['batch_id']}/zip", headers=HEADERS)
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/zip"
+        with zipfile.ZipFile(io.BytesIO(response.content)) as results:
+            names = set(results.namelist())
+            pids = [doc["pid"] for doc in created["documents"]]
+            assert names == {f"{pid}.{kind}" for pid in pids for kind in ("pdf", "txt")}
+            assert results.read(f"{pids[0]}.txt").decode().startswith("invoice page")
+
+    def test_batch_progress(self, app_client, mocker):
+        enqueue = api.main.jobs.enqueue
+
+        async def enqueue_first(document, *args):
+            if document.file_name == "a":
+                await enqueue(document, *args)
+
+        mocker.patch.object(api.main.jobs, "enqueue", side_effect=enqueue_first)
+        response = app_client.post(
+            "/ocr/batch",
+            files=[
+                ("files", ("a.pdf", b"%PDF-1.4 a", "application/pdf")),
+                ("files", ("b.pdf", b"%PDF-1.4 b", "application/pdf")),
+            ],
+            headers=HEADERS,
+        )
+        created = response.json()
+        first = created["documents"][0]["pid"]
+        app_client.get(f"/ocr/{first}", params={"wait": 10}, headers=HEADERS)
+
+        batch = app_client.get(f"/ocr/batch/{created['batch_id']}", headers=HEADERS).json()
+
+        assert batch["status"] == {"done": 1, "received": 1}
+        assert batch["progress"] == 0.5
+        response = app_client.get(f"/ocr/batch/{created['batch_id']}/zip", headers=HEADERS)
+        with zipfile.ZipFile(io.BytesIO(response.content)) as results:
+            assert set(results.namelist()) == {f"{first}.pdf", f"{first}.txt"}
+
+    def test_batch_not_found(self, app_client):
+        for path in ("/ocr/batch/{}", "/ocr/batch/{}/zip"):
+            response = app_client.get(path.format(uuid.uuid4()), headers=HEADERS)
+            assert response.status_code == 404
+
+    def test_batch_without_pdf(self, app_client):
+        response = app_client.post(
+            "/ocr/batch",
+            files=[("files", ("a.zip", zip_of(**{"a.txt": b"text"}), "application/zip"))],
+            headers=HEADERS,
+        )
+
+        assert response.status_code == 400
+        assert response.json() == {"detail": "No PDF in request"}
+
+    def test_batch_too_many_files(self, app_client, monkeypatch):
+        monkeypatch.setattr(config, "max_batch_files", 1)
+
+        response = app_client.post(
+            "/ocr/batch",
+            files=[("files", ("a.pdf", b"%PDF-1.4 a", "application/pdf"))] * 2,
+            headers=HEADERS,
+        )
+
+        assert response.status_code == 413
+
+    def test_batch_request_size_override(self, client):
+        # above the /ocr limit but within the batch one, so the body is read
+        response = client.post(
+            "/ocr/batch",
+            headers={**HEADERS, "Content-Length": str(config.max_request_size + 1)},
+        )
+        assert response.status_code != 413
+
+        response = client.post(
+            "/ocr/batch",
+            headers={**HEADERS, "Content-Length": str(config.max_batch_request_size + 1)},
+        )
+        assert response.status_code == 413
+        assert response.json() == {"detail": "Request too large"}
+
+
+LISTED = [
+    # pid, status, lang, created
+    ("a", "done", "eng", datetime(2024, 1, 1)),
+    ("b", "error", "vie", datetime(2024, 1, 2)),
+    ("c", "done", "eng,vie", datetime(2024, 1, 3)),
+    ("d", "done", "vie", datetime(2024, 1, 3)),
+    ("e", "received", "eng", datetime(2024, 1, 4)),
+]
+
+
+@pytest.fixture
+def listed(db, monkeypatch):
+    # no local worker picks the received document up
+    monkeypatch.setattr(config, "ocr_mode", "queue")
+    engine = create_engine(config.database_url)
+    with engine.begin() as connection:
+        for pid, status, lang, created in LISTED:
+            connection.execute(
+                api.main.DBDocument.__table__.insert().values(
+                    pid=pid, lang=lang, status=status, input="", output="",
+                    output_json="", output_txt="", created=created,
+                    expire=created + timedelta(hours=1), file_name=pid,
+                )
+            )
+    engine.dispose()
+
+
+class TestDocuments:
+    def list_pids(self, client, **params):
+        response = client.get("/documents", params=params, headers=HEADERS)
+        assert response.status_code == 200
+        return [document["pid"] for document in response.json()]
+
+    def test_pages(self, listed, app_client):
+        pids = []
+        params = {"limit": 2}
+        while True:
+            response = app_client.get("/documents", params=params, headers=HEADERS)
+            page = [document["pid"] for document in response.json()]
+            assert len(page) <= 2
+            pids += page
+            if "x-next-cursor" not in response.headers:
+                break
+            params["cursor"] = response.headers["x-next-cursor"]
+
+        # most recent first, documents created together by pid
+        assert pids == ["e", "d", "c", "b", "a"]
+
+    def test_last_page_has_no_cursor(self, listed, app_client):
+        response = app_client.get("/documents", params={"limit": 10}, headers=HEADERS)
+
+        assert len(response.json()) == 5
+        assert "x-next-cursor" not in response.headers
+
+    @pytest.mark.parametrize(
+        "params,expected",
+        [
+            ({"status": "done"}, ["d", "c", "a"]),
+            ({"status": "error"}, ["b"]),
+            ({"lang": "vie"}, ["d", "c", "b"]),
+            ({"lang": ["eng", "vie"]}, ["c"]),
+            ({"created_after": "2024-01-03T00:00:00"}, ["e", "d", "c"]),
+            ({"created_before": "2024-01-03T00:00:00"}, ["b", "a"]),
+            (
+                {"created_after": "2024-01-02T00:00:00", "created_before": "2024-01-04T00:00:00"},
+                ["d", "c", "b"],
+            ),
+            ({"status": "done", "lang": "eng"}, ["c", "a"]),
+        ],
+    )
+    def test_filters(self, listed, app_client, params, expected):
+        assert self.list_pids(app_client, **params) == expected
+
+    def test_filters_across_pages(self, listed, app_client):
+        response = app_client.get(
+            "/documents", params={"status": "done", "limit": 2}, headers=HEADERS
+        )
+        cursor = response.headers["x-next-cursor"]
+
+        assert [document["pid"] for document in response.json()] == ["d", "c"]
+        assert self.list_pids(app_client, status="done", cursor=cursor) == ["a"]
+
+    @pytest.mark.parametrize("cursor", ["invalid", "bm90IGpzb24=", "WzFd"])
+    def test_invalid_cursor(self, listed, app_client, cursor):
+        response = app_client.get("/documents", params={"cursor": cursor}, headers=HEADERS)
+
+        assert response.status_code == 400
+        assert response.json() == {"detail": f"Invalid cursor: {cursor}"}
+
+
+@pytest.fixture
+def ocr_tools(monkeypatch):
+    monkeypatch.setattr(
+        health,
+        "versions",
+        {"ocrmypdf": "13.4.0", "tesseract": "tesseract 4.1.1", "languages": ["eng", "vie"]},
+    )
+
+
+class TestStatus:
+    def test_status_ocrmypdf_unavailable(self, client, monkeypatch):
+        monkeypatch.setattr(health, "versions", {})
+        monkeypatch.setattr(config, "base_command_ocr", "/nonexistent/ocrmypdf")
+
+        response = client.get("/status")
+
+        assert response.status_code == 200
+        assert response.json() == {"status": "ok", "version_ocr": "unavailable"}
+
+    def test_live(self, client, monkeypatch):
+        # liveness does not depend on the database nor the OCR tools
+        monkeypatch.setattr(health, "versions", {})
+
+        response = client.get("/status/live")
+
+        assert response.status_code == 200
+        assert response.json() == {"status": "ok"}
+
+    def test_ready(self, ocr_tools, app_client):
+        response = app_client.get("/status/ready")
+
+        assert response.status_code == 200
+        report = response.json()
+        assert report["ready"]
+        assert report["checks"] == {"database": True, "queue": True, "disk": True, "ocr": True}
+        assert report["database_error"] is None
+        assert report["queue_depth"] == 0
+
+    def test_not_ready_database_down(self, ocr_tools, app_client, mocker):
+        mocker.patch.object(
+            health.database, "fetch_one", side_effect=ConnectionError("database down")
+        )
+
+        response = app_client.get("/status/ready")
+
+        assert response.status_code == 503
+        report = response.json()
+        assert not report["ready"]
+        assert report["checks"]["database"] is False
+        assert "database down" in report["database_error"]
+
+    def test_not_ready_queue_full(self, ocr_tools, app_client, monkeypatch):
+        monkeypatch.setattr(config, "ready_max_queue_depth", 0)
+
+        response = app_client.get("/status/ready")
+
+        assert response.status_code == 503
+        assert response.json()["checks"] == {
+            "database": True, "queue": False, "disk": True, "ocr": True
+        }
+
+    def test_not_ready_without_ocrmypdf(self, app_client, monkeypatch):
+        monkeypatch.setattr(health, "versions", {"ocrmypdf": health.UNAVAILABLE})
+
+        response = app_client.get("/status/ready")
+
+        assert response.status_code == 503
+        assert response.json()["checks"]["ocr"] is False
+
+
+class TestDownloads:
+    def test_docx_built_once(self, app_client):
+        pid = ocr_done(app_client)
+
+        first = app_client.get(f"/ocr/{pid}/docx", headers=HEADERS)
+        document = app_client.get(f"/ocr/{pid}", headers=HEADERS).json()
+        path = storage.docx_path(Path(document["output_txt"]))
+        built = path.stat().st_mtime_ns
+        second = app_client.get(f"/ocr/{pid}/docx", headers=HEADERS)
+
+        assert first.status_code == second.status_code == 200
+        assert first.content == second.content
+        assert path.stat().st_mtime_ns == built
+        assert first.headers["etag"] == second.headers["etag"]
+
+    @pytest.mark.parametrize("kind", ["pdf", "docx"])
+    def test_file_not_modified(self, app_client, kind):
+        pid = ocr_done(app_client)
+
+        response = app_client.get(f"/ocr/{pid}/{kind}", headers=HEADERS)
+        etag = response.headers["etag"]
+        last_modified = response.headers["last-modified"]
+
+        assert response.status_code == 200
+        for conditional in ({"If-None-Match": etag}, {"If-Modified-Since": last_modified}):
+            response = app_client.get(f"/ocr/{pid}/{kind}", headers={**HEADERS, **conditional})
+            assert response.status_code == 304
+            assert response.headers["etag"] == etag
+            assert not response.content
+
+        response = app_client.get(
+            f"/ocr/{pid}/{kind}", headers={**HEADERS, "If-None-Match": '"other"'}
+        )
+        assert response.status_code == 200
+
+    def test_txt_not_modified(self, app_client):
+        pid = ocr_done(app_client)
+
+        response = app_client.get(f"/ocr/{pid}/txt", headers=HEADERS)
+        etag = response.headers["etag"]
+
+        assert response.text.startswith("invoice page")
+        response = app_client.get(
+            f"/ocr/{pid}/txt", headers={**HEADERS, "If-None-Match": etag}
+        )
+        assert response.status_code == 304
+
+
+def three_pages(lang, input_path, output_path, output_txt_path, options, base_options):
+    fake_ocrmypdf(lang, input_path, output_path, output_txt_path, options, base_options)
+    Path(output_txt_path).write_text("first\fsecond\fthird", encoding="utf-8")
+    return b"ok"
+
+
+class TestPages:
+    @pytest.fixture
+    def pid(self, app_client, mocker):
+        mocker.patch.object(engine, "run_ocrmypdf", side_effect=three_pages)
+        return ocr_done(app_client)
+
+    @pytest.mark.parametrize(
+        "pages,expected",
+        [
+            ("1", "first"),
+            ("2", "second"),
+            ("2-3", "second\fthird"),
+            ("2-", "second\fthird"),
+            ("1-10", "first\fsecond\fthird"),
+        ],
+    )
+    def test_page_range(self, app_client, pid, pages, expected):
+        response = app_client.get(f"/ocr/{pid}/txt", params={"pages": pages}, headers=HEADERS)
+
+        assert response.status_code == 200
+        assert response.text == expected
+        assert response.headers["x-page-count"] == "3"
+
+    @pytest.mark.parametrize("pages", ["4", "4-5", "7-"])
+    def test_page_range_out_of_range(self, app_client, pid, pages):
+        response = app_client.get(f"/ocr/{pid}/txt", params={"pages": pages}, headers=HEADERS)
+
+        assert response.status_code == 416
+        assert response.json() == {"detail": "The document has 3 pages"}
+
+    @pytest.mark.parametrize(
+        "pages,status_code", [("0", 400), ("3-2", 400), ("a", 422), ("-2", 422), ("1,2", 422)]
+    )
+    def test_malformed_page_range(self, app_client, pid, pages, status_code):
+        response = app_client.get(f"/ocr/{pid}/txt", params={"pages": pages}, headers=HEADERS)
+
+        assert response.status_code == status_code
+
+    def test_page_ranges_cached_apart(self, app_client, pid):
+        first = app_client.get(f"/ocr/{pid}/txt", params={"pages": "1"}, headers=HEADERS)
+        second = app_client.get(
+            f"/ocr/{pid}/txt",
+            params={"pages": "2"},
+            headers={**HEADERS, "If-None-Match": first.headers["etag"]},
+        )
+
+        assert second.status_code == 200
+        assert second.text == "second"
+
+    def test_pages(self, app_client, pid):
+        response = app_client.get(f"/ocr/{pid}/pages", headers=HEADERS)
+
+        assert response.status_code == 200
+        assert response.json() == {
+            "pages": 3,
+            "offsets": [
+                {"page": 1, "start": 0, "size": 5},
+                {"page": 2, "start": 6, "size": 6},
+                {"page": 3, "start": 13, "size": 5},
+            ],
+        }
+        text = app_client.get(f"/ocr/{pid}/txt", headers=HEADERS).text
+        assert [
+            text[page["start"]:page["start"] + page["size"]]
+            for page in response.json()["offsets"]
+        ] == ["first", "second", "third"]
+
+    def test_pages_not_found(self, app_client):
+        response = app_client.get(f"/ocr/{uuid.uuid4()}/pages", headers=HEADERS)
+
+        assert response.status_code == 404
+
+
+class TestTouch:
+    def test_touch_aware_accessed(self, db):
+        # as PostgreSQL returns timestamptz values
+        accessed = datetime.now(timezone.utc) - timedelta(minutes=5)
+
+        db(api.main.touch, {"pid": "a", "accessed": accessed})
+
+    def test_local_time(self):
+        moment = datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+        assert api.main.database.local_time(moment) == datetime.fromtimestamp(moment.timestamp())
+        assert api.main.database.local_time(datetime(2024, 1, 1)) == datetime(2024, 1, 1)
@@ -0,0 +1,34 @@
+from prometheus_client import REGISTRY
+
+from api import metrics
+from api.models import Lang
+from api.scheduler import OCRScheduler, Priority
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class TestMetrics:
+    def test_lang_label(self):
+        assert metrics.lang_label({Lang.vie, Lang.eng}) == "eng+vie"
+        assert metrics.lang_label(["vie", "eng"]) == "eng+vie"
+
+    def test_observe_ocr(self):
+        pages = sample("ocr_pages_total")
+        runs = sample("ocr_pages_per_second_count")
+
+        metrics.observe_ocr(10, 2.0)
+        metrics.observe_ocr(0, 1.0)
+
+        assert sample("ocr_pages_total") == pages + 10
+        assert sample("ocr_pages_per_second_count") == runs + 1
+
+    def test_queue_wait(self):
+        count = sample("ocr_queue_wait_seconds_count", priority="bulk")
+        scheduler = OCRScheduler(on_wait=metrics.observe_queue_wait)
+        scheduler.submit("job", "a", Priority.bulk)
+
+        scheduler._pop()
+
+        assert sample("ocr_queue_wait_seconds_count", priority="bulk") == count + 1
@@ -0,0 +1,43 @@
+import sqlite3
+
+from api import migrations
+from api.settings import config
+
+
+class TestMigrations:
+    def test_migrate_old_database(self, monkeypatch, tmp_path):
+        path = tmp_path / "old.db"
+        connection = sqlite3.connect(str(path))
+        connection.execute(
+            "CREATE TABLE documents (pid VARCHAR PRIMARY KEY, lang VARCHAR, "
+            "status VARCHAR, input VARCHAR, output VARCHAR, output_json VARCHAR, "
+            "output_txt VARCHAR, text VARCHAR, created DATETIME, expire DATETIME, "
+            "file_name VARCHAR)"
+        )
+        connection.execute(
+            "INSERT INTO documents (pid, text, file_name) "
+            "VALUES ('pid', 'Tiếng Việt', 'scan.PDF')"
+        )
+        connection.commit()
+        monkeypatch.setattr(config, "database_url", f"sqlite:///{path}")
+
+        migrations.migrate()
+        migrations.migrate()
+
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(documents)")]
+        assert "content_key" in columns
+        assert connection.execute("SELECT file_name FROM documents").fetchall() == [("scan",)]
+        assert connection.execute("SELECT key, folded FROM documents_fts").fetchall() == [
+            ("pid", "Tieng Viet")
+        ]
+        assert connection.execute(
+            "SELECT key, size, pages FROM document_texts"
+        ).fetchall() == [("pid", 10, 1)]
+        assert connection.execute(
+            "SELECT key, page, start, size FROM document_pages"
+        ).fetchall() == [("pid", 1, 0, 10)]
+        assert connection.execute("SELECT text FROM documents").fetchall() == [(None,)]
+        assert connection.execute("SELECT version FROM schema_version").fetchall() == [
+            (len(migrations.MIGRATIONS),)
+        ]
+        assert connection.execute("PRAGMA journal_mode").fetchone() == ("wal",)
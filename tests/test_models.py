@@ -31,6 +31,7 @@ class TestDocumentModel:
 
         # 123456 current basedir so we can compute relative path later correctly
         monkeypatch.setattr(api.settings.config, "basedir", tmp_path)
+        monkeypatch.setattr(api.settings.config, "ocr_engine", "subprocess")
         output, param = subprocess_check_output
         monkeypatch.setattr(subprocess, "check_output", output)
 
@@ -43,16 +44,28 @@ class TestDocumentModel:
         assert document.result == param[2]
         assert document.finished > document.created
         output.assert_called_once_with(
-            " ".join(
-                [
-                    api.settings.config.base_command_ocr,
-                    api.settings.config.base_command_option,
-                    f"-l {'+'.join([l.value for l in document.lang])}",
-                    f"--sidecar {str(document.output_txt.absolute())}",
-                    str(document.input.absolute()),
-                    str(document.output.absolute()),
-                ]
-            ),
+            [
+                api.settings.config.base_command_ocr,
+                *api.settings.config.base_command_option.split(),
+                "-l",
+                "+".join([l.value for l in document.lang]),
+                "--sidecar",
+                str(document.output_txt.absolute()),
+                str(document.input.absolute()),
+                str(document.output.absolute()),
+            ],
             stderr=subprocess.STDOUT,
-            shell=True,
         )
+
+    def test_write_state(self, monkeypatch, document_model):
+        import api.settings
+
+        document = document_model()
+        document.output_json.unlink()
+
+        document.write_state()
+        assert not document.output_json.exists()
+
+        monkeypatch.setattr(api.settings.config, "write_state_json", True)
+        document.write_state()
+        assert Document.parse_file(document.output_json) == document
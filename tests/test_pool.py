@@ -0,0 +1,180 @@
+import subprocess
+import textwrap
+import threading
+import time
+from concurrent.futures import Future
+from typing import List
+
+import pytest
+
+from api import pool
+from api.settings import config
+
+# stands in for ocrmypdf in the pool processes
+FAKE_OCRMYPDF = """
+import os
+import shutil
+import time
+
+
+class exceptions:
+    class ExitCodeException(Exception):
+        exit_code = 2
+
+
+def ocr(input_file, output_file, sidecar, use_threads=False, **kwargs):
+    directory, name = os.path.split(input_file)
+    with open(os.path.join(directory, "calls.txt"), "a") as calls:
+        calls.write(name + "\\n")
+    if name == "hang.pdf":
+        time.sleep(60)
+    if name == "die.pdf":
+        os._exit(1)
+    if name == "slow.pdf":
+        time.sleep(0.6)
+    if name == "wait.pdf":
+        # running until the test lets it finish
+        open(os.path.join(directory, "started"), "w").close()
+        for _ in range(300):
+            if os.path.exists(os.path.join(directory, "go")):
+                break
+            time.sleep(0.1)
+    if not use_threads:
+        raise exceptions.ExitCodeException("no pool in a pool process")
+    shutil.copyfile(input_file, output_file)
+    with open(sidecar, "w") as text:
+        text.write("page")
+    return 0
+"""
+
+
+@pytest.fixture
+def fake_pool(monkeypatch, tmp_path):
+    package = tmp_path / "fake" / "ocrmypdf"
+    package.mkdir(parents=True)
+    (package / "__init__.py").write_text(textwrap.dedent(FAKE_OCRMYPDF))
+    # spawned processes start with the sys.path of this one
+    monkeypatch.syspath_prepend(str(tmp_path / "fake"))
+    monkeypatch.setattr(config, "max_ocr_process", 1)
+    monkeypatch.setattr(config, "ocr_pool_timeout_seconds", 5)
+    yield tmp_path
+    pool.stop()
+
+
+def run_fake(directory, name: str = "a.pdf"):
+    (directory / name).write_bytes(b"%PDF")
+    return pool.run(
+        "eng", str(directory / name), str(directory / f"o_{name}"), str(directory / f"o_{name}.txt"), ""
+    )
+
+
+def run_in_thread(directory, name: str) -> Future:
+    future = Future()
+
+    def target():
+        try:
+            future.set_result(run_fake(directory, name))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=target, daemon=True).start()
+    return future
+
+
+def wait_started(directory):
+    for _ in range(100):
+        if (directory / "started").exists():
+            return
+        time.sleep(0.1)
+
+
+def calls(directory) -> List[str]:
+    return (directory / "calls.txt").read_text().split()
+
+
+class TestPool:
+    def test_option_kwargs(self):
+        assert pool.option_kwargs(
+            "--output-type pdf --fast-web-view 0 --optimize 0 --force-ocr --jobs 4"
+        ) == {
+            "output_type": "pdf",
+            "fast_web_view": 0,
+            "optimize": 0,
+            "force_ocr": True,
+            "jobs": 4,
+        }
+
+    def test_available(self, monkeypatch, mocker):
+        import api.settings
+
+        mocker.patch.object(pool, "find_spec", return_value=object())
+        assert pool.available()
+
+        monkeypatch.setattr(api.settings.config, "ocr_engine", "subprocess")
+        assert not pool.available()
+
+    def test_run(self, fake_pool):
+        run_fake(fake_pool)
+
+        assert (fake_pool / "o_a.pdf").read_bytes() == b"%PDF"
+        assert (fake_pool / "o_a.pdf.txt").read_text() == "page"
+
+    @pytest.mark.parametrize("name", ["hang.pdf", "die.pdf"])
+    def test_run_fails_on_a_lost_process(self, fake_pool, monkeypatch, name):
+        monkeypatch.setattr(config, "ocr_pool_timeout_seconds", 2)
+
+        with pytest.raises(subprocess.CalledProcessError) as error:
+            run_fake(fake_pool, name)
+
+        assert error.value.returncode == pool.OTHER_ERROR
+        # not run again, the same PDF would break the next process too
+        assert calls(fake_pool) == [name]
+        # a new process runs the next jobs
+        run_fake(fake_pool)
+
+    def test_dead_process_fails_only_its_job(self, fake_pool, monkeypatch):
+        monkeypatch.setattr(config, "max_ocr_process", 2)
+        running = run_in_thread(fake_pool, "wait.pdf")
+        wait_started(fake_pool)
+
+        with pytest.raises(subprocess.CalledProcessError):
+            run_fake(fake_pool, "die.pdf")
+        (fake_pool / "go").touch()
+
+        assert running.result(timeout=10) == b""
+        assert (fake_pool / "o_wait.pdf").exists()
+
+    def test_timed_out_job_fails_alone(self, fake_pool, monkeypatch):
+        monkeypatch.setattr(config, "max_ocr_process", 2)
+        monkeypatch.setattr(config, "ocr_pool_timeout_seconds", 2)
+        pool.start()
+        hanging = run_in_thread(fake_pool, "hang.pdf")
+        # killed halfway through the other job
+        time.sleep(1)
+        running = run_in_thread(fake_pool, "wait.pdf")
+        wait_started(fake_pool)
+
+        with pytest.raises(subprocess.CalledProcessError):
+            hanging.result(timeout=10)
+        (fake_pool / "go").touch()
+
+        assert running.result(timeout=10) == b""
+
+    def test_timeout_counts_only_the_run(self, fake_pool, monkeypatch):
+        monkeypatch.setattr(config, "ocr_pool_timeout_seconds", 1)
+        pool.start()
+
+        # one process: the second job waits for the first one to finish
+        jobs = [run_in_thread(fake_pool, "slow.pdf") for _ in range(2)]
+
+        assert [job.result(timeout=10) for job in jobs] == [b"", b""]
+        assert calls(fake_pool) == ["slow.pdf", "slow.pdf"]
+
+    def test_processes_recycled(self, fake_pool, monkeypatch):
+        monkeypatch.setattr(config, "ocr_pool_max_tasks", 2)
+        pids = set()
+        for _ in range(4):
+            run_fake(fake_pool)
+            pids |= {process.process.pid for process in pool._processes}
+
+        assert len(pids) == 2
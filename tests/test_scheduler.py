@@ -0,0 +1,88 @@
+import asyncio
+
+from api.scheduler import OCRScheduler, Priority
+
+
+def drain(scheduler, count):
+    async def take():
+        jobs = []
+        for _ in range(count):
+            jobs.append(await scheduler.next_job())
+            scheduler.job_done()
+        return jobs
+
+    return asyncio.run(take())
+
+
+class TestOCRScheduler:
+    def test_interactive_first(self):
+        scheduler = OCRScheduler()
+        scheduler.submit("bulk", "a", Priority.bulk)
+        scheduler.submit("interactive", "a", Priority.interactive)
+
+        assert drain(scheduler, 2) == ["interactive", "bulk"]
+
+    def test_round_robin_between_keys(self):
+        scheduler = OCRScheduler()
+        for i in range(3):
+            scheduler.submit(f"a{i}", "a")
+        scheduler.submit("b0", "b")
+
+        assert drain(scheduler, 4) == ["a0", "b0", "a1", "a2"]
+
+    def test_waiting_worker_is_woken(self):
+        scheduler = OCRScheduler()
+
+        async def run():
+            waiter = asyncio.ensure_future(scheduler.next_job())
+            await asyncio.sleep(0)
+            assert not waiter.done()
+            scheduler.submit("job", "a")
+            return await asyncio.wait_for(waiter, 1)
+
+        assert asyncio.run(run()) == "job"
+        assert scheduler.stats()["active"] == 1
+
+    def test_stats(self):
+        scheduler = OCRScheduler()
+        scheduler.submit("a", "a", Priority.interactive)
+        scheduler.submit("b", "b")
+
+        stats = scheduler.stats()
+        assert stats["depth"] == 2
+        assert stats["depth_by_priority"] == {"interactive": 1, "bulk": 1}
+
+        drain(scheduler, 2)
+        stats = scheduler.stats()
+        assert stats["depth"] == 0
+        assert stats["completed"] == 2
+        assert stats["wait_seconds_max"] >= stats["wait_seconds_avg"] >= 0
+
+    def test_grant_capped_by_free_cores(self):
+        scheduler = OCRScheduler(cores=4, demand=lambda job: job)
+        scheduler.submit(3, "a")
+        scheduler.submit(2, "b")
+
+        async def run():
+            large = await scheduler.next_job()
+            small = await scheduler.next_job()
+            return scheduler.grant(large), scheduler.grant(small)
+
+        assert asyncio.run(run()) == (3, 1)
+        assert scheduler.stats()["cores_used"] == 4
+
+    def test_waits_for_free_cores(self):
+        scheduler = OCRScheduler(cores=2, demand=lambda job: 2)
+        scheduler.submit("first", "a")
+        scheduler.submit("second", "b")
+
+        async def run():
+            first = await scheduler.next_job()
+            waiter = asyncio.ensure_future(scheduler.next_job())
+            await asyncio.sleep(0)
+            assert not waiter.done()
+            scheduler.job_done(first)
+            second = await asyncio.wait_for(waiter, 1)
+            return second, scheduler.grant(second)
+
+        assert asyncio.run(run()) == ("second", 2)
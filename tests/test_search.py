@@ -0,0 +1,128 @@
+from datetime import datetime
+
+import pytest
+
+from api import database, search
+from api.database import DBDocument
+from api.search import (
+    compile_query,
+    decode_cursor,
+    encode_cursor,
+    parse_search_query,
+    parse_snippet,
+    restore_accents,
+)
+
+
+async def add_document(pid: str, content: str):
+    await database.execute(
+        DBDocument.__table__.insert().values(
+            pid=pid,
+            lang="vie",
+            status="done",
+            input="",
+            output="",
+            output_json="",
+            output_txt="",
+            expire=datetime.now(),
+            file_name=pid,
+        )
+    )
+    await search.index_document(pid, content)
+
+
+class TestSearchQuery:
+    def test_parse_search_query(self):
+        assert parse_search_query("a && b || c") == [["a ", " b "], [" c"]]
+
+    @pytest.mark.parametrize(
+        "query,expected",
+        [
+            ("invoice", 'text : (("invoice" *))'),
+            ("a && b", 'text : (("a" * AND "b" *))'),
+            ("a && b || c", 'text : (("a" * AND "b" *) OR ("c" *))'),
+            ('say "hi" OR', 'text : (("say ""hi"" OR" *))'),
+            (" && || ", None),
+        ],
+    )
+    def test_compile_query(self, query, expected):
+        assert compile_query(query) == expected
+
+    def test_compile_query_ignore_accents(self):
+        decomposed = "Vie\u0323\u0302t"
+
+        assert compile_query(decomposed) == 'text : (("Việt" *))'
+        assert compile_query(decomposed, ignore_accents=True) == 'folded : (("Viet" *))'
+
+    def test_parse_snippet(self):
+        assert parse_snippet("\x02Hello\x03 world, \x02hello\x03") == {
+            "snippet": "Hello world, hello",
+            "highlights": [[0, 5], [13, 18]],
+        }
+
+    def test_cursor(self):
+        cursor = encode_cursor(-1.5e-06, "pid")
+
+        assert decode_cursor(cursor) == (-1.5e-06, "pid")
+        with pytest.raises(ValueError):
+            decode_cursor("not a cursor")
+
+    def test_compile_query_postgresql(self, monkeypatch):
+        monkeypatch.setattr("api.database.backend", "postgresql")
+
+        assert compile_query("a b && c's || ?") == "(('a' <-> 'b':*) & ('c' <-> 's':*))"
+
+    def test_postgresql_snippet_ignoring_accents(self):
+        statement = search.build_postgresql_search("folded", snippets=True)
+
+        assert statement.startswith("SELECT pid, file_name, rank, snippet, substr(text, strpos(folded")
+
+    def test_postgresql_search_uses_stored_vectors(self, monkeypatch):
+        monkeypatch.setattr("api.database.backend", "postgresql")
+
+        statement = str(search.build_search("a", limit=10, snippets=True))
+
+        assert "to_tsvector" not in statement
+        assert "documents_fts.text_vector @@ query" in statement
+        # headlines are only made for the rows of the page
+        assert "LIMIT :limit) AS hits JOIN documents_fts" in statement
+
+
+class TestSearch:
+    def test_restore_accents(self):
+        result = parse_snippet("…hoa \x02khach\x03 hang")
+
+        assert restore_accents(result, "hóa khách hàng") == {
+            "snippet": "…hóa khách hàng",
+            "highlights": [[5, 10]],
+        }
+        assert restore_accents(parse_snippet("abc"), "ab")["snippet"] == "abc"
+
+    def test_snippet_ignoring_accents_keeps_them(self, db):
+        async def run():
+            await add_document("a", "Đơn hóa khách hàng tại địa chỉ")
+            return await search.search("khach", snippets=True, ignore_accents=True)
+
+        (result,), _ = db(run)
+
+        assert result["snippet"] == "Đơn hóa khách hàng tại địa chỉ"
+        assert result["highlights"] == [[8, 13]]
+
+    def test_page_hits(self, db):
+        async def run():
+            await add_document("a", "invoice\fcontract\fsecond invoice")
+            await add_document("b", "contract")
+            results, _ = await search.search("invoice", limit=1, pages=True)
+            streamed = [
+                line async for line in search.stream_search("invoice", pages=True)
+            ]
+            return results, streamed
+
+        results, streamed = db(run)
+
+        assert [(result["pid"], result["pages"]) for result in results] == [("a", [1, 3])]
+        assert len(streamed) == 1
+        assert '"pages": [1, 3]' in streamed[0]
+
+    def test_page_numbers(self):
+        assert search.page_numbers("a\f\x02b\x03\fc\f\x02d\x03") == [2, 4]
@@ -0,0 +1,85 @@
+from api import storage
+from api.settings import config
+from tests.test_jobs import upload
+
+
+class TestStorage:
+    def test_shard_path(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(config, "workdir", tmp_path)
+
+        path = storage.shard_path("3fa2b1", "i_3fa2b1.pdf")
+
+        assert path == tmp_path / "3f" / "a2" / "i_3fa2b1.pdf"
+        assert path.parent.is_dir()
+
+    def test_delete_files(self, tmp_path):
+        (tmp_path / "a").write_bytes(b"12345")
+
+        assert storage.delete_files(tmp_path / "a", tmp_path / "missing") == 5
+        assert not (tmp_path / "a").exists()
+
+    def test_save_text_counts_blank_last_page(self, db):
+        async def run():
+            await storage.save_text("key", "one\ftwo\f")
+            return await storage.page_count_of("key"), await storage.load_text("key")
+
+        assert db(run) == (3, "one\ftwo\f")
+
+    def test_acquire_artifacts(self, db):
+        async def run():
+            first, second, other = upload(), upload(), upload(b"%PDF-1.4 other")
+            shared = await storage.acquire_artifacts([first, second, other])
+            return first, other, shared
+
+        first, other, shared = db(run)
+
+        assert len(shared) == 2
+        assert shared[first.content_key]["leader"] == str(first.pid)
+        assert shared[first.content_key]["refcount"] == 2
+        assert shared[other.content_key]["refcount"] == 1
+
+    def test_publish_artifact(self, db):
+        async def run():
+            document = upload()
+            await storage.acquire_artifacts([document])
+            published = await storage.publish_artifact(document.content_key)
+            return published, await storage.get_artifact(document.content_key)
+
+        published, artifact = db(run)
+
+        assert published
+        assert artifact["status"] == "done"
+
+    def test_publish_released_artifact(self, db):
+        async def run():
+            document = upload()
+            await storage.acquire_artifacts([document])
+            await storage.release_artifacts({document.content_key: 1})
+            document.output.write_bytes(b"%PDF")
+            return document, await storage.publish_artifact(document.content_key)
+
+        document, published = db(run)
+
+        assert not published
+        assert not document.output.exists()
+
+    def test_release_artifacts(self, db):
+        async def run():
+            document = upload()
+            await storage.acquire_artifacts([document, upload()])
+            await storage.save_text(document.content_key, "text")
+            kept = await storage.release_artifacts({document.content_key: 1})
+            artifact = await storage.get_artifact(document.content_key)
+            removed = await storage.release_artifacts({document.content_key: 1})
+            text = await storage.load_text(document.content_key)
+            return document, kept, artifact, removed, text
+
+        document, kept, artifact, removed, text = db(run)
+
+        assert kept == []
+        assert artifact["refcount"] == 1
+        assert [str(path) for path in removed[:2]] == [
+            str(document.output.resolve()),
+            str(document.output_txt.resolve()),
+        ]
+        assert text is None
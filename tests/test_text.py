@@ -0,0 +1,58 @@
+import unicodedata
+
+import pytest
+
+from api.text import (
+    compress,
+    decompress,
+    fold,
+    normalize,
+    parse_page_range,
+    split_pages,
+)
+
+
+class TestText:
+    def test_normalize_composes_diacritics(self):
+        decomposed = unicodedata.normalize("NFD", "Tiếng Việt")
+
+        assert normalize(decomposed) == "Tiếng Việt"
+
+    def test_normalize_repairs_ocr_layout(self):
+        text = "a docu-\nment  with\t spaces\fNew-\nYork"
+
+        assert normalize(text) == "a document with spaces\fNew-\nYork"
+
+    def test_fold(self):
+        assert fold("Đường phố Hà Nội") == "Duong pho Ha Noi"
+
+    def test_fold_keeps_offsets(self):
+        text = normalize("Tiếng Việt ﬁ 한국어")
+
+        assert len(fold(text)) == len(text)
+
+    def test_compress(self):
+        content = "Tiếng Việt\f" * 100
+
+        assert decompress(*compress(content)) == content
+        assert compress(content, "none") == ("plain", content.encode("utf-8"))
+        assert len(compress(content)[1]) < len(content)
+
+    def test_split_pages(self):
+        text = "one\ftwo two\f"  # a blank last page
+        pages = split_pages(text)
+
+        assert pages == [(0, "one"), (4, "two two"), (12, "")]
+        assert "\f".join(page for _, page in pages) == text
+        assert split_pages("no form feed") == [(0, "no form feed")]
+
+    @pytest.mark.parametrize(
+        "pages,expected", [("3", (3, 3)), ("10-20", (10, 20)), ("10-", (10, None))]
+    )
+    def test_parse_page_range(self, pages, expected):
+        assert parse_page_range(pages) == expected
+
+    @pytest.mark.parametrize("pages", ["0", "5-3", "a-b", "-2"])
+    def test_parse_page_range_invalid(self, pages):
+        with pytest.raises(ValueError):
+            parse_page_range(pages)
@@ -0,0 +1,84 @@
+import asyncio
+import hashlib
+import io
+import zipfile
+
+import pytest
+from fastapi import HTTPException, UploadFile
+
+from api import tools
+from api.tools import extract_pdfs, save_upload_file, write_results_zip
+
+
+def make_zip(path, members):
+    with zipfile.ZipFile(str(path), "w") as zip_file:
+        for name, content in members.items():
+            zip_file.writestr(name, content)
+    return path
+
+
+class TestZip:
+    def test_extract_pdfs(self, tmp_path):
+        archive = make_zip(
+            tmp_path / "a.zip",
+            {"dir/a.pdf": b"%PDF-1.4 a", "notes.txt": b"skip", "__MACOSX/._a.pdf": b""},
+        )
+        paths = iter([("1", tmp_path / "i_1.pdf"), ("2", tmp_path / "i_2.pdf")])
+
+        extracted = extract_pdfs(archive, 1024, 10, lambda: next(paths))
+
+        assert [(pid, name) for pid, _, _, name in extracted] == [("1", "a.pdf")]
+        assert (tmp_path / "i_1.pdf").read_bytes() == b"%PDF-1.4 a"
+
+    def test_extract_pdfs_invalid_member(self, tmp_path):
+        archive = make_zip(
+            tmp_path / "a.zip", {"a.pdf": b"%PDF-1.4 a", "b.pdf": b"not a pdf"}
+        )
+        paths = iter([("1", tmp_path / "i_1.pdf"), ("2", tmp_path / "i_2.pdf")])
+
+        with pytest.raises(HTTPException) as error:
+            extract_pdfs(archive, 1024, 10, lambda: next(paths))
+
+        assert error.value.status_code == 415
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["a.zip"]
+
+    def test_write_results_zip(self, tmp_path):
+        (tmp_path / "a.pdf").write_bytes(b"%PDF-1.4 a")
+        destination = tmp_path / "out.zip"
+
+        write_results_zip(
+            [("1.pdf", tmp_path / "a.pdf"), ("1.txt", tmp_path / "missing.txt")],
+            destination,
+        )
+
+        assert zipfile.ZipFile(str(destination)).namelist() == ["1.pdf"]
+
+
+def save(content, destination, max_size):
+    upload = UploadFile("a.pdf", file=io.BytesIO(content))
+    return asyncio.run(save_upload_file(upload, destination, max_size))
+
+
+class TestUpload:
+    def test_save_upload_file(self, tmp_path):
+        content = b"%PDF-1.4 " + b"x" * 100
+
+        assert save(content, tmp_path / "a.pdf", 200) == hashlib.sha256(content).hexdigest()
+        assert (tmp_path / "a.pdf").read_bytes() == content
+
+    def test_too_large(self, monkeypatch, tmp_path):
+        # over the limit in the second chunk, after the first was written
+        monkeypatch.setattr(tools, "CHUNK_SIZE", 64)
+
+        with pytest.raises(HTTPException) as error:
+            save(b"%PDF-1.4 " + b"x" * 100, tmp_path / "a.pdf", 100)
+
+        assert error.value.status_code == 413
+        assert not (tmp_path / "a.pdf").exists()
+
+    def test_not_a_pdf(self, tmp_path):
+        with pytest.raises(HTTPException) as error:
+            save(b"GIF89a", tmp_path / "a.pdf", 100)
+
+        assert error.value.status_code == 415
+        assert not (tmp_path / "a.pdf").exists()
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import httpx
+import pytest
+
+from api import webhooks
+from api.settings import config
+
+
+@pytest.fixture
+def stub_server():
+    """
+    Local HTTP server answering with the queued status codes (then 200)
+    and recording the calls it got
+    """
+    calls = []
+    statuses = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            calls.append((dict(self.headers), body))
+            self.send_response(statuses.pop(0) if statuses else 200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/hook", calls, statuses
+    server.shutdown()
+
+
+def deliver(url, notifications):
+    async def run():
+        async with httpx.AsyncClient() as http:
+            return await webhooks.deliver(http, url, notifications)
+
+    return asyncio.run(run())
+
+
+class TestWebhooks:
+    def test_deliver_signed(self, stub_server):
+        url, calls, _ = stub_server
+
+        assert deliver(url, [{"pid": "a", "status": "done"}, {"pid": "b", "status": "error"}])
+
+        (headers, body), = calls
+        assert json.loads(body) == {
+            "documents": [{"pid": "a", "status": "done"}, {"pid": "b", "status": "error"}]
+        }
+        assert headers["X-Signature"] == "sha256=" + webhooks.sign(body, headers["X-Timestamp"])
+
+    def test_deliver_retries(self, monkeypatch, stub_server):
+        url, calls, statuses = stub_server
+        monkeypatch.setattr(config, "webhook_retry_base_seconds", 0.01)
+        statuses += [503, 500]
+
+        assert deliver(url, [{"pid": "a", "status": "done"}])
+        assert len(calls) == 3
+
+    def test_deliver_gives_up_on_client_error(self, monkeypatch, stub_server):
+        url, calls, statuses = stub_server
+        monkeypatch.setattr(config, "webhook_retry_base_seconds", 0.01)
+        statuses += [404]
+
+        assert not deliver(url, [{"pid": "a", "status": "done"}])
+        assert len(calls) == 1
+
+    def test_retry_delay(self, monkeypatch):
+        monkeypatch.setattr(config, "webhook_retry_base_seconds", 1)
+        monkeypatch.setattr(config, "webhook_retry_max_seconds", 5)
+
+        assert [webhooks.retry_delay(attempt) for attempt in range(1, 5)] == [1, 2, 4, 5]
+
+    def test_dispatcher_survives_database_errors(self, monkeypatch, mocker):
+        monkeypatch.setattr(config, "webhook_batch_seconds", 0)
+        monkeypatch.setattr(config, "webhook_retry_base_seconds", 0.01)
+        row = {"pid": "a", "file_name": "a", "callback_url": "http://hook"}
+        fetch_all = mocker.patch.object(
+            webhooks.database, "fetch_all", side_effect=[RuntimeError("database down"), [row]]
+        )
+
+        async def run():
+            delivered = asyncio.Event()
+
+            async def fake_deliver(http, url, notifications):
+                delivered.set()
+                return True
+
+            monkeypatch.setattr(webhooks, "deliver", fake_deliver)
+            monkeypatch.setattr(webhooks, "queue", asyncio.Queue())
+            dispatcher = asyncio.ensure_future(webhooks.dispatcher())
+            webhooks.on_event({"pid": "a", "status": "done"})
+            await asyncio.wait_for(delivered.wait(), 1)
+            assert not dispatcher.done()
+            dispatcher.cancel()
+
+        asyncio.run(run())
+        assert fetch_all.call_count == 2
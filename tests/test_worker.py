@@ -0,0 +1,209 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql, sqlite
+
+import api.main
+from api import engine, health, jobs, worker
+from api.settings import config
+from api.worker import build_claim
+from tests.test_jobs import fake_ocrmypdf, row, upload
+
+
+@pytest.fixture
+def queue_mode(monkeypatch, mocker):
+    monkeypatch.setattr(config, "ocr_mode", "queue")
+    monkeypatch.setattr(config, "text_layer_min_chars", 0)
+    return mocker.patch.object(engine, "run_ocrmypdf", side_effect=fake_ocrmypdf)
+
+
+class TestWorker:
+    def test_build_claim(self):
+        statement = build_claim("token", 3, datetime(2024, 1, 1))
+        compiled = str(statement.compile(dialect=sqlite.dialect()))
+
+        assert compiled.startswith("UPDATE documents SET status=?, worker=?, lease_expire=?")
+        assert "documents.lease_expire < ?" in compiled
+        assert "LIMIT ?" in compiled
+        assert "FOR UPDATE" not in compiled
+
+    def test_build_claim_postgresql(self, monkeypatch):
+        monkeypatch.setattr("api.database.backend", "postgresql")
+        statement = build_claim("token", 3, datetime(2024, 1, 1))
+
+        assert "FOR UPDATE SKIP LOCKED" in str(statement.compile(dialect=postgresql.dialect()))
+
+    def test_claim_and_run(self, db, queue_mode):
+
+        async def run():
+            document = upload()
+            await jobs.submit([document])
+            token, claimed = await worker.claim(2)
+            assert [str(job.pid) for job in claimed] == [str(document.pid)]
+            claimed_row = await row(document)
+            assert (claimed_row["status"], claimed_row["worker"]) == ("processing", token)
+            assert (await worker.claim(2))[1] == []
+
+            await worker.run(token, claimed[0])
+            return await row(document)
+
+        stored = db(run)
+
+        assert stored["status"] == "done"
+        queue_mode.assert_called_once()
+
+    def test_long_poll_reads_progress_of_workers(self, db, queue_mode, monkeypatch):
+        monkeypatch.setattr(config, "worker_poll_seconds", 0.05)
+
+        async def run():
+            document = upload()
+            await jobs.submit([document])
+            token, (claimed,) = await worker.claim(1)
+            # another process runs it, nothing is published here
+            monkeypatch.setattr(jobs, "publish", lambda pid, values: None)
+            running = asyncio.ensure_future(worker.run(token, claimed))
+
+            started = asyncio.get_event_loop().time()
+            polled = await api.main.get_doc(document.pid, wait=30, api_key=None)
+            await running
+            return polled, asyncio.get_event_loop().time() - started
+
+        polled, elapsed = db(run)
+
+        assert polled.status == "done"
+        assert elapsed < 5
+
+    def test_taken_over_job_keeps_the_new_result(self, db, queue_mode):
+        def taken_over(*args):
+            fake_ocrmypdf(*args)
+            # the lease ran out meanwhile, another worker claimed the job
+            engine = create_engine(config.database_url)
+            engine.execute(jobs.documents.update().values(worker="other"))
+            engine.dispose()
+            return b"ok"
+
+        queue_mode.side_effect = taken_over
+
+        async def run():
+            document = upload()
+            await jobs.submit([document])
+            token, (claimed,) = await worker.claim(1)
+            await worker.run(token, claimed)
+            return await row(document)
+
+        stored = db(run)
+
+        assert (stored["status"], stored["worker"]) == ("processing", "other")
+        assert stored["finished"] is None
+
+    def test_taken_over_job_keeps_the_new_error(self, db, queue_mode):
+        async def run():
+            document = upload()
+            await jobs.submit([document])
+            token, (claimed,) = await worker.claim(1)
+            await jobs.update_status(str(document.pid), worker="other")
+            await jobs.fail_job(claimed, RuntimeError("late"), token)
+            return await row(document)
+
+        stored = db(run)
+
+        assert (stored["status"], stored["result"]) == ("processing", None)
+
+    def test_heartbeat_survives_database_errors(self, db, monkeypatch, mocker):
+        monkeypatch.setattr(config, "worker_lease_seconds", 0.15)
+
+        def execute_once_failing(query):
+            if execute.call_count == 1:
+                raise RuntimeError("database down")
+
+        execute = mocker.patch.object(
+            worker.database, "execute", side_effect=execute_once_failing
+        )
+
+        async def run():
+            job = asyncio.ensure_future(asyncio.sleep(30))
+            renew = asyncio.ensure_future(worker.heartbeat("token", "pid", job))
+            while execute.call_count < 4:
+                await asyncio.sleep(0.01)
+            alive = not renew.done() and not job.done()
+            renew.cancel()
+            job.cancel()
+            return alive
+
+        assert db(run)
+
+    def test_heartbeat_cancels_job_once_lease_expired(self, db, monkeypatch, mocker):
+        monkeypatch.setattr(config, "worker_lease_seconds", 0.15)
+        mocker.patch.object(
+            worker.database, "execute", side_effect=RuntimeError("database down")
+        )
+
+        async def run():
+            job = asyncio.ensure_future(asyncio.sleep(30))
+            await asyncio.wait_for(worker.heartbeat("token", "pid", job), 5)
+            await asyncio.sleep(0)
+            return job
+
+        assert db(run).cancelled()
+
+    def test_run_returns_once_heartbeat_gave_up(self, db, queue_mode, monkeypatch, mocker):
+        async def hanging(document, token):
+            await asyncio.sleep(30)
+
+        async def expired(token, pid, job):
+            job.cancel()
+
+        mocker.patch.object(jobs, "run_job", side_effect=hanging)
+        fail_job = mocker.patch.object(jobs, "fail_job")
+        monkeypatch.setattr(worker, "heartbeat", expired)
+
+        async def run():
+            await asyncio.wait_for(worker.run("token", upload()), 5)
+
+        db(run)
+
+        fail_job.assert_not_called()
+
+    def test_serve_retries_failed_claims(self, db, queue_mode, monkeypatch, mocker):
+        monkeypatch.setattr(config, "worker_poll_seconds", 0.01)
+        stopping = asyncio.Event()
+        calls = []
+
+        async def claim(limit):
+            calls.append(limit)
+            if len(calls) == 3:
+                stopping.set()
+                return "token", []
+            raise RuntimeError("database down")
+
+        monkeypatch.setattr(worker, "claim", claim)
+
+        db(lambda: asyncio.wait_for(worker.serve(stopping), 5))
+
+        assert len(calls) == 3
+        assert worker.retry_delay(0) == 0.01
+        assert worker.retry_delay(2) == 0.04
+        assert worker.retry_delay(1000) == config.worker_lease_seconds
+
+    def test_queue_depth_from_database(self, db, queue_mode, mocker):
+        mocker.patch.object(health, "database_ok", return_value=None)
+
+        async def run():
+            await jobs.submit(
+                [upload(b"%PDF-1.4 a"), upload(b"%PDF-1.4 b")], priority=jobs.Priority.bulk
+            )
+            await jobs.submit([upload(b"%PDF-1.4 c")], priority=jobs.Priority.interactive)
+            await worker.claim(1)
+            return await health.readiness(jobs.scheduler), await api.main.status_queue()
+
+        report, stats = db(run)
+
+        assert report["queue_depth"] == 2
+        assert report["active"] == 1
+        assert stats == {
+            "depth": 2,
+            "depth_by_priority": {"interactive": 0, "bulk": 2},
+            "active": 1,
+        }